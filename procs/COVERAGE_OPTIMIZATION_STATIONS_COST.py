@@ -1,35 +1,41 @@
-CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "GRID_SIZE" FLOAT DEFAULT 0.02, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "SAMPLE_SIZE" NUMBER(38,0) DEFAULT 500000, "PARTITION_COUNT" NUMBER(38,0) DEFAULT 10)
+CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "GRID_SIZE" FLOAT DEFAULT 0.02, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "SAMPLE_SIZE" NUMBER(38,0) DEFAULT 500000, "PARTITION_COUNT" NUMBER(38,0) DEFAULT 1, "MAX_RUNTIME_SECONDS" FLOAT DEFAULT 0)
 RETURNS VARCHAR
 LANGUAGE PYTHON
 RUNTIME_VERSION = '3.10'
-PACKAGES = ('pandas','numpy','scikit-learn','snowflake-snowpark-python','numba')
+PACKAGES = ('pandas','numpy','scipy','snowflake-snowpark-python','numba','pyarrow')
+IMPORTS = ('@REPORT_DB.GPS_DASHBOARD.PROC_CODE/coverage_engine.py')
 HANDLER = 'main'
 EXECUTE AS CALLER
 AS '
+import time
+IMPORT_STARTED = time.perf_counter()
 import pandas as pd
 import numpy as np
 import json
 import datetime
-from sklearn.neighbors import BallTree
-from numba import njit
+from io import BytesIO
+from scipy.spatial import cKDTree
 import os
+from coverage_engine import (EARTH_RADIUS_KM, PARTITION_CONTEXT, PhaseTimer, assign_cells, chord_length,
+                             efficient_coverage_precomputation, grid_partitions, grow_buffer, import_stats,
+                             jit_kernel, latlon_to_unit_xyz, partition_halo, save_artifacts, solve_partitions)
+# Module-level import time, reported in compute_metrics
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
 # =============================================
-# 1. OPTIMIZED DISTANCE CALCULATION
+# 1. DISTANCES
 # =============================================
-@njit(fastmath=True, cache=True)
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    a = (np.sin(dlat/2)**2 +
-         np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) *
-         np.sin(dlon/2)**2)
-    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+# Points and candidates are (lat, lon) degrees; spatial queries run on
+# latlon_to_unit_xyz vectors in a cKDTree, where chord_length(km) is the
+# exact great-circle radius
 
 # =============================================
 # 2. CANDIDATE GENERATION
 # =============================================
+# Grid cells generated and filtered per tile in generate_candidates
+CANDIDATE_TILE_CELLS = 1_000_000
+KM_PER_DEGREE = EARTH_RADIUS_KM * np.pi / 180
+
 def generate_candidates(gps_points: np.ndarray, grid_size: float) -> np.ndarray:
     lat_q1, lat_q3 = np.percentile(gps_points[:,0], [25, 75])
     lon_q1, lon_q3 = np.percentile(gps_points[:,1], [25, 75])
@@ -42,94 +48,201 @@ def generate_candidates(gps_points: np.ndarray, grid_size: float) -> np.ndarray:
 
     lat_grid = np.arange(lat_min, lat_max, grid_size)
     lon_grid = np.arange(lon_min, lon_max, grid_size)
-    grid_lats, grid_lons = np.meshgrid(lat_grid, lon_grid)
-    candidates = np.column_stack((grid_lats.ravel(), grid_lons.ravel()))
 
-    tree = BallTree(np.deg2rad(gps_points), metric="haversine")
-    dists, _ = tree.query(np.deg2rad(candidates), k=1)
-    valid_mask = (dists.ravel() <= (grid_size * np.pi/180 * 6371))
-    return candidates[valid_mask]
+    # The grid is built and filtered a block of longitude columns at a time,
+    # so at most CANDIDATE_TILE_CELLS cells exist at once; candidates come
+    # out in the same (longitude, latitude) order as one meshgrid.  A grid
+    # cell is kept when a point lies within one grid step (in km) of it
+    tree = cKDTree(latlon_to_unit_xyz(gps_points))
+    step_chord = np.nextafter(chord_length(grid_size * KM_PER_DEGREE), np.inf)
+    columns_per_tile = max(1, CANDIDATE_TILE_CELLS // max(len(lat_grid), 1))
+    tiles = []
+    for start in range(0, len(lon_grid), columns_per_tile):
+        grid_lats, grid_lons = np.meshgrid(lat_grid, lon_grid[start:start + columns_per_tile])
+        tile = np.column_stack((grid_lats.ravel(), grid_lons.ravel()))
+        chords, _ = tree.query(latlon_to_unit_xyz(tile), k=1, distance_upper_bound=step_chord)
+        tiles.append(tile[np.isfinite(chords)])
+    return np.concatenate(tiles) if tiles else np.zeros((0, 2))
 
 # =============================================
 # 3. HELPER FUNCTIONS
 # =============================================
-def find_best_station(points, candidates, radius, weights=None):
-    if len(candidates) == 0 or len(points) == 0:
-        return None, []
-    tree = BallTree(np.deg2rad(points), metric="haversine")
-    cover_counts = []
-    for c in candidates:
-        idx = tree.query_radius(np.deg2rad([c]), r=radius/6371)[0]
-        if weights is not None:
-            score = weights[idx].sum()
-        else:
-            score = len(idx)
-        cover_counts.append((score, idx))
-    if not cover_counts:
-        return None, []
-    best_idx = np.argmax([c[0] for c in cover_counts])
-    return candidates[best_idx], cover_counts[best_idx][1]
-
-def enforce_separation(candidates, selected, min_sep):
-    if len(selected) == 0:
-        return candidates
-    sel_array = np.array(selected)
-    tree = BallTree(np.deg2rad(sel_array), metric="haversine")
-    mask = np.ones(len(candidates), dtype=bool)
-    for i, c in enumerate(candidates):
-        dist, _ = tree.query(np.deg2rad([c]), k=1)
-        if dist[0][0] * 6371 < min_sep:
-            mask[i] = False
-    return candidates[mask]
-
-def calculate_coverage(points, stations, radius):
-    if len(stations) == 0:
-        return 0
-    tree = BallTree(np.deg2rad(stations), metric="haversine")
-    covered = 0
-    for p in points:
-        dist, _ = tree.query(np.deg2rad([p]), k=1)
-        if dist[0][0] * 6371 <= radius:
-            covered += 1
-    return covered / len(points)
+def point_candidates(indptr, indices, n_points):
+    """The inverse CSR index: candidates covering point p are
+    candidates[point_indptr[p]:point_indptr[p + 1]]"""
+    owners = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    point_indptr = np.zeros(n_points + 1, dtype=np.int64)
+    np.cumsum(np.bincount(indices, minlength=n_points), out=point_indptr[1:])
+    return point_indptr, owners[np.argsort(indices, kind="stable")]
+
+@jit_kernel
+def cover_candidate(candidate, indptr, indices, point_indptr, point_owners, weights, rows, covered, gains,
+                    open_points):
+    # Mark the points of candidate covered and take each newly covered point
+    # out of the gain of every candidate that covers it.  open_points counts
+    # each candidate''s uncovered points, so a gain is exactly 0 once they
+    # are all covered.  Returns how many sampled rows (rows per point) were
+    # newly covered
+    newly = 0
+    for j in range(indptr[candidate], indptr[candidate + 1]):
+        p = indices[j]
+        if covered[p]:
+            continue
+        covered[p] = True
+        newly += rows[p]
+        for k in range(point_indptr[p], point_indptr[p + 1]):
+            other = point_owners[k]
+            open_points[other] -= 1
+            gains[other] = gains[other] - weights[p] if open_points[other] > 0 else 0.0
+    return newly
+
+def stream_points(frame, capacity=65536, timer=None):
+    # Read MEAN_LAT/MEAN_LONG and their row COUNT batch by batch into
+    # preallocated float32 / int64 buffers (doubled when full) instead of
+    # materializing a pandas copy; the wait for the first batch is the query
+    # itself (sql_aggregation)
+    points = np.empty((capacity, 2), dtype=np.float32)
+    counts = np.empty(capacity, dtype=np.int64)
+    n_rows = 0
+    for batch in frame.to_pandas_batches():
+        if timer is not None and n_rows == 0:
+            timer.mark("sql_aggregation")
+        end = n_rows + len(batch)
+        if end > len(points):
+            rows = max(2*len(points), end)
+            points, counts = grow_buffer(points, rows), grow_buffer(counts, rows)
+        points[n_rows:end, 0] = batch["MEAN_LAT"].to_numpy(dtype=np.float32)
+        points[n_rows:end, 1] = batch["MEAN_LONG"].to_numpy(dtype=np.float32)
+        counts[n_rows:end] = batch["COUNT"].to_numpy(dtype=np.int64)
+        n_rows = end
+    if timer is not None:
+        timer.mark("to_pandas" if n_rows else "sql_aggregation", rows=n_rows)
+    return points[:n_rows], counts[:n_rows]
 
 # =============================================
 # 4. GREEDY OPTIMIZATION
 # =============================================
-def optimized_greedy_cover(gps_points, service_radius, min_separation, max_stations, weights=None, batch_size=100000):
+def sample_candidates(gps_points, service_radius, batch_size=100000):
     if len(gps_points) > batch_size:
         sample_idx = np.random.choice(len(gps_points), size=batch_size, replace=False)
         points_sample = gps_points[sample_idx]
-        w_sample = weights[sample_idx] if weights is not None else None
     else:
         points_sample = gps_points
-        w_sample = weights
+    # Grid step of half the service radius, in degrees
+    return generate_candidates(points_sample, service_radius/2 / KM_PER_DEGREE)
 
-    candidates = generate_candidates(points_sample, service_radius/2)
+def optimized_greedy_cover(gps_points, service_radius, min_separation, max_stations, weights=None, batch_size=100000,
+                           candidates=None, deadline=None, rows=None, stop_rows=None, workers=-1):
+    # Past deadline (time.time() seconds) return the stations selected so far;
+    # the second return value says whether the deadline stopped the greedy.
+    # rows is the number of sampled rows at each point (1 each by default);
+    # the greedy stops once fewer than stop_rows (batch_size/10 by default)
+    # sampled rows are left uncovered.  workers is the coverage query's
+    # thread count
+    if candidates is None:
+        candidates = sample_candidates(gps_points, service_radius, batch_size)
+    point_rows = rows if rows is not None else np.ones(len(gps_points), dtype=np.int64)
+    if stop_rows is None:
+        stop_rows = batch_size/10
     selected = []
-    remaining_points = gps_points.copy()
-    remaining_weights = weights.copy() if weights is not None else None
+    if len(candidates) == 0 or len(gps_points) == 0:
+        return selected, False
+    # Coverage is computed once; each pick then only touches the points it
+    # covers and the candidates covering those (the inverse index), and the
+    # candidates within min_separation of it
+    point_weights = weights if weights is not None else np.ones(len(gps_points))
+    candidates_xyz = latlon_to_unit_xyz(candidates)
+    indptr, indices = efficient_coverage_precomputation(candidates_xyz, cKDTree(latlon_to_unit_xyz(gps_points)),
+                                                        chord_length(service_radius), workers=workers)
+    point_indptr, point_owners = point_candidates(indptr, indices, len(gps_points))
+    open_points = np.diff(indptr)
+    gains = np.bincount(np.repeat(np.arange(len(candidates)), open_points), weights=point_weights[indices],
+                        minlength=len(candidates))
+    covered = np.zeros(len(gps_points), dtype=bool)
+    uncovered = point_rows.sum()
+    dead = np.zeros(len(candidates), dtype=bool)
+    candidate_tree = cKDTree(candidates_xyz) if min_separation > 0 else None
+    # Candidates strictly closer than min_separation are dropped
+    separation_chord = np.nextafter(chord_length(min_separation), 0)
 
+    stopped_at_deadline = False
     while len(selected) < max_stations:
-        best_station, covered_idx = find_best_station(remaining_points, candidates, service_radius, remaining_weights)
-        if best_station is None:
+        if deadline is not None and time.time() >= deadline:
+            stopped_at_deadline = True
             break
-        selected.append(best_station)
-        remaining_points = np.delete(remaining_points, covered_idx, axis=0)
-        if remaining_weights is not None:
-            remaining_weights = np.delete(remaining_weights, covered_idx)
-        candidates = enforce_separation(candidates, selected, min_separation)
-        if len(remaining_points) < batch_size/10:
+        best = int(np.argmax(np.where(dead, -np.inf, gains)))
+        if dead[best] or gains[best] <= 0:
             break
-    return selected
+        selected.append(candidates[best])
+        uncovered -= cover_candidate(best, indptr, indices, point_indptr, point_owners, point_weights, point_rows,
+                                     covered, gains, open_points)
+        dead[best] = True
+        if candidate_tree is not None:
+            dead[candidate_tree.query_ball_point(candidates_xyz[best], separation_chord)] = True
+        if uncovered < stop_rows:
+            break
+    return selected, stopped_at_deadline
 
 # =============================================
-# 5. MAIN PROCEDURE
+# 5. PARTITIONED SOLVE
+# =============================================
+def solve_partition(members):
+    # Candidates come from the partition''s own points; demand adds a halo
+    # of other partitions'' points within service_radius of an own point, so
+    # border candidates are valued by all the traffic they serve.  Halo
+    # points carry no rows, so the early stop counts the partition''s own
+    # sampled rows against its share of the global threshold
+    ctx = PARTITION_CONTEXT
+    gps_points = ctx["gps_points"]
+    halo, _ = partition_halo(ctx["points_xyz"], members, ctx["radius_chord"])
+    demand = np.concatenate((members, halo))
+    rows = np.concatenate((ctx["rows"][members], np.zeros(len(halo), dtype=np.int64)))
+    weights = ctx["weights"][demand] if ctx["weights"] is not None else None
+    candidates = sample_candidates(gps_points[members], ctx["service_radius"], ctx["batch_size"])
+    return optimized_greedy_cover(gps_points[demand], ctx["service_radius"], ctx["min_separation"],
+                                  ctx["max_stations"], weights, ctx["batch_size"], candidates=candidates,
+                                  deadline=ctx["deadline"], rows=rows,
+                                  stop_rows=ctx["batch_size"]/10 * rows.sum() / ctx["rows"].sum(),
+                                  workers=ctx["query_workers"])
+
+def partitioned_greedy_cover(gps_points, service_radius, min_separation, max_stations, weights, partition_count,
+                             deadline=None, rows=None, batch_size=100000):
+    # Solve grid partitions in forked workers (they inherit the arrays), then
+    # reconcile: a greedy pass over all points with the union of partition
+    # stations as candidates re-applies min_separation across borders and
+    # counts each point once.  The result is partial if the deadline stopped
+    # any partition or the reconciliation
+    labels = grid_partitions(gps_points, partition_count)
+    partitions = [np.flatnonzero(labels == p) for p in np.unique(labels)]
+    rows = rows if rows is not None else np.ones(len(gps_points), dtype=np.int64)
+    context = {"gps_points": gps_points, "points_xyz": latlon_to_unit_xyz(gps_points), "weights": weights,
+               "rows": rows, "service_radius": service_radius, "radius_chord": chord_length(service_radius),
+               "min_separation": min_separation, "max_stations": max_stations, "deadline": deadline,
+               "batch_size": batch_size}
+    partition_results = solve_partitions(solve_partition, context, partitions,
+                                         min(os.cpu_count() or 1, len(partitions)))
+    partitions_stopped = any(stopped for _, stopped in partition_results)
+    candidates = np.array([s for stations, _ in partition_results for s in stations])
+    if len(candidates) == 0:
+        return [], partitions_stopped
+    selected, stopped_at_deadline = optimized_greedy_cover(gps_points, service_radius, min_separation, max_stations,
+                                                           weights, batch_size, candidates=candidates,
+                                                           deadline=deadline, rows=rows)
+    return selected, partitions_stopped or stopped_at_deadline
+
+# =============================================
+# 6. MAIN PROCEDURE
 # =============================================
 def main(session, service_radius, min_separation, coverage_target, max_stations,
          zoom_level, stage_name, start_time, end_time, area, province, district,
-         grid_size=0.02, use_traffic_weighting=True, sample_size=500000, partition_count=10):
+         grid_size=0.02, use_traffic_weighting=True, sample_size=500000, partition_count=1,
+         max_runtime_seconds=0):
 
+    start = time.time()
+    timer = PhaseTimer()
+    # Past the deadline the greedy returns the stations so far and the
+    # result is flagged partial, only when the deadline actually stopped it
+    deadline = start + max_runtime_seconds if max_runtime_seconds and max_runtime_seconds > 0 else None
     df = session.table("REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED")
     if start_time and end_time:
         df = df.filter((df["MEAN_TIMESTAMP"] >= start_time) & (df["MEAN_TIMESTAMP"] <= end_time))
@@ -140,36 +253,77 @@ def main(session, service_radius, min_separation, coverage_target, max_stations,
     if district and district != "NULL":
         df = df.filter(df["DISTRICT"].isin([d.strip("''''") for d in district.split("'''', ''''")]))
 
-    if sample_size and df.count() > sample_size:
-        df = df.sample(sample_size)
-
-    gps_points = df.select("MEAN_LAT", "MEAN_LONG").to_pandas().to_numpy()
+    # A fixed-size row sample needs no count() first (a smaller table is
+    # returned whole), and grouping it server-side makes the whole fetch one
+    # scan: each distinct coordinate comes back once with its row count
+    if sample_size:
+        df = df.sample(n=int(sample_size))
+    cells = df.group_by("MEAN_LAT", "MEAN_LONG").count()
+    gps_points, point_counts = stream_points(cells, capacity=int(sample_size or 65536), timer=timer)
     if len(gps_points) == 0:
         return json.dumps({"message": "No data after filtering", "stations": []})
 
-    weights = None
+    # Every sampled row still counts once, as it did before coordinates were
+    # deduplicated; traffic weighting scales each row by 1-10 on top
+    weights = point_counts.astype(np.float64)
     if use_traffic_weighting:
-        freq_df = df.group_by("MEAN_LAT", "MEAN_LONG").count().to_pandas()
-        max_count = freq_df["COUNT"].max()
-        weights = np.array([1 + 9*(c/max_count) for c in freq_df["COUNT"]])
+        weights = weights * (1 + 9*(point_counts / point_counts.max()))
+    timer.mark("traffic_weights", rows=len(gps_points))
 
-    stations = optimized_greedy_cover(gps_points, service_radius, min_separation, max_stations, weights)
-    coverage = calculate_coverage(gps_points, stations, service_radius)
+    if partition_count and partition_count > 1:
+        stations, partial = partitioned_greedy_cover(gps_points, service_radius, min_separation, max_stations,
+                                                     weights, partition_count, deadline, rows=point_counts)
+    else:
+        stations, partial = optimized_greedy_cover(gps_points, service_radius, min_separation, max_stations, weights,
+                                                   deadline=deadline, rows=point_counts)
+    timer.mark("greedy", stations=len(stations))
+    # One batched nearest-station query gives both the coverage (the share
+    # of sampled rows near a station) and the per-point assignment saved
+    # with the results
+    station_array = np.array(stations, dtype=np.float64).reshape(-1, 2)
+    nearest, distance_km = assign_cells(latlon_to_unit_xyz(gps_points), latlon_to_unit_xyz(station_array),
+                                        service_radius)
+    coverage = float(point_counts[nearest >= 0].sum()) / float(point_counts.sum())
+    timer.mark("coverage", points=len(gps_points))
 
     result = {
-        "stations": [{"lat": float(s[0]), "lon": float(s[1])} for s in stations],
+        "stations": [{"lat": round(float(s[0]), 6), "lon": round(float(s[1]), 6)} for s in stations],
         "coverage": coverage,
+        "partial": partial,
         "compute_metrics": {
             "points_processed": len(gps_points),
+            "rows_sampled": int(point_counts.sum()),
+            "partitions": int(partition_count) if partition_count and partition_count > 1 else 1,
             "execution_time": datetime.datetime.now().strftime("%H:%M:%S"),
+            "total_seconds": round(time.time() - start, 2),
+            "import_seconds": import_stats(IMPORT_SECONDS),
             "warehouse": session.get_current_warehouse()
         }
     }
 
-    tmp_path = f"/tmp/results_{datetime.datetime.now().strftime(''%Y%m%d'')}.json"
-    with open(tmp_path, "w") as f:
-        json.dump(result, f)
-
-    session.file.put(tmp_path, f"@{stage_name}/results_{datetime.datetime.now().strftime(''%Y%m%d'')}.json", overwrite=True)
-    return json.dumps(result)
+    # Stations and the nearest station of every point go to the stage as
+    # Parquet, streamed without a local file; the result, serialized once,
+    # is a manifest pointing at them
+    stage = stage_name if stage_name.startswith("@") else f"@{stage_name}"
+    stage_prefix = f"{stage}/results_{datetime.datetime.now().strftime(''%Y%m%d%H%M%S'')}"
+    result["artifacts"] = save_artifacts(session, stage_prefix, {
+        "stations": pd.DataFrame({
+            "station_id": np.arange(1, len(station_array) + 1, dtype=np.int32),
+            "lat": station_array[:, 0],
+            "lon": station_array[:, 1],
+        }),
+        "points": pd.DataFrame({
+            "lat": gps_points[:, 0],
+            "lon": gps_points[:, 1],
+            "station_id": nearest + 1,
+            "distance_km": distance_km,
+            "row_count": point_counts,
+        }),
+    })
+    # Encoding and uploading this manifest itself is the only untimed work
+    timer.mark("serialization", points=len(gps_points))
+    result["compute_metrics"]["phases"] = timer.summary()
+    result_json = json.dumps(result)
+    session.file.put_stream(BytesIO(result_json.encode("utf-8")), f"{stage_prefix}/result.json", overwrite=True)
+    return result_json
 ';
\ No newline at end of file
@@ -1,34 +1,75 @@
-CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "H3_RESOLUTION" NUMBER(38,0) DEFAULT 7)
+CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "H3_RESOLUTION" NUMBER(38,0) DEFAULT 7, "STRATEGY" VARCHAR DEFAULT 'celf', "CURVE_TARGETS" VARCHAR DEFAULT '0.5,0.75,0.9,0.95', "MAX_RUNTIME_SECONDS" FLOAT DEFAULT 0, "CHECKPOINT_SECONDS" FLOAT DEFAULT 30)
 RETURNS VARCHAR
 LANGUAGE PYTHON
 RUNTIME_VERSION = '3.10'
-PACKAGES = ('pandas','numpy','scikit-learn','snowflake-snowpark-python','scipy')
+PACKAGES = ('pandas','numpy','snowflake-snowpark-python','scipy','pyarrow')
+IMPORTS = ('@REPORT_DB.GPS_DASHBOARD.PROC_CODE/coverage_engine.py')
 HANDLER = 'main'
 EXECUTE AS OWNER
 AS '
+import time
+IMPORT_STARTED = time.perf_counter()
 import pandas as pd
 import numpy as np
 import json
 import datetime
+import hashlib
 from io import BytesIO
 from scipy.spatial import cKDTree
 import heapq
-from snowflake.snowpark.functions import col, avg, count
-
-def haversine_distance(lat1, lon1, lat2, lon2):
-    # Haversine distance in km between two points
-    R = 6371.0
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    a = np.sin(dlat/2)**2 + np.cos(np.radians(lat1))*np.cos(np.radians(lat2))*np.sin(dlon/2)**2
-    c = 2*np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    return R * c
+from snowflake.snowpark.functions import col, avg, count, lit
+from coverage_engine import (PhaseTimer, assign_cells, chord_length,
+                             efficient_coverage_precomputation, import_stats, latlon_to_unit_xyz, save_artifacts,
+                             stream_cells)
+# Module-level import time, reported in optimization_stats
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_TTL_HOURS = 24
+# Stations a call with a time limit selects before it checks the clock, so
+# a call whose setup eats the whole limit still moves a resumed run forward
+MIN_PICKS_PER_CALL = 16
+
+def load_checkpoint(session, path):
+    """
+    [lat, lon] of the stations an interrupted call saved at path, in
+    selection order; empty when there is no checkpoint or it expired
+    """
+    try:
+        state = json.load(session.file.get_stream(path))
+    except Exception:
+        return []
+    if time.time() - state["saved_at"] > CHECKPOINT_TTL_HOURS * 3600:
+        return []
+    return state["stations"]
+
+def save_checkpoint(session, path, stations):
+    try:
+        payload = json.dumps({"saved_at": time.time(), "stations": stations})
+        session.file.put_stream(BytesIO(payload.encode("utf-8")), path, auto_compress=False, overwrite=True)
+    except Exception as e:
+        print(f"[WARN] Could not save checkpoint: {str(e)}")
 
 def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
          ZOOM_LEVEL, STAGE_NAME, START_TIME, END_TIME, AREA, PROVINCE, DISTRICT,
-         USE_TRAFFIC_WEIGHTING=True, H3_RESOLUTION=7):
+         USE_TRAFFIC_WEIGHTING=True, H3_RESOLUTION=7, STRATEGY="celf",
+         CURVE_TARGETS="0.5,0.75,0.9,0.95", MAX_RUNTIME_SECONDS=0, CHECKPOINT_SECONDS=30):
 
     print("[INFO] Starting coverage optimization...")
+    timer = PhaseTimer()
+    # celf: exact lazy greedy; threshold: legacy 95% stale-gain heuristic
+    strategy = (STRATEGY or "celf").lower()
+    if strategy not in ("celf", "threshold"):
+        raise ValueError(f"Unknown STRATEGY {STRATEGY}; expected celf or threshold")
+
+    # Past the deadline the greedy stops with the stations so far, the
+    # result is flagged partial and the stations are checkpointed under a
+    # key of every input that shapes them, so an identical call resumes
+    deadline = time.time() + MAX_RUNTIME_SECONDS if MAX_RUNTIME_SECONDS and MAX_RUNTIME_SECONDS > 0 else None
+    checkpoint_key = hashlib.sha256(json.dumps([str(p) for p in (
+        START_TIME, END_TIME, AREA, PROVINCE, DISTRICT, USE_TRAFFIC_WEIGHTING, H3_RESOLUTION,
+        SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS, strategy)]).encode("utf-8")).hexdigest()[:32]
+    checkpoint_path = f"{STAGE_NAME}/{CHECKPOINT_DIR}/{checkpoint_key}.json"
 
     # Step 1: Filter and aggregate GPS points inside Snowflake, grouped by H3 cell
     base_df = session.table("REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED")
@@ -85,18 +126,19 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
             count("*").alias("POINT_COUNT")
         )
 
-        # Convert aggregated result to pandas dataframe (much smaller now)
-        agg_pdf = agg_df.to_pandas()
+        # Stream the aggregated result into NumPy buffers
+        gps_points, point_counts, gps_xyz, _ = stream_cells(agg_df, timer=timer)
         
     except Exception as e:
         print(f"[ERROR] H3 aggregation failed, falling back to simple sampling: {str(e)}")
         # Fallback: simple sampling without H3
         sample_df = base_df.sample(n=min(10000, base_df.count()))  # Limit to 10k points
-        agg_pdf = sample_df.select("MEAN_LAT", "MEAN_LONG").to_pandas()
-        agg_pdf.columns = ["CELL_LAT", "CELL_LON"]
-        agg_pdf["POINT_COUNT"] = 1
+        timer.mark("sampling")
+        gps_points, point_counts, gps_xyz, _ = stream_cells(sample_df.select(
+            col("MEAN_LAT").alias("CELL_LAT"), col("MEAN_LONG").alias("CELL_LON"), lit(1).alias("POINT_COUNT")
+        ), capacity=10000, timer=timer)
     
-    if agg_pdf.empty:
+    if len(gps_points) == 0:
         return json.dumps({
             "message": "No GPS data found after filtering",
             "stations": [],
@@ -108,10 +150,9 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
             }
         })
 
-    print(f"[INFO] Working with {len(agg_pdf)} data points")
+    print(f"[INFO] Working with {len(gps_points)} data points")
 
-    gps_points = agg_pdf[["CELL_LAT", "CELL_LON"]].values
-    weights = agg_pdf["POINT_COUNT"].values.astype(float)
+    weights = point_counts.astype(float)
 
     # Step 2: If traffic weighting enabled, normalize weights 1-10
     if USE_TRAFFIC_WEIGHTING:
@@ -119,77 +160,143 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
     else:
         weights = np.ones_like(weights)
 
-    # Step 3: Build cKDTree for spatial queries (fast radius searches)
-    tree = cKDTree(np.radians(gps_points))  # use radians for spherical approx
+    # Step 3: Build cKDTree on 3D unit vectors so radius searches are exact
+    # great-circle neighborhoods; distances become chord lengths
+    tree = cKDTree(gps_xyz)
+    timer.mark("tree_build", candidates=len(gps_xyz))
 
-    # Convert distances to radians for queries
-    service_radius_rad = SERVICE_RADIUS / 6371.0  # Earth radius in km
-    min_separation_rad = MIN_SEPARATION / 6371.0
+    service_radius_chord = chord_length(SERVICE_RADIUS)
+    # Stations must be strictly closer than MIN_SEPARATION to conflict
+    min_separation_chord = np.nextafter(chord_length(MIN_SEPARATION), 0)
 
     # Step 4: Candidate points are all aggregated H3 cells
-    candidates = gps_points.copy()
+    candidates = gps_points.astype(np.float64)
     candidate_weights = weights.copy()
 
-    # Precompute coverage for all candidates (indices of gps_points within service radius)
-    print("[INFO] Precomputing coverage sets for all candidates...")
-    candidate_coverage = []
-    for idx, candidate in enumerate(np.radians(candidates)):
-        indices = tree.query_ball_point(candidate, service_radius_rad)
-        candidate_coverage.append(set(indices))
+    # Precompute coverage for all candidates (indices of gps_points within
+    # service radius) as flat int32 CSR arrays: candidate i covers
+    # coverage_indices[coverage_indptr[i]:coverage_indptr[i + 1]]
+    print("[INFO] Precomputing coverage for all candidates...")
+    candidates_xyz = gps_xyz
+    coverage_indptr, coverage_indices = efficient_coverage_precomputation(candidates_xyz, tree, service_radius_chord)
+    timer.mark("coverage_precomputation", coverage_entries=len(coverage_indices))
 
     # Step 5: Greedy algorithm with priority queue for maximum uncovered weighted coverage
+    # There is no partitioned mode: a resumed call replays its checkpoint
+    # into this single greedy, which per-partition solves would not
+    # reproduce.  Large areas are partitioned by COST_OPTIMIZED_V2
+    # (PARTITION_MODE) instead
     selected_stations = []
-    covered_points = set()
+    covered_points = np.zeros(len(gps_points), dtype=bool)
     uncovered_weight = weights.sum()
 
-    # Priority queue stores tuples: (-gain, candidate_index)
-    heap = []
-    for idx, coverage_set in enumerate(candidate_coverage):
-        gain = sum(weights[i] for i in coverage_set)
-        heapq.heappush(heap, (-gain, idx))
+    def newly_covered_by(candidate_idx):
+        points = coverage_indices[coverage_indptr[candidate_idx]:coverage_indptr[candidate_idx + 1]]
+        return points[~covered_points[points]]
+
+    # Candidates inside MIN_SEPARATION of a selected station are marked dead
+    # in bulk and never evaluated again
+    dead = np.zeros(len(candidates), dtype=bool)
+    candidates_pruned = 0
+
+    # Greedy is prefix-monotone, so recording coverage after every pick
+    # gives the whole stations-vs-coverage curve from this one run
+    curve_coverage = []
+    curve_gain = []
 
-    print("[INFO] Running greedy selection...")
+    def select(candidate_idx, newly_covered, actual_gain):
+        nonlocal uncovered_weight, candidates_pruned
+        selected_stations.append(candidate_idx)
+        dead[candidate_idx] = True
+        if MIN_SEPARATION > 0:
+            pruned = tree.query_ball_point(candidates_xyz[candidate_idx], min_separation_chord)
+            candidates_pruned += int(np.count_nonzero(~dead[pruned]))
+            dead[pruned] = True
+        covered_points[newly_covered] = True
+        uncovered_weight -= actual_gain
+        current_coverage = 1 - (uncovered_weight / weights.sum()) if weights.sum() > 0 else 0
+        curve_coverage.append(round(float(current_coverage), 6))
+        curve_gain.append(round(float(actual_gain), 4))
+        return current_coverage
+
+    # Step 5b: Replay the stations of an interrupted call in their order,
+    # which restores the state its greedy stopped in
+    resumed_stations = 0
+    saved_stations = load_checkpoint(session, checkpoint_path) if deadline is not None else []
+    if saved_stations:
+        distances, saved_ids = tree.query(latlon_to_unit_xyz(np.asarray(saved_stations)))
+        for candidate_idx in saved_ids[distances < 1e-9]:
+            newly_covered = newly_covered_by(candidate_idx)
+            select(candidate_idx, newly_covered, weights[newly_covered].sum())
+        resumed_stations = len(selected_stations)
+        print(f"[INFO] Resumed from {checkpoint_path} after {resumed_stations} stations")
+        timer.mark("resume", stations=resumed_stations)
+
+    # Priority queue stores tuples: (-gain, candidate_index, stamp) where
+    # stamp is the number of stations selected when the gain was computed;
+    # after a resume gains are computed against the replayed stations, so
+    # only ties of equal gain may break differently than in the first call
+    heap = [(-weights[newly_covered_by(idx)].sum(), idx, len(selected_stations))
+            for idx in np.flatnonzero(~dead).tolist()]
+    heapq.heapify(heap)
+
+    gain_evaluations = len(heap)
+    gain_reevaluations = 0
+    heap_pops = 0
+    timer.mark("heap_init", heap_entries=len(heap))
+
+    checkpoint_saved_at = time.time()
+    checkpoint_saves = 0
+    stopped_at_deadline = False
+
+    print(f"[INFO] Running {strategy} greedy selection...")
 
     while len(selected_stations) < MAX_STATIONS and uncovered_weight > 0:
         if not heap:
             print("[WARN] No more candidates in heap")
             break
+        if 1 - (uncovered_weight / weights.sum()) >= COVERAGE_TARGET:
+            # Only a resumed call can start at the target
+            break
+        if (deadline is not None and len(selected_stations) - resumed_stations >= MIN_PICKS_PER_CALL
+                and time.time() >= deadline):
+            stopped_at_deadline = True
+            print(f"[WARN] Time limit reached after {len(selected_stations)} stations")
+            break
 
-        neg_gain, candidate_idx = heapq.heappop(heap)
+        neg_gain, candidate_idx, stamp = heapq.heappop(heap)
+        heap_pops += 1
         gain = -neg_gain
+        if dead[candidate_idx]:
+            continue
 
         # Calculate actual gain based on uncovered points
-        newly_covered = candidate_coverage[candidate_idx].difference(covered_points)
-        actual_gain = sum(weights[i] for i in newly_covered)
+        newly_covered = newly_covered_by(candidate_idx)
+        if strategy == "celf" and stamp == len(selected_stations):
+            # Gain is current: gains only shrink, so it beats every stale bound
+            actual_gain = gain
+        else:
+            actual_gain = weights[newly_covered].sum()
+            gain_evaluations += 1
+            gain_reevaluations += 1
 
-        if actual_gain < gain * 0.95:
-            # Gain decreased, reinsert with updated gain
-            if actual_gain > 0:
-                heapq.heappush(heap, (-actual_gain, candidate_idx))
-            continue
+            if strategy == "celf" or actual_gain < gain * 0.95:
+                # Gain is stale or decreased, reinsert with updated gain
+                if actual_gain > 0:
+                    heapq.heappush(heap, (-actual_gain, candidate_idx, len(selected_stations)))
+                continue
 
         if actual_gain == 0:
             # No coverage improvement, skip
             continue
 
-        # Check min separation constraint against already selected stations
-        lat1, lon1 = candidates[candidate_idx]
-        too_close = False
-        for st in selected_stations:
-            lat2, lon2 = candidates[st]
-            dist = haversine_distance(lat1, lon1, lat2, lon2)
-            if dist < MIN_SEPARATION:
-                too_close = True
-                break
-        if too_close:
-            continue
-
         # Select station
-        selected_stations.append(candidate_idx)
-        covered_points.update(newly_covered)
-        uncovered_weight -= actual_gain
-
-        current_coverage = 1 - (uncovered_weight / weights.sum()) if weights.sum() > 0 else 0
+        lat1, lon1 = candidates[candidate_idx]
+        current_coverage = select(candidate_idx, newly_covered, actual_gain)
+        if deadline is not None and time.time() - checkpoint_saved_at >= CHECKPOINT_SECONDS:
+            save_checkpoint(session, checkpoint_path, candidates[selected_stations].tolist())
+            checkpoint_saved_at = time.time()
+            checkpoint_saves += 1
         print(f"[INFO] Selected station #{len(selected_stations)} at ({lat1:.5f}, {lon1:.5f}), "
               f"coverage: {current_coverage*100:.2f}%")
 
@@ -197,18 +304,36 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
             print(f"[INFO] Coverage target {COVERAGE_TARGET*100:.2f}% reached.")
             break
 
+    timer.mark("greedy", stations=len(selected_stations), heap_pops=heap_pops,
+               gain_reevaluations=gain_reevaluations)
+    if stopped_at_deadline:
+        save_checkpoint(session, checkpoint_path, candidates[selected_stations].tolist())
+    elif saved_stations or checkpoint_saves:
+        try:
+            session.sql(f"REMOVE {checkpoint_path}").collect()
+        except Exception as e:
+            print(f"[WARN] Could not remove checkpoint: {str(e)}")
+
     # Step 6: Build result JSON
     stations_info = [
         {
             "station_id": i+1,
-            "lat": float(candidates[idx][0]),
-            "lon": float(candidates[idx][1])
+            "lat": round(float(candidates[idx][0]), 6),
+            "lon": round(float(candidates[idx][1]), 6)
         }
         for i, idx in enumerate(selected_stations)
     ]
 
     coverage_pct = 1 - (uncovered_weight / weights.sum()) if weights.sum() > 0 else 0
 
+    # Smallest station count reaching each target (None if never reached)
+    targets = sorted({float(t) for t in str(CURVE_TARGETS or "").split(",") if t.strip() and t.strip() != "NULL"}
+                     | {float(COVERAGE_TARGET)})
+    stations_for_targets = {}
+    for target in targets:
+        hits = [i for i, c in enumerate(curve_coverage) if c >= target]
+        stations_for_targets[str(target)] = hits[0] + 1 if hits else None
+
     center_lat = np.mean(candidates[selected_stations, 0]) if selected_stations else np.mean(candidates[:, 0])
     center_lon = np.mean(candidates[selected_stations, 1]) if selected_stations else np.mean(candidates[:, 1])
 
@@ -219,9 +344,12 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
     }
 
     result = {
-        "message": f"Selected {len(selected_stations)} stations covering {coverage_pct*100:.2f}% of points",
+        "message": (f"Partial result at the {MAX_RUNTIME_SECONDS:g}s time limit: " if stopped_at_deadline else "")
+                   + f"Selected {len(selected_stations)} stations covering {coverage_pct*100:.2f}% of points",
+        "partial": stopped_at_deadline,
         "stations": stations_info,
         "coverage_percentage": coverage_pct,
+        "coverage_curve": {"stations_for_targets": stations_for_targets},
         "map_meta": map_meta,
         "parameters": {
             "service_radius_km": SERVICE_RADIUS,
@@ -229,24 +357,68 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
             "coverage_target": COVERAGE_TARGET,
             "max_stations": MAX_STATIONS,
             "h3_resolution": H3_RESOLUTION,
-            "use_traffic_weighting": USE_TRAFFIC_WEIGHTING
+            "use_traffic_weighting": USE_TRAFFIC_WEIGHTING,
+            "strategy": strategy,
+            "max_runtime_seconds": MAX_RUNTIME_SECONDS if deadline is not None else None
+        },
+        "optimization_stats": {
+            "data_points_processed": len(gps_points),
+            "stations_selected": len(selected_stations),
+            "strategy": strategy,
+            "gain_evaluations": gain_evaluations,
+            "gain_reevaluations": gain_reevaluations,
+            "heap_pops": heap_pops,
+            "candidates_pruned": candidates_pruned,
+            "partial": stopped_at_deadline,
+            "resumed_stations": resumed_stations,
+            "checkpoint": checkpoint_path if stopped_at_deadline else None,
+            "import_seconds": import_stats(IMPORT_SECONDS)
         }
     }
 
-    # Step 7: Save full result JSON to stage file
-    try:
-        json_str = json.dumps(result, indent=2)
-        json_file = BytesIO(json_str.encode("utf-8"))
+    timer.mark("result")
 
-        timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
-        filename = f"coverage_opt_stations_{timestamp}.json"
+    # Step 7: Stations, the nearest station of each cell and the coverage
+    # curve go to the stage as Parquet; the result, serialized once, is a
+    # manifest pointing at them
+    nearest, distance_km = assign_cells(gps_xyz, candidates_xyz[selected_stations], SERVICE_RADIUS)
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    stage_prefix = f"{STAGE_NAME}/coverage_opt_stations_{timestamp}"
+    try:
+        result["artifacts"] = save_artifacts(session, stage_prefix, {
+            "stations": pd.DataFrame({
+                "station_id": np.arange(1, len(selected_stations) + 1, dtype=np.int32),
+                "lat": candidates[selected_stations, 0],
+                "lon": candidates[selected_stations, 1],
+            }),
+            "cells": pd.DataFrame({
+                "cell_lat": gps_points[:, 0],
+                "cell_lon": gps_points[:, 1],
+                "point_count": point_counts,
+                "weight": weights.astype(np.float32),
+                "station_id": nearest + 1,
+                "distance_km": distance_km,
+            }),
+            "curve": pd.DataFrame({
+                "stations": np.arange(1, len(curve_coverage) + 1, dtype=np.int32),
+                "coverage": curve_coverage,
+                "marginal_gain": curve_gain,
+            }),
+        })
+    except Exception as e:
+        print(f"[WARN] Could not save artifacts to stage: {str(e)}")
+    # Encoding and uploading this manifest itself is the only untimed work
+    timer.mark("serialization", cells=len(gps_points))
+    result["optimization_stats"]["phases"] = timer.summary()
 
-        session.file.put_stream(json_file, f"{STAGE_NAME}/{filename}", overwrite=True)
-        print(f"[INFO] Result saved to stage://{STAGE_NAME}/{filename}")
+    result_json = json.dumps(result, separators=('','', '':''))
+    try:
+        session.file.put_stream(BytesIO(result_json.encode("utf-8")), f"{stage_prefix}/result.json", overwrite=True)
+        print(f"[INFO] Result saved to stage://{stage_prefix}")
     except Exception as e:
         print(f"[WARN] Could not save to stage: {str(e)}")
 
     print(f"[INFO] Optimization complete. Selected {len(selected_stations)} stations with {coverage_pct*100:.2f}% coverage")
 
-    return json.dumps(result)
+    return result_json
 ';
\ No newline at end of file
@@ -1,174 +1,1032 @@
-CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED_V2("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "H3_RESOLUTION" NUMBER(38,0) DEFAULT 7, "MAX_DATA_POINTS" NUMBER(38,0) DEFAULT 50000, "EARLY_TERMINATION_THRESHOLD" FLOAT DEFAULT 0.001)
+CREATE OR REPLACE PROCEDURE REPORT_DB.GPS_DASHBOARD.COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED_V2("SERVICE_RADIUS" FLOAT, "MIN_SEPARATION" FLOAT, "COVERAGE_TARGET" FLOAT, "MAX_STATIONS" NUMBER(38,0), "ZOOM_LEVEL" NUMBER(38,0), "STAGE_NAME" VARCHAR, "START_TIME" TIMESTAMP_NTZ(9), "END_TIME" TIMESTAMP_NTZ(9), "AREA" VARCHAR, "PROVINCE" VARCHAR, "DISTRICT" VARCHAR, "USE_TRAFFIC_WEIGHTING" BOOLEAN DEFAULT TRUE, "H3_RESOLUTION" NUMBER(38,0) DEFAULT 7, "MAX_DATA_POINTS" NUMBER(38,0) DEFAULT 50000, "EARLY_TERMINATION_THRESHOLD" FLOAT DEFAULT 0.001, "STRATEGY" VARCHAR DEFAULT 'celf', "EPSILON" FLOAT DEFAULT 0.1, "USE_COVERAGE_CACHE" BOOLEAN DEFAULT TRUE, "CACHE_TTL_HOURS" FLOAT DEFAULT 24, "CACHE_MAX_MB" FLOAT DEFAULT 512, "CURVE_TARGETS" VARCHAR DEFAULT '0.5,0.75,0.9,0.95', "SERVICE_RADII" VARCHAR DEFAULT NULL, "PARTITION_MODE" VARCHAR DEFAULT 'none', "PARTITION_COUNT" NUMBER(38,0) DEFAULT 0, "SAMPLING_GRID" NUMBER(38,0) DEFAULT 20, "REDUCTION" VARCHAR DEFAULT 'sample', "REFINE_SECONDS" FLOAT DEFAULT 0, "COST_TABLE" VARCHAR DEFAULT NULL, "COST_COLUMN" VARCHAR DEFAULT NULL, "BUDGET" FLOAT DEFAULT 0, "EXISTING_STATIONS" VARCHAR DEFAULT NULL, "MAX_RUNTIME_SECONDS" FLOAT DEFAULT 0, "CHECKPOINT_SECONDS" FLOAT DEFAULT 30, "MAX_CORESET_TOLERANCE_KM" FLOAT DEFAULT NULL)
 RETURNS VARCHAR
 LANGUAGE PYTHON
 RUNTIME_VERSION = '3.10'
-PACKAGES = ('pandas','numpy','scikit-learn','snowflake-snowpark-python','scipy')
+PACKAGES = ('pandas','numpy','snowflake-snowpark-python','scipy','pyarrow','numba')
+IMPORTS = ('@REPORT_DB.GPS_DASHBOARD.PROC_CODE/coverage_engine.py')
 HANDLER = 'main'
 EXECUTE AS OWNER
 AS '
+import time
+IMPORT_STARTED = time.perf_counter()
 import pandas as pd
 import numpy as np
 import json
 import datetime
-import time
+import os
+import re
+import functools
+import hashlib
+import zipfile
 from io import BytesIO
 from scipy.spatial import cKDTree
-import heapq
-from collections import defaultdict
+from scipy.sparse import csr_matrix
+from itertools import chain
+from coverage_engine import (EARTH_RADIUS_KM, PARTITION_CONTEXT, PhaseTimer, SeparationGrid, assign_cells,
+                             chord_length, efficient_coverage_precomputation, grid_partitions,
+                             haversine_distance, import_stats, jit_kernel, latlon_to_unit_xyz, partition_halo,
+                             save_artifacts, solve_partitions, stream_cells)
+# Module-level import time, reported with the lazily imported modules
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
 
-def haversine_distance_vectorized(lat1, lon1, lat2, lon2):
-    """Vectorized haversine distance calculation for better performance"""
-    R = 6371.0
-    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    return R * c
+RANDOM_SEED = 42
+COVERAGE_CACHE_DIR = "coverage_cache"
+COVERAGE_CACHE_VERSION = 1
+CHECKPOINT_DIR = "checkpoints"
+CHECKPOINT_TTL_HOURS = 24
+STRATEGIES = ("celf", "threshold", "stochastic")
+PARTITION_MODES = ("none", "grid", "province", "district")
+REDUCTIONS = ("sample", "coreset")
+CORESET_FETCH_LIMIT = 1_000_000
+# Average H3 hexagon edge length in km per resolution; a site serves the
+# candidates within one edge of it
+H3_EDGE_KM = (1281.256, 483.057, 182.513, 68.979, 26.072, 9.854, 3.725, 1.406,
+              0.531, 0.201, 0.076, 0.029, 0.011, 0.004, 0.0015, 0.0006)
+# Free sites are ranked as if they cost this much, best gain first
+COST_FLOOR = 1e-9
+# Separation cell keys pack (row, column + offset) into one int64
+GRID_KEY_STRIDE = 1 << 32
+GRID_COLUMN_OFFSET = 1 << 31
+# greedy_kernel return codes, and how much work it does between clock
+# checks when a deadline or checkpoint is set
+KERNEL_PAUSED, KERNEL_EXHAUSTED, KERNEL_TARGET, KERNEL_EARLY_STOP = 0, 1, 2, 3
+KERNEL_STATIONS_PER_CALL = 16
+KERNEL_POPS_PER_CALL = 200_000
 
-def adaptive_sampling(df, max_points, density_aware=True):
+def build_where_clause(start_time, end_time, area, province, district):
+    """SQL filter for the time window and AREA/PROVINCE/DISTRICT lists"""
+    where_clauses = []
+    
+    if start_time and end_time:
+        where_clauses.append(f"MEAN_TIMESTAMP BETWEEN ''{start_time}'' AND ''{end_time}''")
+    
+    # Location filters
+    if area and area != "NULL" and area != "CAST(NULL AS VARCHAR)":
+        area_clean = area.strip("''").replace("'', ''", "'',''")
+        where_clauses.append(f"AREA IN (''{area_clean}'')")
+    
+    if province and province != "NULL" and province != "CAST(NULL AS VARCHAR)":
+        province_clean = province.strip("''").replace("'', ''", "'',''") 
+        where_clauses.append(f"PROVINCE IN (''{province_clean}'')")
+    
+    if district and district != "NULL" and district != "CAST(NULL AS VARCHAR)":
+        district_clean = district.strip("''").replace("'', ''", "'',''")
+        where_clauses.append(f"DISTRICT IN (''{district_clean}'')")
+    
+    return " AND ".join(where_clauses) if where_clauses else "1=1"
+
+def fetch_aggregated_cells(session, where_clause, h3_resolution, max_data_points,
+                           partition_column=None, row_limit=None, timer=None):
+    """
+    H3-aggregated cells, densest first, streamed by stream_cells into
+    (points, point_counts, points_xyz, labels).  With partition_column
+    (PROVINCE or DISTRICT) labels holds each cell''s PARTITION_KEY.
+    row_limit overrides the default cap of min(2 * max_data_points, 100000)
+    densest cells.  timer is passed to stream_cells.
+    """
+    row_limit = row_limit or min(max_data_points * 2, 100000)
+    label_source = f", {partition_column}" if partition_column else ""
+    label_agg = f", MAX({partition_column}) as PARTITION_KEY" if partition_column else ""
+    label = ", PARTITION_KEY" if partition_column else ""
+    label_row = f", {partition_column} as PARTITION_KEY" if partition_column else ""
+    try:
+        # Optimized H3 aggregation query
+        h3_query = f"""
+        WITH filtered_data AS (
+            SELECT MEAN_LAT, MEAN_LONG{label_source}
+            FROM REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED
+            WHERE {where_clause}
+        ),
+        h3_aggregated AS (
+            SELECT 
+                H3_LATLNG_TO_CELL(MEAN_LAT, MEAN_LONG, {h3_resolution}) as H3_CELL,
+                AVG(MEAN_LAT) as CELL_LAT,
+                AVG(MEAN_LONG) as CELL_LON,
+                COUNT(*) as POINT_COUNT{label_agg}
+            FROM filtered_data
+            GROUP BY H3_CELL
+        )
+        SELECT CELL_LAT, CELL_LON, POINT_COUNT{label}
+        FROM h3_aggregated
+        ORDER BY POINT_COUNT DESC
+        LIMIT {row_limit}
+        """
+        
+        print("[INFO] Executing optimized H3 aggregation query")
+        return stream_cells(session.sql(h3_query), row_limit,
+                            "PARTITION_KEY" if partition_column else None, timer)
+        
+    except Exception as e:
+        print(f"[ERROR] H3 query failed: {str(e)}, using fallback")
+        # Fallback to simple sampling
+        simple_query = f"""
+        SELECT MEAN_LAT as CELL_LAT, MEAN_LONG as CELL_LON, 1 as POINT_COUNT{label_row}
+        FROM REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED
+        WHERE {where_clause}
+        ORDER BY RANDOM()
+        LIMIT {max_data_points}
+        """
+        return stream_cells(session.sql(simple_query), max_data_points,
+                            "PARTITION_KEY" if partition_column else None, timer)
+
+def sql_identifier(name, parameter):
+    """name if it is a plain (optionally qualified) SQL identifier"""
+    if not re.fullmatch("[A-Za-z_][A-Za-z0-9_$]*([.][A-Za-z_][A-Za-z0-9_$]*){0,2}", str(name)):
+        raise ValueError(f"{parameter} must be a table or column name, got {name}")
+    return name
+
+def fetch_site_costs(session, cost_table, cost_column, where_clause, h3_resolution):
+    """
+    Cheapest site of every H3 cell as (site_points, site_costs): the
+    coordinates and cost of one row, so a cost is never paired with a
+    location where it does not apply.
+
+    With cost_table the sites are its LAT/LON rows; without it cost_column
+    is read from the GPS table itself under the run''s filters.  Rows with
+    a NULL cost are not sites; ties go to the lowest LAT, then LON.
+    """
+    if cost_table:
+        source, lat, lon, where = cost_table, "LAT", "LON", "1=1"
+    else:
+        source, lat, lon = "REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED", "MEAN_LAT", "MEAN_LONG"
+        where = where_clause
+    cost_query = f"""
+    SELECT {lat} as SITE_LAT, {lon} as SITE_LON, {cost_column} as SITE_COST
+    FROM {source}
+    WHERE {where} AND {cost_column} IS NOT NULL
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY H3_LATLNG_TO_CELL({lat}, {lon}, {h3_resolution})
+        ORDER BY {cost_column}, {lat}, {lon}
+    ) = 1
+    """
+    sites = session.sql(cost_query).to_pandas()
+    site_costs = sites["SITE_COST"].to_numpy(dtype=np.float64)
+    if np.any(site_costs < 0):
+        raise ValueError(f"{cost_column} must not be negative")
+    return sites[["SITE_LAT", "SITE_LON"]].to_numpy(dtype=np.float64), site_costs
+
+def candidate_costs(candidate_tree, site_points, site_costs, match_km):
+    """
+    Cost of each candidate of candidate_tree (a cKDTree over unit vectors):
+    the cheapest site within match_km, inf where there is none
+    """
+    costs = np.full(candidate_tree.n, np.inf)
+    if len(site_costs) == 0:
+        return costs
+    matches = candidate_tree.query_ball_point(latlon_to_unit_xyz(site_points), chord_length(match_km))
+    lengths = np.fromiter((len(m) for m in matches), dtype=np.int64, count=len(matches))
+    if lengths.sum():
+        np.minimum.at(costs, np.fromiter(chain.from_iterable(matches), dtype=np.int64),
+                      np.repeat(site_costs, lengths))
+    return costs
+
+def load_existing_stations(session, source):
+    """
+    Lat/lon of operating stations from a table with LAT and LON columns or
+    a stage file (@stage/path): JSON shaped like /api/stations (a list of
+    {lat, lon, name}) or CSV with LAT and LON columns, optionally gzipped.
+    """
+    if str(source).startswith("@"):
+        compressed = source.lower().endswith(".gz")
+        stream = session.file.get_stream(source, decompress=compressed)
+        if source.lower().removesuffix(".gz").endswith(".json"):
+            frame = pd.DataFrame(json.load(stream))
+        else:
+            frame = pd.read_csv(stream)
+    else:
+        table = sql_identifier(source, "EXISTING_STATIONS")
+        frame = session.sql(f"SELECT LAT, LON FROM {table}").to_pandas()
+    frame.columns = [str(column).upper() for column in frame.columns]
+    if not {"LAT", "LON"} <= set(frame.columns):
+        raise ValueError(f"EXISTING_STATIONS {source} needs LAT and LON columns")
+    return frame[["LAT", "LON"]].dropna().to_numpy(dtype=np.float64)
+
+def coverage_cache_key(*parts):
+    """Stable hash of everything that determines points, weights and coverage"""
+    payload = json.dumps([COVERAGE_CACHE_VERSION] + [str(p) for p in parts])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+def coverage_cache_entries(session, stage_name):
+    """Cached artifacts on the stage as a DataFrame of file, size, last_modified"""
+    listing = session.sql(f"LIST {stage_name}/{COVERAGE_CACHE_DIR}/").to_pandas()
+    listing.columns = [c.lower() for c in listing.columns]
+    return pd.DataFrame({
+        "file": listing["name"].str.rsplit("/", n=1).str[-1],
+        "size": listing["size"].astype(np.int64),
+        "last_modified": pd.to_datetime(listing["last_modified"], utc=True),
+    })
+
+def evict_coverage_cache(session, stage_name, entries, ttl_hours, max_mb):
+    """Drop entries older than ttl_hours, then the oldest until under max_mb"""
+    if entries.empty:
+        return entries
+    now = pd.Timestamp.now(tz="UTC")
+    entries = entries.sort_values("last_modified", ascending=False)
+    expired = entries["last_modified"] < now - pd.Timedelta(hours=ttl_hours)
+    over_size = entries["size"].where(~expired, 0).cumsum() > max_mb * 1024 * 1024
+    for file_name in entries.loc[expired | over_size, "file"]:
+        session.sql(f"REMOVE {stage_name}/{COVERAGE_CACHE_DIR}/{file_name}").collect()
+        print(f"[INFO] Evicted coverage cache entry {file_name}")
+    return entries[~(expired | over_size)]
+
+def load_coverage_cache(session, stage_name, key, ttl_hours, max_mb):
+    """
+    Return (gps_points, point_counts, (indptr, indices), extras) or None on
+    a miss; extras holds any further arrays saved with the entry.
+    """
+    try:
+        entries = coverage_cache_entries(session, stage_name)
+        entries = evict_coverage_cache(session, stage_name, entries, ttl_hours, max_mb)
+        if f"{key}.npz" not in set(entries["file"]):
+            return None
+        stream = session.file.get_stream(f"{stage_name}/{COVERAGE_CACHE_DIR}/{key}.npz")
+        with np.load(stream) as artifact:
+            core = ("points", "point_counts", "indptr", "indices")
+            extras = {name: artifact[name] for name in artifact.files if name not in core}
+            return (artifact["points"], artifact["point_counts"],
+                    (artifact["indptr"], artifact["indices"]), extras)
+    except Exception as e:
+        print(f"[WARN] Coverage cache unavailable: {str(e)}")
+        return None
+
+def save_coverage_cache(session, stage_name, key, gps_points, point_counts, coverage, extras=None):
+    try:
+        # An .npz written with fast deflate: neighbor ids barely compress, so
+        # numpy''s default level costs seconds for a few percent of size
+        buffer = BytesIO()
+        arrays = {"points": gps_points, "point_counts": point_counts,
+                  "indptr": coverage[0], "indices": coverage[1], **(extras or {})}
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            for name, array in arrays.items():
+                with archive.open(f"{name}.npy", "w", force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.ascontiguousarray(array))
+        buffer.seek(0)
+        session.file.put_stream(buffer, f"{stage_name}/{COVERAGE_CACHE_DIR}/{key}.npz",
+                                auto_compress=False, overwrite=True)
+        print(f"[INFO] Saved coverage cache entry {key} ({buffer.getbuffer().nbytes / 1e6:.1f} MB)")
+    except Exception as e:
+        print(f"[WARN] Could not save coverage cache: {str(e)}")
+
+class SelectionCheckpoint:
+    """
+    Selection progress of a run under MAX_RUNTIME_SECONDS, kept on the stage
+    as checkpoints/<key>.json so a call cut off by the time limit can be
+    resumed by the next call with the same inputs.
+
+    Per service radius it records the phase reached (greedy, refinement or
+    done), the greedy stations in selection order and the current stations.
+    Stations are stored as coordinates and matched back to candidates on
+    load, and record() writes to the stage at most every interval seconds.
+    """
+
+    def __init__(self, session, stage_name, key, interval, candidates, candidate_tree):
+        self.session = session
+        self.path = f"{stage_name}/{CHECKPOINT_DIR}/{key}.json"
+        self.interval = interval
+        self.candidates = candidates
+        self.candidate_tree = candidate_tree
+        self.loaded = {}
+        self.progress = {}
+        self.saved_at = time.time()
+        self.saves = 0
+
+    def load(self):
+        """Read the checkpoint of an earlier call; True when there is a fresh one"""
+        try:
+            state = json.load(self.session.file.get_stream(self.path))
+        except Exception:
+            return False
+        if time.time() - state["saved_at"] > CHECKPOINT_TTL_HOURS * 3600:
+            return False
+        self.loaded = state["radii"]
+        return bool(self.loaded)
+
+    def phase(self, radius):
+        return self.loaded.get(str(radius), {}).get("phase")
+
+    def stations(self, radius, field):
+        """Candidate ids of the loaded greedy or current stations of a radius"""
+        coordinates = self.loaded.get(str(radius), {}).get(field) or []
+        if not coordinates:
+            return []
+        distances, ids = self.candidate_tree.query(latlon_to_unit_xyz(np.asarray(coordinates)))
+        return ids[distances < 1e-9].tolist()
+
+    def record(self, radius, phase, greedy, stations=None):
+        self.progress[str(radius)] = {"phase": phase, "greedy": list(greedy),
+                                      "stations": list(greedy if stations is None else stations)}
+        if time.time() - self.saved_at >= self.interval:
+            self.save()
+
+    def save(self):
+        radii = dict(self.loaded)
+        for radius, state in self.progress.items():
+            radii[radius] = {"phase": state["phase"],
+                             "greedy": self.candidates[state["greedy"]].tolist(),
+                             "stations": self.candidates[state["stations"]].tolist()}
+        try:
+            payload = json.dumps({"saved_at": time.time(), "radii": radii})
+            self.session.file.put_stream(BytesIO(payload.encode("utf-8")), self.path,
+                                         auto_compress=False, overwrite=True)
+            self.saves += 1
+        except Exception as e:
+            print(f"[WARN] Could not save checkpoint: {str(e)}")
+        self.saved_at = time.time()
+
+    def clear(self):
+        try:
+            self.session.sql(f"REMOVE {self.path}").collect()
+        except Exception as e:
+            print(f"[WARN] Could not remove checkpoint: {str(e)}")
+
+def adaptive_sampling(df, max_points, density_aware=True, grid_size=20, seed=RANDOM_SEED):
     """
     Adaptive sampling strategy that preserves high-density areas
     while reducing computational load
+
+    Cells are stratified on a grid_size x grid_size lat/lon grid and every
+    stratum gets max(1, max_points * its share of POINT_COUNT) rows, drawn
+    without replacement with probability proportional to POINT_COUNT.  The
+    draw uses Efraimidis-Spirakis keys (Exp(1) / weight, smallest first), so
+    all strata are sampled by one sort instead of a pass per stratum.  df is
+    not modified; sampled rows keep their original order.
     """
     if len(df) <= max_points:
         return df
     
     print(f"[INFO] Applying adaptive sampling: {len(df)} -> {max_points}")
     
+    rng = np.random.default_rng(seed)
+    counts = df["POINT_COUNT"].to_numpy(dtype=np.float64)
+    keys = rng.exponential(size=len(df)) / counts
+    
     if density_aware:
-        # Use stratified sampling based on spatial density
-        # Create a coarse grid for density estimation
-        lat_bins = np.linspace(df[''CELL_LAT''].min(), df[''CELL_LAT''].max(), 20)
-        lon_bins = np.linspace(df[''CELL_LON''].min(), df[''CELL_LON''].max(), 20)
-        
-        df[''lat_bin''] = np.digitize(df[''CELL_LAT''], lat_bins)
-        df[''lon_bin''] = np.digitize(df[''CELL_LON''], lon_bins)
-        df[''grid_cell''] = df[''lat_bin''] * 100 + df[''lon_bin'']
+        lat = df["CELL_LAT"].to_numpy()
+        lon = df["CELL_LON"].to_numpy()
+        lat_bin = np.digitize(lat, np.linspace(lat.min(), lat.max(), grid_size))
+        lon_bin = np.digitize(lon, np.linspace(lon.min(), lon.max(), grid_size))
+        _, stratum = np.unique(lat_bin * (grid_size + 1) + lon_bin, return_inverse=True)
         
         # Sample proportionally from each grid cell based on density
-        sampled_dfs = []
-        total_weight = df[''POINT_COUNT''].sum()
-        
-        for cell in df[''grid_cell''].unique():
-            cell_df = df[df[''grid_cell''] == cell]
-            cell_weight = cell_df[''POINT_COUNT''].sum()
-            cell_proportion = cell_weight / total_weight
-            cell_sample_size = max(1, int(max_points * cell_proportion))
-            
-            if len(cell_df) <= cell_sample_size:
-                sampled_dfs.append(cell_df)
-            else:
-                # Weight-based sampling within cell
-                weights = cell_df[''POINT_COUNT''] / cell_df[''POINT_COUNT''].sum()
-                sampled_indices = np.random.choice(
-                    cell_df.index, 
-                    size=cell_sample_size, 
-                    replace=False, 
-                    p=weights
-                )
-                sampled_dfs.append(cell_df.loc[sampled_indices])
-        
-        result_df = pd.concat(sampled_dfs, ignore_index=True)
-        return result_df.drop([''lat_bin'', ''lon_bin'', ''grid_cell''], axis=1)
+        stratum_weight = np.bincount(stratum, weights=counts)
+        quota = np.maximum(1, (max_points * stratum_weight / counts.sum()).astype(np.int64))
+        order = np.lexsort((keys, stratum))
+        stratum_sorted = stratum[order]
+        stratum_start = np.concatenate(([0], np.cumsum(np.bincount(stratum))[:-1]))
+        rank = np.arange(len(order)) - stratum_start[stratum_sorted]
+        chosen = order[rank < quota[stratum_sorted]]
     else:
         # Simple weighted random sampling
-        weights = df[''POINT_COUNT''] / df[''POINT_COUNT''].sum()
-        sampled_indices = np.random.choice(
-            df.index, 
-            size=max_points, 
-            replace=False, 
-            p=weights
-        )
-        return df.loc[sampled_indices].reset_index(drop=True)
+        chosen = np.argpartition(keys, max_points)[:max_points]
+    
+    return df.iloc[np.sort(chosen)].reset_index(drop=True)
 
-def efficient_coverage_precomputation(candidates_rad, tree, service_radius_rad, batch_size=1000):
+def build_coreset(points, point_counts, max_points, max_tolerance_km=None, iterations=30):
     """
-    Batch-process coverage computation to manage memory efficiently
+    Merge nearby cells into at most max_points weighted representatives.
+
+    Cells are snapped to a square kilometre grid whose size is found by
+    bisection, and each occupied grid cell becomes one representative at
+    the centre of its members'' bounding box, which keeps the largest
+    member displacement (the tolerance) at most half a grid diagonal.  The
+    grid is never coarser than a half diagonal of max_tolerance_km, so when
+    that bound binds there are more than max_points representatives.
+
+    Returns (groups, rep_points, rep_counts, multiplicity, tolerance_km):
+    groups maps each input cell to its representative, rep_counts sums the
+    members'' POINT_COUNT, multiplicity counts the members, and tolerance_km
+    is the largest member-to-representative distance.  A move of at most
+    tolerance_km can only carry a point across a service circle it lies
+    within tolerance_km of, so for any station set the coreset coverage at
+    radius R lies between the full-data coverage at R - tolerance_km and
+    R + tolerance_km, as long as representatives weigh the sum of their
+    members (see main, Step 3).
     """
-    print(f"[INFO] Computing coverage for {len(candidates_rad)} candidates in batches of {batch_size}")
-    coverage_sets = []
+    lat = points[:, 0].astype(np.float64)
+    lon = points[:, 1].astype(np.float64)
+    # Local equirectangular km; scaling longitude at the latitude closest to
+    # the equator keeps every grid cell at most size km wide
+    y = (lat - lat.min()) * 111.32
+    x = (lon - lon.min()) * 111.32 * np.cos(np.radians(np.abs(lat).min()))
+    
+    def snap(size):
+        row = np.floor(y / size).astype(np.int64)
+        col = np.floor(x / size).astype(np.int64)
+        return np.unique(row * (col.max() + 1) + col, return_inverse=True)[1]
+    
+    low, high = 0.0, max(y.max(), x.max()) + 1.0
+    if max_tolerance_km is not None:
+        high = min(high, max_tolerance_km * np.sqrt(2))
+    if snap(high).max() + 1 <= max_points:
+        for _ in range(iterations):
+            size = (low + high) / 2
+            if snap(size).max() + 1 <= max_points:
+                high = size
+            else:
+                low = size
+    groups = snap(high)
     
-    for i in range(0, len(candidates_rad), batch_size):
-        batch_end = min(i + batch_size, len(candidates_rad))
-        batch_candidates = candidates_rad[i:batch_end]
+    n_groups = groups.max() + 1
+    rep_points = np.empty((n_groups, 2))
+    for axis, values in enumerate((lat, lon)):
+        low_edge = np.full(n_groups, np.inf)
+        high_edge = np.full(n_groups, -np.inf)
+        np.minimum.at(low_edge, groups, values)
+        np.maximum.at(high_edge, groups, values)
+        rep_points[:, axis] = (low_edge + high_edge) / 2
+    rep_counts = np.bincount(groups, weights=point_counts).astype(np.int64)
+    multiplicity = np.bincount(groups)
+    tolerance_km = float(haversine_distance(
+        lat, lon, rep_points[groups, 0], rep_points[groups, 1]).max())
+    return groups, rep_points, rep_counts, multiplicity, tolerance_km
+
+def covered_by(stations_xyz, tree, radius_km, strict=False):
+    """
+    Mask of the points of tree within radius_km of any station (strictly
+    closer than radius_km if strict)
+    """
+    covered = np.zeros(tree.n, dtype=bool)
+    if len(stations_xyz) and radius_km > 0:
+        radius_chord = chord_length(radius_km)
+        if strict:
+            radius_chord = np.nextafter(radius_chord, 0)
+        hits = tree.query_ball_point(stations_xyz, radius_chord, return_sorted=False)
+        covered[np.fromiter(chain.from_iterable(hits), dtype=np.int64)] = True
+    return covered
+
+def weighted_coverage(stations_xyz, tree, weights, radius_km):
+    """Share of weights within radius_km of any station, by exact tree queries"""
+    return float(weights[covered_by(stations_xyz, tree, radius_km)].sum() / weights.sum())
+
+def coverage_radius_bands(coverage, candidates_xyz, points_xyz, radius_chords,
+                          max_chunk_entries=1_000_000):
+    """
+    Smallest sweep radius reaching each entry of a CSR coverage structure.
+
+    coverage must have been computed at the largest of radius_chords
+    (ascending chord lengths).  Returns an int8 array aligned with the
+    coverage indices: bands[k] = j means point indices[k] lies within
+    radius_chords[j] of its candidate, so the coverage at radius j is the
+    entries with bands <= j (see truncate_coverage).  Distances are
+    recomputed per coordinate in chunks of about max_chunk_entries entries,
+    which is much cheaper than another spatial query per radius.
+    """
+    indptr, indices = coverage
+    n_candidates = len(indptr) - 1
+    squared_chords = np.asarray(radius_chords, dtype=np.float64) ** 2
+    bands = np.empty(len(indices), dtype=np.int8)
+    axes = [np.ascontiguousarray(candidates_xyz[:, k]) for k in range(3)]
+    point_axes = [np.ascontiguousarray(points_xyz[:, k]) for k in range(3)]
+    targets = np.arange(max_chunk_entries, len(indices), max_chunk_entries)
+    bounds = np.unique(np.concatenate((
+        [0], np.searchsorted(indptr, targets, side="right") - 1, [n_candidates]
+    )))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        lo, hi = indptr[start], indptr[end]
+        if lo == hi:
+            continue
+        counts = np.diff(indptr[start:end + 1])
+        chunk = indices[lo:hi]
+        squared = np.zeros(hi - lo)
+        for axis, point_axis in zip(axes, point_axes):
+            delta = point_axis[chunk] - np.repeat(axis[start:end], counts)
+            squared += delta * delta
+        bands[lo:hi] = np.searchsorted(squared_chords, squared, side="left")
+    return bands
+
+def truncate_coverage(coverage, bands, band):
+    """
+    CSR coverage at sweep radius number band, derived by truncating the
+    coverage of the largest radius; no spatial query is needed.
+    """
+    indptr, indices = coverage
+    keep = bands <= band
+    kept_before = np.concatenate(([0], np.cumsum(keep)))
+    return kept_before[indptr].astype(np.int32), indices[keep]
+
+def parse_service_radii(radii):
+    """Comma-separated service radii in km, e.g. 1,1.5,2,3,5"""
+    if not radii or radii == "NULL":
+        return []
+    values = sorted({float(r) for r in str(radii).split(",") if r.strip()})
+    if values and values[0] <= 0:
+        raise ValueError(f"SERVICE_RADII must be positive, got {radii}")
+    return values
+
+def coverage_matrix(coverage, n_points):
+    """Candidate x point incidence matrix of a CSR coverage structure"""
+    indptr, indices = coverage
+    data = np.ones(len(indices), dtype=np.float64)
+    return csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, n_points))
+
+def marginal_gain(coverage, candidate_idx, weights, covered):
+    """Weight of the points a candidate covers that are not covered yet"""
+    indptr, indices = coverage
+    row = indices[indptr[candidate_idx]:indptr[candidate_idx + 1]]
+    return weights[row[~covered[row]]].sum()
+
+def batch_marginal_gains(coverage, candidate_ids, weights, covered):
+    """Marginal gains of many candidates at once, without a Python loop"""
+    indptr, indices = coverage
+    starts = indptr[candidate_ids].astype(np.int64)
+    lengths = indptr[candidate_ids + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(len(candidate_ids))
+    segment = np.repeat(np.arange(len(candidate_ids)), lengths)
+    positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + starts[segment]
+    rows = indices[positions]
+    values = np.where(covered[rows], 0.0, weights[rows])
+    return np.bincount(segment, weights=values, minlength=len(candidate_ids))
+
+def separation_cells(candidates, min_separation):
+    """
+    Bucket candidates into min_separation cells for the compiled pruning.
+
+    Returns (cell_rows, cell_cols, cell_keys, cell_start, cell_order): the
+    candidates of the cell with key cell_keys[k] are
+    cell_order[cell_start[k]:cell_start[k + 1]].  Cells are sized like
+    SeparationGrid, so every candidate within min_separation of another
+    lies in one of the 3x3 cells around it.
+    """
+    max_abs_lat = np.abs(candidates[:, 0]).max() if len(candidates) else 0.0
+    cell_lat = max(min_separation, 1e-9) / (EARTH_RADIUS_KM * np.pi / 180) * 1.001
+    cell_lon = cell_lat / max(np.cos(np.radians(min(max_abs_lat + 1.0, 89.0))), 1e-6)
+    rows = np.floor(candidates[:, 0] / cell_lat).astype(np.int64)
+    cols = np.floor(candidates[:, 1] / cell_lon).astype(np.int64) + GRID_COLUMN_OFFSET
+    keys = rows * GRID_KEY_STRIDE + cols
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_start = np.unique(keys[order], return_index=True)
+    return rows, cols, cell_keys, np.append(cell_start, len(order)).astype(np.int64), order.astype(np.int64)
+
+@jit_kernel
+def heap_before(key_a, idx_a, stamp_a, key_b, idx_b, stamp_b):
+    # The order heapq gives (-key, idx, stamp) tuples
+    if key_a != key_b:
+        return key_a > key_b
+    if idx_a != idx_b:
+        return idx_a < idx_b
+    return stamp_a < stamp_b
+
+@jit_kernel
+def heap_push(heap_key, heap_idx, heap_stamp, size, key, idx, stamp):
+    pos = size
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if not heap_before(key, idx, stamp, heap_key[parent], heap_idx[parent], heap_stamp[parent]):
+            break
+        heap_key[pos], heap_idx[pos], heap_stamp[pos] = heap_key[parent], heap_idx[parent], heap_stamp[parent]
+        pos = parent
+    heap_key[pos], heap_idx[pos], heap_stamp[pos] = key, idx, stamp
+    return size + 1
+
+@jit_kernel
+def heap_pop(heap_key, heap_idx, heap_stamp, size):
+    # Drops the top entry (read it first) and returns the new size
+    size -= 1
+    key, idx, stamp = heap_key[size], heap_idx[size], heap_stamp[size]
+    pos = 0
+    while 2 * pos + 1 < size:
+        child = 2 * pos + 1
+        if child + 1 < size and heap_before(heap_key[child + 1], heap_idx[child + 1], heap_stamp[child + 1],
+                                            heap_key[child], heap_idx[child], heap_stamp[child]):
+            child += 1
+        if not heap_before(heap_key[child], heap_idx[child], heap_stamp[child], key, idx, stamp):
+            break
+        heap_key[pos], heap_idx[pos], heap_stamp[pos] = heap_key[child], heap_idx[child], heap_stamp[child]
+        pos = child
+    heap_key[pos], heap_idx[pos], heap_stamp[pos] = key, idx, stamp
+    return size
+
+@jit_kernel
+def take_station(candidate, indptr, indices, covered, dead, candidates_xyz,
+                 cell_rows, cell_cols, cell_keys, cell_start, cell_order, min_separation_chord):
+    """
+    Select a candidate: cover its points and mark every live candidate
+    closer than min_separation_chord to it dead.  Returns how many were marked.
+    """
+    dead[candidate] = True
+    for j in range(indptr[candidate], indptr[candidate + 1]):
+        covered[indices[j]] = True
+    pruned = 0
+    if min_separation_chord <= 0:
+        return pruned
+    limit = min_separation_chord * min_separation_chord
+    for dr in range(-1, 2):
+        for dc in range(-1, 2):
+            key = (cell_rows[candidate] + dr) * GRID_KEY_STRIDE + cell_cols[candidate] + dc
+            k = np.searchsorted(cell_keys, key)
+            if k == len(cell_keys) or cell_keys[k] != key:
+                continue
+            for t in range(cell_start[k], cell_start[k + 1]):
+                other = cell_order[t]
+                if dead[other]:
+                    continue
+                dx = candidates_xyz[other, 0] - candidates_xyz[candidate, 0]
+                dy = candidates_xyz[other, 1] - candidates_xyz[candidate, 1]
+                dz = candidates_xyz[other, 2] - candidates_xyz[candidate, 2]
+                if dx * dx + dy * dy + dz * dz < limit:
+                    dead[other] = True
+                    pruned += 1
+    return pruned
+
+@jit_kernel
+def greedy_kernel(indptr, indices, weights, covered, dead, cost_scale, costs, budgeted,
+                  candidates_xyz, cell_rows, cell_cols, cell_keys, cell_start, cell_order,
+                  min_separation_chord, heap_key, heap_idx, heap_stamp, selected, pick_gains,
+                  fstate, istate, lazy, max_stations, coverage_target, early_termination_threshold,
+                  max_new, max_pops):
+    """
+    The selection loop of optimized_greedy_selection, compiled.
+
+    Runs until a stopping rule holds or, returning KERNEL_PAUSED, until
+    max_new more stations are selected or max_pops entries popped, so the
+    caller can check the clock between calls.  fstate holds
+    (uncovered weight, total weight, last improvement, remaining budget)
+    and istate (stations selected, heap size, heap pops, gain evaluations,
+    gain re-evaluations, candidates pruned, budget rejections); both are
+    updated in place.
+    """
+    new = 0
+    pops = 0
+    total_weight = fstate[1]
+    while True:
+        n_selected = istate[0]
+        if n_selected >= max_stations or fstate[0] <= 0 or istate[1] == 0:
+            return KERNEL_EXHAUSTED
+        current_coverage = 1.0 - fstate[0] / total_weight
+        if current_coverage >= coverage_target:
+            return KERNEL_TARGET
+        if (n_selected > 10 and fstate[2] < early_termination_threshold and
+                current_coverage > coverage_target * 0.9):
+            return KERNEL_EARLY_STOP
+        if new >= max_new or pops >= max_pops:
+            return KERNEL_PAUSED
         
-        batch_coverage = []
-        for candidate in batch_candidates:
-            indices = tree.query_ball_point(candidate, service_radius_rad)
-            batch_coverage.append(set(indices))
+        key, candidate, stamp = heap_key[0], heap_idx[0], heap_stamp[0]
+        istate[1] = heap_pop(heap_key, heap_idx, heap_stamp, istate[1])
+        istate[2] += 1
+        pops += 1
+        if dead[candidate]:
+            continue
+        if budgeted and costs[candidate] > fstate[3]:
+            # The budget only shrinks, so this site never fits again
+            dead[candidate] = True
+            istate[6] += 1
+            continue
         
-        coverage_sets.extend(batch_coverage)
+        if lazy and stamp == n_selected:
+            gain = key * cost_scale[candidate]
+        else:
+            gain = 0.0
+            for j in range(indptr[candidate], indptr[candidate + 1]):
+                if not covered[indices[j]]:
+                    gain += weights[indices[j]]
+            istate[3] += 1
+            istate[4] += 1
+            if gain <= 0:
+                continue
+            # A stale entry goes back with its fresh key; the legacy mode
+            # only re-queues when the key dropped by more than 10%
+            fresh_key = gain / cost_scale[candidate]
+            if lazy or fresh_key < key * 0.9:
+                istate[1] = heap_push(heap_key, heap_idx, heap_stamp, istate[1], fresh_key, candidate, n_selected)
+                continue
         
-        if i % (batch_size * 10) == 0:
-            print(f"[INFO] Processed {i}/{len(candidates_rad)} candidates")
-    
-    return coverage_sets
+        # Live candidates are never within min_separation of a selected
+        # station: selecting one marks its neighbors dead
+        istate[5] += take_station(candidate, indptr, indices, covered, dead, candidates_xyz,
+                                  cell_rows, cell_cols, cell_keys, cell_start, cell_order,
+                                  min_separation_chord)
+        selected[n_selected] = candidate
+        pick_gains[n_selected] = gain
+        istate[0] = n_selected + 1
+        if budgeted:
+            fstate[3] -= costs[candidate]
+        previous_weight = fstate[0]
+        fstate[0] -= gain
+        fstate[2] = (previous_weight - fstate[0]) / total_weight
+        new += 1
 
 def optimized_greedy_selection(candidates, weights, candidate_coverage, 
                              service_radius, min_separation, max_stations, 
-                             coverage_target, early_termination_threshold):
+                             coverage_target, early_termination_threshold,
+                             strategy="celf", candidate_tree=None, costs=None, budget=None,
+                             covered=None, blocked=None, timer=None, resume=None,
+                             deadline=None, checkpoint=None):
     """
     Optimized greedy algorithm with early termination and smart pruning
+
+    strategy="celf" is exact lazy greedy: every heap entry remembers how many
+    stations were selected when its gain was computed, and an entry is only
+    trusted when that stamp is current.  Because gains never increase, this
+    picks exactly what the standard greedy would.  strategy="threshold"
+    keeps the old heuristic that accepts gains within 10% of the stale value.
+
+    The loop runs in greedy_kernel, compiled with numba, over the CSR
+    coverage, a covered mask and flat heap arrays of key, candidate and
+    stamp.  Selecting a station marks every candidate closer than min_separation
+    of it dead by scanning the 3x3 separation_cells around it with exact
+    chord distances, so a live candidate always keeps the separation and
+    separation_rejections stays 0.  candidate_tree (a cKDTree over
+    latlon_to_unit_xyz(candidates)) only supplies the unit vectors.
+    
+    costs (per candidate, inf for unavailable sites) excludes the
+    unavailable candidates.  With a budget as well, the heap is keyed by
+    gain / cost instead of gain, candidates that no longer fit the
+    remaining budget are dropped when popped, and the result is compared
+    with the best single affordable site.  The better of the two is within
+    (1 - 1/e) / 2 of the best station set within budget (Khuller, Moss and
+    Naor, 1999); gain / cost only decreases as well, so the lazy stamps
+    stay exact.
+    
+    covered marks points served by existing stations and blocked the
+    candidates too close to them; selection starts from that state.  With
+    a timer, building the heap is marked heap_init.
+    
+    resume replays the stations of an interrupted run in their order, which
+    restores the state its selection stopped in.  With a deadline
+    (time.time() seconds) or a checkpoint, the kernel runs
+    KERNEL_STATIONS_PER_CALL stations at a time; past the deadline
+    selection stops with the stations so far and stopped_at_deadline set,
+    and checkpoint is called with the station list after every call.
     """
     selected_stations = []
-    covered_points = set()
-    uncovered_weight = weights.sum()
+    covered_points = np.zeros(len(weights), dtype=bool) if covered is None else covered.copy()
+    uncovered_weight = weights[~covered_points].sum()
+    initial_uncovered = uncovered_weight
     total_weight = weights.sum()
+    indptr, indices = candidate_coverage
+    lazy = strategy == "celf"
+    stats = {"gain_evaluations": len(candidates), "gain_reevaluations": 0,
+             "heap_pops": 0, "separation_rejections": 0, "candidates_pruned": 0}
+    dead = np.zeros(len(candidates), dtype=bool) if blocked is None else blocked.copy()
+    candidates_xyz = candidate_tree.data if candidate_tree is not None else latlon_to_unit_xyz(candidates)
+    cells = separation_cells(candidates, min_separation)
+    min_separation_chord = chord_length(min_separation) if min_separation > 0 else 0.0
+    budgeted = costs is not None
+    remaining_budget = budget if budget else np.inf
+    cost_scale = np.ones(len(candidates))
+    available = ~dead
+    if budgeted:
+        stats.update({"budget_spent": 0.0, "budget_rejections": 0, "best_single_site": False})
+        available &= np.isfinite(costs) & (costs <= remaining_budget)
+        if budget:
+            cost_scale = np.maximum(costs, COST_FLOOR)
     
-    # Priority queue with candidate gains
-    heap = []
-    for idx, coverage_set in enumerate(candidate_coverage):
-        gain = sum(weights[i] for i in coverage_set)
-        heapq.heappush(heap, (-gain, idx))
+    # Priority queue of (key = gain / cost, candidate, stamp); all initial
+    # gains come from one sparse product and are current at stamp 0.  A
+    # resumed run recomputes them after the replay, so it does not
+    # re-evaluate every stale entry first; only ties of equal gain may
+    # break differently
+    incidence_matrix = coverage_matrix(candidate_coverage, len(weights))
+    initial_gains = incidence_matrix.dot(np.where(covered_points, 0.0, weights))
+    gains = initial_gains
+    last_improvement = np.inf
+    for candidate_idx in resume or ():
+        gain = marginal_gain(candidate_coverage, candidate_idx, weights, covered_points)
+        selected_stations.append(candidate_idx)
+        stats["candidates_pruned"] += take_station(candidate_idx, indptr, indices, covered_points, dead,
+                                                   candidates_xyz, *cells, min_separation_chord)
+        if budgeted:
+            stats["budget_spent"] += float(costs[candidate_idx])
+        uncovered_weight -= gain
+        last_improvement = gain / total_weight
+    if resume:
+        gains = incidence_matrix.dot(np.where(covered_points, 0.0, weights))
+        if budgeted:
+            remaining_budget -= stats["budget_spent"]
+        stats["resumed_stations"] = len(resume)
+        print(f"[INFO] Resumed greedy selection after {len(resume)} stations")
+    del incidence_matrix
+    keys = np.where(available & ~dead, gains / cost_scale, 0.0)
+    # Entries sorted in heap order already form a valid binary heap
+    entries = np.flatnonzero(keys > 0)
+    entries = entries[np.lexsort((entries, -keys[entries]))]
+    heap_size = len(entries)
+    heap_key = np.zeros(max(heap_size, 1))
+    heap_key[:heap_size] = keys[entries]
+    heap_idx = np.zeros(max(heap_size, 1), dtype=np.int64)
+    heap_idx[:heap_size] = entries
+    heap_stamp = np.full(max(heap_size, 1), len(selected_stations), dtype=np.int64)
+    if timer is not None:
+        timer.mark("heap_init", heap_entries=heap_size)
     
-    print(f"[INFO] Starting greedy selection with {len(heap)} candidates")
+    print(f"[INFO] Starting {strategy} greedy selection with {heap_size} candidates")
+    
+    selected = np.zeros(max(max_stations, len(selected_stations), 1), dtype=np.int64)
+    selected[:len(selected_stations)] = selected_stations
+    pick_gains = np.zeros(len(selected))
+    fstate = np.array([uncovered_weight, total_weight, last_improvement, remaining_budget], dtype=np.float64)
+    istate = np.array([len(selected_stations), heap_size, 0, len(candidates), 0, 0, 0], dtype=np.int64)
+    stations_per_call = max_stations
+    pops_per_call = np.iinfo(np.int64).max
+    if deadline is not None or checkpoint is not None:
+        stations_per_call, pops_per_call = KERNEL_STATIONS_PER_CALL, KERNEL_POPS_PER_CALL
+    
+    while True:
+        first_new = int(istate[0])
+        status = greedy_kernel(
+            indptr, indices, weights, covered_points, dead, cost_scale,
+            costs if budgeted else cost_scale, budgeted, candidates_xyz, *cells, min_separation_chord,
+            heap_key, heap_idx, heap_stamp, selected, pick_gains, fstate, istate,
+            lazy, max_stations, coverage_target, early_termination_threshold,
+            stations_per_call, pops_per_call
+        )
+        picked_weight = total_weight - uncovered_weight
+        for n in range(first_new, int(istate[0])):
+            picked_weight += pick_gains[n]
+            if (n + 1) % 10 == 0 or n + 1 <= 10:
+                print(f"[INFO] Station #{n + 1}: coverage {picked_weight / total_weight * 100:.2f}%, "
+                      f"improvement: {pick_gains[n] / total_weight:.4f}")
+        uncovered_weight = fstate[0]
+        if checkpoint is not None and istate[0] > first_new:
+            checkpoint(selected[:istate[0]].tolist())
+        if status != KERNEL_PAUSED:
+            break
+        if deadline is not None and time.time() >= deadline:
+            stats["stopped_at_deadline"] = True
+            print(f"[WARN] Time limit reached after {istate[0]} stations")
+            break
+    if status == KERNEL_TARGET:
+        print(f"[INFO] Coverage target {coverage_target*100:.2f}% reached!")
+    elif status == KERNEL_EARLY_STOP:
+        print(f"[INFO] Early termination: minimal improvement ({fstate[2]:.6f})")
+    
+    kernel_picks = selected[len(selected_stations):istate[0]]
+    selected_stations = selected[:istate[0]].tolist()
+    stats.update({"heap_pops": int(istate[2]), "gain_evaluations": int(istate[3]),
+                  "gain_reevaluations": int(istate[4])})
+    stats["candidates_pruned"] += int(istate[5])
+    if budgeted:
+        stats["budget_rejections"] = int(istate[6])
+        stats["budget_spent"] += float(costs[kernel_picks].sum())
+    
+    if budgeted and budget and np.any(available):
+        # Cost-benefit greedy alone can be arbitrarily bad (a cheap small
+        # site crowding out one expensive site); keep the best single site
+        # when it covers more
+        affordable = np.where(available, initial_gains, -np.inf)
+        best_single = int(np.argmax(affordable))
+        if affordable[best_single] > initial_uncovered - uncovered_weight:
+            selected_stations = [best_single]
+            covered_points = np.zeros(len(weights), dtype=bool) if covered is None else covered.copy()
+            covered_points[indices[indptr[best_single]:indptr[best_single + 1]]] = True
+            uncovered_weight = initial_uncovered - initial_gains[best_single]
+            stats["budget_spent"] = float(costs[best_single])
+            stats["best_single_site"] = True
+            print("[INFO] Best single site beats the cost-benefit greedy")
+    
+    # Whether the kernel came from the on-disk cache or was compiled here
+    stats["kernel_cache_hits"] = int(sum(greedy_kernel.stats.cache_hits.values()))
+    stats["kernel_cache_misses"] = int(sum(greedy_kernel.stats.cache_misses.values()))
+    print(f"[INFO] Greedy used {stats[''gain_evaluations'']} gain evaluations "
+          f"({stats[''gain_reevaluations'']} re-evaluations)")
+    return selected_stations, covered_points, uncovered_weight, stats
+
+def parse_coverage_targets(targets):
+    """Comma-separated coverage fractions, e.g. 0.5,0.75,0.9"""
+    if not targets or targets == "NULL":
+        return []
+    return sorted({float(t) for t in str(targets).split(",") if t.strip()})
+
+def coverage_curve(selected_stations, candidate_coverage, weights, targets=(), covered=None):
+    """
+    Cumulative coverage and marginal gain after each selected station.
+
+    Greedy selection is prefix-monotone: the first n stations of one run are
+    the greedy answer for n stations, so a single run to MAX_STATIONS gives
+    the whole stations-vs-coverage curve.  stations_for_targets maps each
+    target to the smallest prefix reaching it (None if never reached).
+    covered marks points served before the first station.
+    """
+    indptr, indices = candidate_coverage
+    covered = np.zeros(len(weights), dtype=bool) if covered is None else covered.copy()
+    total_weight = weights.sum()
+    coverage, gains = [], []
+    covered_weight = weights[covered].sum()
+    for candidate_idx in selected_stations:
+        gain = marginal_gain(candidate_coverage, candidate_idx, weights, covered)
+        covered[indices[indptr[candidate_idx]:indptr[candidate_idx + 1]]] = True
+        covered_weight += gain
+        gains.append(round(float(gain), 4))
+        coverage.append(round(float(covered_weight / total_weight), 6) if total_weight > 0 else 0.0)
+    
+    reached = np.asarray(coverage)
+    stations_for_targets = {}
+    for target in targets:
+        hits = np.flatnonzero(reached >= target)
+        stations_for_targets[str(target)] = int(hits[0]) + 1 if len(hits) else None
+    return {
+        "stations": list(range(1, len(coverage) + 1)),
+        "coverage": coverage,
+        "marginal_gain": gains,
+        "stations_for_targets": stations_for_targets,
+    }
+
+def stochastic_greedy_selection(candidates, weights, candidate_coverage,
+                                min_separation, max_stations, coverage_target,
+                                early_termination_threshold, epsilon,
+                                candidate_tree=None, seed=RANDOM_SEED, covered=None, blocked=None,
+                                resume=None, deadline=None, checkpoint=None):
+    """
+    Stochastic greedy (Mirzasoleiman et al., 2015) for very large candidate sets.
+
+    Each step evaluates only a random sample of ceil(n / k * ln(1 / epsilon))
+    live candidates and takes the best of them, which gives a
+    (1 - 1/e - epsilon) approximation in expectation with O(n ln(1/epsilon))
+    gain evaluations overall.  Candidates whose sampled gain is zero are
+    dropped for good, since gains never increase.  Separation handling,
+    covered / blocked and resume / deadline / checkpoint match
+    optimized_greedy_selection.
+    """
+    selected_stations = []
+    covered_points = np.zeros(len(weights), dtype=bool) if covered is None else covered.copy()
+    uncovered_weight = weights[~covered_points].sum()
+    total_weight = weights.sum()
+    indptr, indices = candidate_coverage
+    rng = np.random.default_rng(seed)
+    
+    n_candidates = len(candidates)
+    k = max(1, min(max_stations, n_candidates))
+    sample_size = max(1, int(np.ceil(n_candidates / k * np.log(1.0 / epsilon))))
+    stats = {"gain_evaluations": 0, "heap_pops": 0, "separation_rejections": 0,
+             "candidates_pruned": 0, "epsilon": epsilon, "sample_size": sample_size}
+    separation_grid = SeparationGrid(min_separation, np.abs(candidates[:, 0]).max() if n_candidates else 0.0)
+    # Candidates strictly closer than min_separation are dropped, as in too_close
+    min_separation_chord = np.nextafter(chord_length(min_separation), 0)
+    # Candidates that cover nothing can never be picked
+    dead = np.diff(indptr) == 0
+    if blocked is not None:
+        dead |= blocked
+    
+    def take(candidate_idx):
+        lat1, lon1 = candidates[candidate_idx]
+        selected_stations.append(candidate_idx)
+        separation_grid.add(lat1, lon1)
+        dead[candidate_idx] = True
+        if candidate_tree is not None and min_separation > 0:
+            pruned = candidate_tree.query_ball_point(candidate_tree.data[candidate_idx], min_separation_chord)
+            stats["candidates_pruned"] += int(np.count_nonzero(~dead[pruned]))
+            dead[pruned] = True
+        covered_points[indices[indptr[candidate_idx]:indptr[candidate_idx + 1]]] = True
     
     last_improvement = float(''inf'')
-    iterations_without_improvement = 0
+    for candidate_idx in resume or ():
+        gain = marginal_gain(candidate_coverage, candidate_idx, weights, covered_points)
+        take(candidate_idx)
+        uncovered_weight -= gain
+        last_improvement = gain / total_weight
+    if resume:
+        stats["resumed_stations"] = len(resume)
+        print(f"[INFO] Resumed stochastic greedy selection after {len(resume)} stations")
+    
+    print(f"[INFO] Starting stochastic greedy selection with {n_candidates} candidates, "
+          f"epsilon {epsilon}, sample size {sample_size}")
     
-    while (len(selected_stations) < max_stations and 
-           uncovered_weight > 0 and 
-           heap):
+    while len(selected_stations) < max_stations and uncovered_weight > 0:
+        if deadline is not None and time.time() >= deadline:
+            stats["stopped_at_deadline"] = True
+            print(f"[WARN] Time limit reached after {len(selected_stations)} stations")
+            break
         
-        # Early termination if improvement is minimal
         current_coverage = 1 - (uncovered_weight / total_weight)
+        if current_coverage >= coverage_target:
+            break
         if (len(selected_stations) > 10 and 
             last_improvement < early_termination_threshold and
             current_coverage > coverage_target * 0.9):
             print(f"[INFO] Early termination: minimal improvement ({last_improvement:.6f})")
             break
         
-        # Get best candidate
-        neg_gain, candidate_idx = heapq.heappop(heap)
-        gain = -neg_gain
-        
-        # Calculate actual gain
-        newly_covered = candidate_coverage[candidate_idx].difference(covered_points)
-        actual_gain = sum(weights[i] for i in newly_covered)
-        
-        # Re-queue if gain has changed significantly
-        if actual_gain < gain * 0.9 and actual_gain > 0:
-            heapq.heappush(heap, (-actual_gain, candidate_idx))
-            continue
-        
-        if actual_gain == 0:
-            continue
+        pool = np.flatnonzero(~dead)
+        if len(pool) == 0:
+            break
+        sample = rng.choice(pool, size=min(sample_size, len(pool)), replace=False)
+        gains = batch_marginal_gains(candidate_coverage, sample, weights, covered_points)
+        stats["gain_evaluations"] += len(sample)
+        dead[sample[gains <= 0]] = True
         
-        # Check separation constraint efficiently
-        lat1, lon1 = candidates[candidate_idx]
-        if selected_stations:
-            selected_coords = candidates[selected_stations]
-            distances = haversine_distance_vectorized(
-                lat1, lon1, 
-                selected_coords[:, 0], selected_coords[:, 1]
-            )
-            if np.any(distances < min_separation):
+        # Best feasible candidate of the sample
+        candidate_idx = None
+        for pos in np.argsort(-gains, kind="stable"):
+            if gains[pos] <= 0:
+                break
+            lat1, lon1 = candidates[sample[pos]]
+            if separation_grid.too_close(lat1, lon1):
+                stats["separation_rejections"] += 1
+                dead[sample[pos]] = True
                 continue
+            candidate_idx = int(sample[pos])
+            actual_gain = gains[pos]
+            break
+        if candidate_idx is None:
+            continue
         
         # Select station
-        selected_stations.append(candidate_idx)
-        covered_points.update(newly_covered)
+        take(candidate_idx)
+        if checkpoint is not None:
+            checkpoint(selected_stations)
         previous_weight = uncovered_weight
         uncovered_weight -= actual_gain
         
@@ -183,137 +1041,548 @@ def optimized_greedy_selection(candidates, weights, candidate_coverage,
             print(f"[INFO] Coverage target {coverage_target*100:.2f}% reached!")
             break
     
-    return selected_stations, covered_points, uncovered_weight
+    print(f"[INFO] Stochastic greedy used {stats[''gain_evaluations'']} gain evaluations")
+    return selected_stations, covered_points, uncovered_weight, stats
+
+def swap_refinement(candidates, weights, candidate_coverage, selected_stations,
+                    service_radius, min_separation, time_budget, costs=None, budget=None,
+                    covered=None, blocked=None, deadline=None, checkpoint=None):
+    """
+    1-for-1 swap local search on a greedy station set, under a time budget.
+
+    Keeps cover_count (selected stations covering each point), the gain of
+    every candidate against the current set and the loss of dropping each
+    selected station (its uniquely covered weight).  Swapping s for c
+    changes covered weight by gain(c) - loss(s) + overlap(s, c), where
+    overlap is the weight c re-covers among the points only s covers; it is
+    scored by touching just the coverage lists of s and c, and it is zero
+    unless s is within 2 * service_radius of c.  Since overlap(s, c) is at
+    most the already covered weight in c''s radius, total(c) - gain(c), no
+    swap adding c can beat gain(c) - max(0, min loss - covered(c)); each
+    pass takes the candidates with a positive bound in decreasing order,
+    checks separation and the per-pair bound against all selected stations
+    in vectorized chunks, and applies the first improving swap that keeps
+    MIN_SEPARATION.  The gains of the candidates covering changed points
+    are then updated through the transposed coverage.  Stops at a local
+    optimum or when time_budget seconds have passed.  With costs, only
+    available candidates come in, and with a budget only swaps that keep
+    the total cost within it.  Points in covered count as covered by a
+    station that is never dropped, and blocked candidates never come in.
+    Refinement also stops at deadline, and checkpoint is called with the
+    station list after every swap.
+    """
+    refine_start = time.time()
+    indptr, indices = candidate_coverage
+    n_points = len(weights)
+    selected = list(selected_stations)
+    is_selected = np.zeros(len(candidates), dtype=bool)
+    is_selected[selected] = True
+    
+    def row(idx):
+        return indices[indptr[idx]:indptr[idx + 1]]
+    
+    cover_count = np.zeros(n_points, dtype=np.int32)
+    for idx in selected:
+        cover_count[row(idx)] += 1
+    if covered is not None:
+        cover_count[covered] += 1
+    covered_before = weights[cover_count > 0].sum()
+    incidence_matrix = coverage_matrix(candidate_coverage, n_points)
+    totals = incidence_matrix.dot(weights)
+    gains = incidence_matrix.dot(np.where(cover_count == 0, weights, 0.0))
+    del incidence_matrix
+    # Point -> candidates covering it, as CSC of the incidence pattern
+    incidence = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr),
+                           shape=(len(candidates), n_points)).tocsc()
+    
+    def shift_gains(points, sign):
+        if len(points) == 0:
+            return
+        starts, ends = incidence.indptr[points], incidence.indptr[points + 1]
+        lengths = ends - starts
+        covering = incidence.indices[np.repeat(ends - np.cumsum(lengths), lengths) + np.arange(lengths.sum())]
+        gains[:] += sign * np.bincount(covering, weights=np.repeat(weights[points], lengths),
+                                       minlength=len(gains))
+    
+    def out_of_time():
+        now = time.time()
+        return now - refine_start >= time_budget or (deadline is not None and now >= deadline)
+    
+    marked = np.zeros(n_points, dtype=bool)
+    tolerance = 1e-9 * weights.sum()
+    stats = {"refine_swaps": 0, "refine_evaluations": 0, "refine_passes": 0}
+    
+    while selected and not out_of_time():
+        stats["refine_passes"] += 1
+        losses = np.array([weights[r[cover_count[r] == 1]].sum() for r in map(row, selected)])
+        selected_coords = candidates[selected]
+        bounds = gains - np.maximum(0.0, losses.min() - (totals - gains))
+        bounds[is_selected] = -np.inf
+        if costs is not None:
+            bounds[~np.isfinite(costs)] = -np.inf
+        if blocked is not None:
+            bounds[blocked] = -np.inf
+        promising = np.flatnonzero(bounds > tolerance)
+        promising = promising[np.argsort(-bounds[promising])]
+        swap = None
+        for chunk_start in range(0, len(promising), 20000):
+            chunk = promising[chunk_start:chunk_start + 20000]
+            distances = haversine_distance(
+                candidates[chunk, 0][:, None], candidates[chunk, 1][:, None],
+                selected_coords[None, :, 0], selected_coords[None, :, 1])
+            # Dropping s can only clear a separation conflict with s itself
+            conflict = distances < min_separation
+            n_conflicts = conflict.sum(axis=1)
+            allowed = np.where((n_conflicts == 1)[:, None], conflict, n_conflicts[:, None] == 0)
+            near = distances <= 2 * service_radius
+            chunk_gains = gains[chunk][:, None]
+            pair_bound = chunk_gains - losses + np.minimum(losses, (totals[chunk] - gains[chunk])[:, None])
+            exact_far = np.where(near, -np.inf, chunk_gains - losses)
+            viable = allowed & (near & (pair_bound > tolerance) | (exact_far > tolerance))
+            if costs is not None and budget:
+                viable &= costs[chunk][:, None] - costs[selected] <= budget - costs[selected].sum()
+            for i, k in zip(*np.nonzero(viable)):
+                c = chunk[i]
+                if not near[i, k]:
+                    swap = (k, c)
+                    break
+                row_s, row_c = row(selected[k]), row(c)
+                unique_s = row_s[cover_count[row_s] == 1]
+                marked[unique_s] = True
+                overlap = weights[row_c[marked[row_c]]].sum()
+                marked[unique_s] = False
+                stats["refine_evaluations"] += 1
+                if gains[c] - losses[k] + overlap > tolerance:
+                    swap = (k, c)
+                    break
+            if swap is not None or out_of_time():
+                break
+        if swap is None:
+            break
+        
+        # Apply: drop s (points falling to 0 raise the gains covering them),
+        # then add c (points rising from 0 lower them)
+        k, c = swap
+        s = selected[k]
+        row_s, row_c = row(s), row(c)
+        cover_count[row_s] -= 1
+        shift_gains(row_s[cover_count[row_s] == 0], 1.0)
+        shift_gains(row_c[cover_count[row_c] == 0], -1.0)
+        cover_count[row_c] += 1
+        selected[k] = c
+        is_selected[s], is_selected[c] = False, True
+        stats["refine_swaps"] += 1
+        if checkpoint is not None:
+            checkpoint(selected)
+    
+    covered_points = cover_count > 0
+    uncovered_weight = weights[~covered_points].sum()
+    stats["refine_gain"] = round(float((weights.sum() - uncovered_weight - covered_before) / weights.sum()), 6)
+    stats["refine_seconds"] = round(time.time() - refine_start, 2)
+    if deadline is not None and time.time() >= deadline:
+        stats["stopped_at_deadline"] = True
+    if costs is not None:
+        stats["budget_spent"] = float(costs[selected].sum())
+    print(f"[INFO] Swap refinement: {stats[''refine_swaps'']} swaps in {stats[''refine_seconds'']}s, "
+          f"coverage +{stats[''refine_gain''] * 100:.2f}%")
+    return selected, covered_points, uncovered_weight, stats
+
+def select_stations(strategy, candidates, weights, candidate_coverage, service_radius,
+                    min_separation, max_stations, coverage_target,
+                    early_termination_threshold, epsilon, candidate_tree=None,
+                    costs=None, budget=None, covered=None, blocked=None, timer=None,
+                    resume=None, deadline=None, checkpoint=None):
+    """Run the greedy variant named by STRATEGY (costs need celf or threshold)"""
+    if strategy == "stochastic":
+        return stochastic_greedy_selection(
+            candidates, weights, candidate_coverage,
+            min_separation, max_stations, coverage_target,
+            early_termination_threshold, epsilon, candidate_tree=candidate_tree,
+            covered=covered, blocked=blocked, resume=resume, deadline=deadline, checkpoint=checkpoint
+        )
+    return optimized_greedy_selection(
+        candidates, weights, candidate_coverage, 
+        service_radius, min_separation, max_stations, 
+        coverage_target, early_termination_threshold, strategy,
+        candidate_tree=candidate_tree, costs=costs, budget=budget,
+        covered=covered, blocked=blocked, timer=timer,
+        resume=resume, deadline=deadline, checkpoint=checkpoint
+    )
+
+def partition_labels(points, partition_mode, partition_count, partition_keys=None):
+    """Partition id per point for PARTITION_MODE grid, province or district"""
+    if partition_mode == "grid":
+        return grid_partitions(points, partition_count)
+    labels, _ = pd.factorize(pd.Series(partition_keys), use_na_sentinel=True)
+    labels[labels < 0] = labels.max() + 1  # cells without a label form one partition
+    return labels
+
+def solve_partition(partition_id):
+    """
+    Greedy selection restricted to one partition''s candidates.
+
+    Demand is the partition''s points plus a halo of points from other
+    partitions within the service radius, so the coverage of every
+    candidate near a border is complete and border stations are valued by
+    all the traffic they serve.  Returns the selected global point ids.
+    """
+    ctx = PARTITION_CONTEXT
+    partition_start = time.time()
+    points_xyz, labels, radius_chord = ctx["points_xyz"], ctx["labels"], ctx["radius_chord"]
+    own = np.flatnonzero(labels == partition_id)
+    halo, own_tree = partition_halo(points_xyz, own, radius_chord)
+    demand = np.concatenate((own, halo))
+    coverage = efficient_coverage_precomputation(points_xyz[own], cKDTree(points_xyz[demand]), radius_chord,
+                                                 workers=ctx["query_workers"])
+    selected, _, uncovered_weight, stats = select_stations(
+        ctx["strategy"], ctx["points"][own], ctx["weights"][demand], coverage,
+        ctx["service_radius"], ctx["min_separation"], ctx["max_stations"],
+        ctx["coverage_target"], ctx["early_termination_threshold"], ctx["epsilon"],
+        candidate_tree=own_tree, costs=ctx["costs"][own] if ctx["costs"] is not None else None,
+        budget=ctx["budget"],
+        covered=ctx["covered"][demand] if ctx["covered"] is not None else None,
+        blocked=ctx["blocked"][own] if ctx["blocked"] is not None else None,
+        deadline=ctx["deadline"]
+    )
+    total_weight = ctx["weights"][demand].sum()
+    return own[selected], {
+        "partition": int(partition_id),
+        "points": len(own),
+        "halo_points": len(halo),
+        "stations": len(selected),
+        "coverage": round(float(1 - uncovered_weight / total_weight), 4) if total_weight > 0 else 0.0,
+        "seconds": round(time.time() - partition_start, 2),
+        "gain_evaluations": stats["gain_evaluations"],
+        "stopped_at_deadline": stats.get("stopped_at_deadline", False),
+    }
 
 def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
          ZOOM_LEVEL, STAGE_NAME, START_TIME, END_TIME, AREA, PROVINCE, DISTRICT,
          USE_TRAFFIC_WEIGHTING=True, H3_RESOLUTION=7, MAX_DATA_POINTS=50000,
-         EARLY_TERMINATION_THRESHOLD=0.001):
+         EARLY_TERMINATION_THRESHOLD=0.001, STRATEGY="celf", EPSILON=0.1,
+         USE_COVERAGE_CACHE=True, CACHE_TTL_HOURS=24, CACHE_MAX_MB=512,
+         CURVE_TARGETS="0.5,0.75,0.9,0.95", SERVICE_RADII=None,
+         PARTITION_MODE="none", PARTITION_COUNT=0, SAMPLING_GRID=20, REDUCTION="sample",
+         REFINE_SECONDS=0, COST_TABLE=None, COST_COLUMN=None, BUDGET=0,
+         EXISTING_STATIONS=None, MAX_RUNTIME_SECONDS=0, CHECKPOINT_SECONDS=30,
+         MAX_CORESET_TOLERANCE_KM=None):
     
     start_time = time.time()
+    timer = PhaseTimer()
+    # Past the deadline selection and refinement stop with the best stations
+    # so far, and the result is flagged partial
+    deadline = start_time + MAX_RUNTIME_SECONDS if MAX_RUNTIME_SECONDS and MAX_RUNTIME_SECONDS > 0 else None
+    strategy = (STRATEGY or "celf").lower()
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown STRATEGY {STRATEGY}; expected one of {STRATEGIES}")
+    if strategy == "stochastic" and not 0 < EPSILON < 1:
+        raise ValueError(f"EPSILON must be between 0 and 1, got {EPSILON}")
+    partition_mode = (PARTITION_MODE or "none").lower()
+    if partition_mode not in PARTITION_MODES:
+        raise ValueError(f"Unknown PARTITION_MODE {PARTITION_MODE}; expected one of {PARTITION_MODES}")
+    reduction = (REDUCTION or "sample").lower()
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"Unknown REDUCTION {REDUCTION}; expected one of {REDUCTIONS}")
+    # Site costs come from COST_TABLE (LAT, LON, COST_COLUMN) or from
+    # COST_COLUMN of the GPS table; BUDGET caps their total
+    cost_table = sql_identifier(COST_TABLE, "COST_TABLE") if COST_TABLE and COST_TABLE != "NULL" else None
+    cost_column = COST_COLUMN if COST_COLUMN and COST_COLUMN != "NULL" else ("SITE_COST" if cost_table else None)
+    if cost_column:
+        sql_identifier(cost_column, "COST_COLUMN")
+    budget = float(BUDGET) if BUDGET and BUDGET > 0 else None
+    if budget and not cost_column:
+        raise ValueError("BUDGET needs site costs from COST_TABLE or COST_COLUMN")
+    if cost_column and strategy == "stochastic":
+        raise ValueError("Site costs need STRATEGY celf or threshold")
     print(f"[INFO] Starting optimized coverage optimization (max points: {MAX_DATA_POINTS})")
     
-    # Step 1: Efficient data filtering and aggregation
-    try:
-        # Build optimized query with proper filtering
-        where_clauses = []
-        
-        if START_TIME and END_TIME:
-            where_clauses.append(f"MEAN_TIMESTAMP BETWEEN ''{START_TIME}'' AND ''{END_TIME}''")
-        
-        # Location filters
-        if AREA and AREA != "NULL" and AREA != "CAST(NULL AS VARCHAR)":
-            area_clean = AREA.strip("''").replace("'', ''", "'',''")
-            where_clauses.append(f"AREA IN (''{area_clean}'')")
-        
-        if PROVINCE and PROVINCE != "NULL" and PROVINCE != "CAST(NULL AS VARCHAR)":
-            province_clean = PROVINCE.strip("''").replace("'', ''", "'',''") 
-            where_clauses.append(f"PROVINCE IN (''{province_clean}'')")
-        
-        if DISTRICT and DISTRICT != "NULL" and DISTRICT != "CAST(NULL AS VARCHAR)":
-            district_clean = DISTRICT.strip("''").replace("'', ''", "'',''")
-            where_clauses.append(f"DISTRICT IN (''{district_clean}'')")
-        
-        where_clause = " AND ".join(where_clauses) if where_clauses else "1=1"
-        
-        # Optimized H3 aggregation query
-        h3_query = f"""
-        WITH filtered_data AS (
-            SELECT MEAN_LAT, MEAN_LONG
-            FROM REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED
-            WHERE {where_clause}
-        ),
-        h3_aggregated AS (
-            SELECT 
-                H3_LATLNG_TO_CELL(MEAN_LAT, MEAN_LONG, {H3_RESOLUTION}) as H3_CELL,
-                AVG(MEAN_LAT) as CELL_LAT,
-                AVG(MEAN_LONG) as CELL_LON,
-                COUNT(*) as POINT_COUNT
-            FROM filtered_data
-            GROUP BY H3_CELL
+    # SERVICE_RADII sweeps several radii in one call; coverage is computed
+    # once at the largest and truncated for the others
+    service_radii = sorted(set(parse_service_radii(SERVICE_RADII)) | {float(SERVICE_RADIUS)})
+    coverage_radius = service_radii[-1]
+    if partition_mode != "none" and len(service_radii) > 1:
+        raise ValueError("SERVICE_RADII cannot be combined with PARTITION_MODE")
+    # A partitioned solve never builds the full coverage, so there is nothing to cache
+    use_cache = USE_COVERAGE_CACHE and partition_mode == "none"
+    partition_column = partition_mode.upper() if partition_mode in ("province", "district") else None
+    # A coreset never moves a cell further than this; by default a tenth of
+    # the smallest radius, so its coverage bounds stay tight at every radius
+    coreset_max_tolerance = None
+    if reduction == "coreset":
+        coreset_max_tolerance = (float(MAX_CORESET_TOLERANCE_KM) if MAX_CORESET_TOLERANCE_KM
+                                 else service_radii[0] / 10)
+    
+    where_clause = build_where_clause(START_TIME, END_TIME, AREA, PROVINCE, DISTRICT)
+    
+    # Step 1: Reuse aggregated points and coverage from the stage cache when
+    # only selection parameters (MAX_STATIONS, COVERAGE_TARGET, ...) changed
+    cache_key = coverage_cache_key(START_TIME, END_TIME, AREA, PROVINCE, DISTRICT,
+                                   H3_RESOLUTION, coverage_radius, MAX_DATA_POINTS, SAMPLING_GRID,
+                                   reduction, coreset_max_tolerance)
+    # A time-limited call checkpoints its selection under a key of every
+    # input that shapes it, so an identical follow-up call resumes
+    checkpoint_key = coverage_cache_key(cache_key, service_radii, MIN_SEPARATION, COVERAGE_TARGET,
+                                        MAX_STATIONS, USE_TRAFFIC_WEIGHTING, EARLY_TERMINATION_THRESHOLD,
+                                        strategy, EPSILON, partition_mode, PARTITION_COUNT, REFINE_SECONDS,
+                                        cost_table, cost_column, budget, EXISTING_STATIONS)
+    cached = None
+    if use_cache:
+        cached = load_coverage_cache(session, STAGE_NAME, cache_key, CACHE_TTL_HOURS, CACHE_MAX_MB)
+    timer.mark("cache_load")
+    
+    # A coreset representative stands for multiplicity cells; count_scale is
+    # the largest POINT_COUNT of the unreduced cells (see Step 3)
+    multiplicity = None
+    count_scale = None
+    coreset_tolerance = None
+    full_data = None
+    if cached is not None:
+        gps_points, point_counts, candidate_coverage, extras = cached
+        points_xyz = latlon_to_unit_xyz(gps_points)
+        if "multiplicity" in extras:
+            multiplicity = extras["multiplicity"]
+            count_scale = float(extras["count_scale"][0])
+            coreset_tolerance = float(extras["coreset_tolerance_km"][0])
+        print(f"[INFO] Coverage cache hit {cache_key}: {len(gps_points)} points")
+    else:
+        # Efficient data filtering and aggregation
+        gps_points, point_counts, points_xyz, partition_keys = fetch_aggregated_cells(
+            session, where_clause, H3_RESOLUTION, MAX_DATA_POINTS, partition_column,
+            CORESET_FETCH_LIMIT if reduction == "coreset" else None, timer
         )
-        SELECT CELL_LAT, CELL_LON, POINT_COUNT
-        FROM h3_aggregated
-        ORDER BY POINT_COUNT DESC
-        LIMIT {min(MAX_DATA_POINTS * 2, 100000)}
-        """
         
-        print("[INFO] Executing optimized H3 aggregation query")
-        agg_df = session.sql(h3_query)
-        agg_pdf = agg_df.to_pandas()
+        if len(gps_points) == 0:
+            return json.dumps({
+                "message": "No GPS data found after filtering",
+                "stations": [],
+                "coverage_percentage": 0,
+                "map_meta": {"center_lat": 7.8731, "center_lon": 80.7718, "zoom": ZOOM_LEVEL}
+            })
         
-    except Exception as e:
-        print(f"[ERROR] H3 query failed: {str(e)}, using fallback")
-        # Fallback to simple sampling
-        simple_query = f"""
-        SELECT MEAN_LAT as CELL_LAT, MEAN_LONG as CELL_LON, 1 as POINT_COUNT
-        FROM REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED
-        WHERE {where_clause}
-        ORDER BY RANDOM()
-        LIMIT {MAX_DATA_POINTS}
-        """
-        agg_df = session.sql(simple_query)
-        agg_pdf = agg_df.to_pandas()
-    
-    if agg_pdf.empty:
-        return json.dumps({
-            "message": "No GPS data found after filtering",
-            "stations": [],
-            "coverage_percentage": 0,
-            "map_meta": {"center_lat": 7.8731, "center_lon": 80.7718, "zoom": ZOOM_LEVEL}
-        })
+        print(f"[INFO] Retrieved {len(gps_points)} aggregated data points")
+        
+        # Step 2: Reduce to MAX_DATA_POINTS, either by a coreset with a
+        # stated distance tolerance or by adaptive sampling (ROW maps the
+        # sample back onto the streamed buffers)
+        if len(gps_points) > MAX_DATA_POINTS and reduction == "coreset":
+            full_data = (gps_points, point_counts, points_xyz)
+            groups, gps_points, point_counts, multiplicity, coreset_tolerance = build_coreset(
+                gps_points, point_counts, MAX_DATA_POINTS, coreset_max_tolerance
+            )
+            count_scale = float(full_data[1].max())
+            points_xyz = latlon_to_unit_xyz(gps_points)
+            if partition_keys is not None:
+                # Label a representative like its first member
+                first_member = np.full(len(gps_points), len(groups))
+                np.minimum.at(first_member, groups, np.arange(len(groups)))
+                partition_keys = partition_keys[first_member]
+            print(f"[INFO] Coreset: {len(full_data[0])} -> {len(gps_points)} cells, "
+                  f"tolerance {coreset_tolerance:.3f} km")
+            if len(gps_points) > MAX_DATA_POINTS:
+                print(f"[WARN] Coreset keeps {len(gps_points)} cells (MAX_DATA_POINTS {MAX_DATA_POINTS}) "
+                      f"to stay within MAX_CORESET_TOLERANCE_KM {coreset_max_tolerance:g}")
+        elif len(gps_points) > MAX_DATA_POINTS:
+            frame = pd.DataFrame({
+                "CELL_LAT": gps_points[:, 0], "CELL_LON": gps_points[:, 1],
+                "POINT_COUNT": point_counts, "ROW": np.arange(len(gps_points))
+            }, copy=False)
+            rows = adaptive_sampling(frame, MAX_DATA_POINTS, grid_size=int(SAMPLING_GRID))["ROW"].to_numpy()
+            gps_points, point_counts, points_xyz = gps_points[rows], point_counts[rows], points_xyz[rows]
+            if partition_keys is not None:
+                partition_keys = partition_keys[rows]
     
-    print(f"[INFO] Retrieved {len(agg_pdf)} aggregated data points")
+    # Step 3: Traffic weighting; a coreset representative weighs exactly the
+    # sum of its members'' weights, which keeps its tolerance guarantee
+    if multiplicity is None:
+        multiplicity = np.ones(len(point_counts))
+        count_scale = float(point_counts.max())
+    weights = multiplicity.astype(float)
+    if USE_TRAFFIC_WEIGHTING:
+        weights = weights + 9 * (point_counts / count_scale)
     
-    # Step 2: Adaptive sampling for scalability
-    if len(agg_pdf) > MAX_DATA_POINTS:
-        agg_pdf = adaptive_sampling(agg_pdf, MAX_DATA_POINTS)
+    print(f"[INFO] Processing {len(gps_points)} points with total weight {weights.sum():.0f}")
+    timer.mark("sampling", points=len(gps_points))
     
-    gps_points = agg_pdf[["CELL_LAT", "CELL_LON"]].values
-    weights = agg_pdf["POINT_COUNT"].values.astype(float)
+    # Step 4: Efficient spatial indexing on unit vectors; one index serves
+    # both coverage and separation queries with exact great-circle radii
+    candidates = gps_points.astype(np.float64)
+    candidates_xyz = points_xyz
+    tree = cKDTree(candidates_xyz)
+    partition_stats = None
+    timer.mark("tree_build", candidates=len(candidates))
     
-    # Step 3: Traffic weighting
-    if USE_TRAFFIC_WEIGHTING:
-        weights = 1 + 9 * (weights / weights.max())
-    else:
-        weights = np.ones_like(weights)
+    # Step 4b: A candidate costs as much as the cheapest site within one H3
+    # edge of it; candidates without a site cannot be selected
+    costs = None
+    if cost_column:
+        site_points, site_costs = fetch_site_costs(session, cost_table, cost_column, where_clause, H3_RESOLUTION)
+        costs = candidate_costs(tree, site_points, site_costs, H3_EDGE_KM[int(H3_RESOLUTION)])
+        print(f"[INFO] {np.isfinite(costs).sum()} of {len(costs)} candidates have a site cost "
+              f"from {len(site_costs)} sites")
+        timer.mark("site_costs", sites=len(site_costs))
     
-    print(f"[INFO] Processing {len(gps_points)} points with total weight {weights.sum():.0f}")
+    # Step 4c: Existing stations serve their points from the start and keep
+    # candidates closer than MIN_SEPARATION out; selection adds expansion stations
+    points_tree = tree
+    existing_xyz = None
+    blocked = None
+    if EXISTING_STATIONS and EXISTING_STATIONS != "NULL":
+        existing = load_existing_stations(session, EXISTING_STATIONS)
+        existing_xyz = latlon_to_unit_xyz(existing)
+        blocked = covered_by(existing_xyz, tree, MIN_SEPARATION, strict=True)
+        print(f"[INFO] {len(existing)} existing stations block {blocked.sum()} candidates")
+        timer.mark("existing_stations", stations=len(existing))
     
-    # Step 4: Efficient spatial indexing
-    tree = cKDTree(np.radians(gps_points))
-    service_radius_rad = SERVICE_RADIUS / 6371.0
-    candidates = gps_points.copy()
-    candidates_rad = np.radians(candidates)
+    if partition_mode != "none":
+        # Step 5a: Solve partitions in parallel, then reconcile over the union
+        # of their picks: the final greedy below sees global coverage and
+        # one SeparationGrid, so border stations are neither double-counted
+        # nor closer than MIN_SEPARATION
+        partition_count = int(PARTITION_COUNT) if PARTITION_COUNT and PARTITION_COUNT > 0 else (os.cpu_count() or 1)
+        labels = partition_labels(candidates, partition_mode, partition_count, partition_keys)
+        partition_ids = np.unique(labels).tolist()
+        workers = min(os.cpu_count() or 1, len(partition_ids))
+        print(f"[INFO] Solving {len(partition_ids)} {partition_mode} partitions on {workers} workers")
+        partition_results = solve_partitions(solve_partition, {
+            "points": candidates, "points_xyz": points_xyz, "weights": weights, "labels": labels,
+            "radius_chord": chord_length(SERVICE_RADIUS), "strategy": strategy,
+            "service_radius": SERVICE_RADIUS, "min_separation": MIN_SEPARATION,
+            "max_stations": MAX_STATIONS, "coverage_target": COVERAGE_TARGET,
+            "early_termination_threshold": EARLY_TERMINATION_THRESHOLD, "epsilon": EPSILON,
+            "costs": costs, "budget": budget, "blocked": blocked, "deadline": deadline,
+            "covered": covered_by(existing_xyz, points_tree, SERVICE_RADIUS) if existing_xyz is not None else None,
+        }, partition_ids, workers)
+        partition_stats = [summary for _, summary in partition_results]
+        pool = np.unique(np.concatenate([picks for picks, _ in partition_results]))
+        print(f"[INFO] Reconciling {len(pool)} partition stations")
+        timer.mark("partitions", partitions=len(partition_ids))
+        
+        candidate_coverage = efficient_coverage_precomputation(
+            candidates_xyz[pool], tree, chord_length(SERVICE_RADIUS)
+        )
+        timer.mark("coverage_precomputation", coverage_entries=len(candidate_coverage[1]))
+        candidates = candidates[pool]
+        candidates_xyz = candidates_xyz[pool]
+        if costs is not None:
+            costs = costs[pool]
+        if blocked is not None:
+            blocked = blocked[pool]
+        tree = cKDTree(candidates_xyz)
+        timer.mark("tree_build", candidates=len(candidates))
+    elif cached is None:
+        # Step 5: Batch coverage computation, once at the largest radius
+        candidate_coverage = efficient_coverage_precomputation(
+            candidates_xyz, tree, chord_length(coverage_radius)
+        )
+        timer.mark("coverage_precomputation", coverage_entries=len(candidate_coverage[1]))
+        if use_cache:
+            extras = None
+            if coreset_tolerance is not None:
+                extras = {"multiplicity": multiplicity, "count_scale": np.array([count_scale]),
+                          "coreset_tolerance_km": np.array([coreset_tolerance])}
+            save_coverage_cache(session, STAGE_NAME, cache_key, gps_points, point_counts,
+                                candidate_coverage, extras)
+            timer.mark("cache_save")
     
-    # Step 5: Batch coverage computation
-    candidate_coverage = efficient_coverage_precomputation(
-        candidates_rad, tree, service_radius_rad, batch_size=min(1000, len(candidates) // 10)
-    )
+    radius_chords = [chord_length(radius) for radius in service_radii]
+    bands = None
+    if len(service_radii) > 1:
+        bands = coverage_radius_bands(candidate_coverage, candidates_xyz, points_xyz, radius_chords)
+        timer.mark("coverage_precomputation")
     
     print(f"[INFO] Coverage computation completed in {time.time() - start_time:.2f}s")
     
-    # Step 6: Optimized greedy selection
-    selection_start = time.time()
-    selected_stations, covered_points, uncovered_weight = optimized_greedy_selection(
-        candidates, weights, candidate_coverage, 
-        SERVICE_RADIUS, MIN_SEPARATION, MAX_STATIONS, 
-        COVERAGE_TARGET, EARLY_TERMINATION_THRESHOLD
-    )
+    checkpoint = None
+    if deadline is not None:
+        checkpoint = SelectionCheckpoint(session, STAGE_NAME, checkpoint_key, CHECKPOINT_SECONDS, candidates, tree)
+        if checkpoint.load():
+            print(f"[INFO] Resuming from checkpoint {checkpoint.path}")
     
-    print(f"[INFO] Station selection completed in {time.time() - selection_start:.2f}s")
+    # Step 6: Optimized greedy selection for every radius; smaller radii
+    # truncate the largest radius'' neighbor lists instead of querying again
+    curve_targets = sorted(set(parse_coverage_targets(CURVE_TARGETS)) | {float(COVERAGE_TARGET)})
+    sweep = []
+    for band, radius in enumerate(service_radii):
+        selection_start = time.time()
+        radius_coverage = candidate_coverage
+        if radius != coverage_radius:
+            radius_coverage = truncate_coverage(candidate_coverage, bands, band)
+        existing_covered = None
+        if existing_xyz is not None:
+            existing_covered = covered_by(existing_xyz, points_tree, radius)
+        timer.mark("coverage_precomputation")
+        
+        # A resumed radius replays its checkpointed greedy stations first
+        resume = checkpoint.stations(radius, "greedy") if checkpoint is not None else None
+        selected, covered_points, uncovered_weight, stats = select_stations(
+            strategy, candidates, weights, radius_coverage, radius,
+            MIN_SEPARATION, MAX_STATIONS, COVERAGE_TARGET,
+            EARLY_TERMINATION_THRESHOLD, EPSILON, candidate_tree=tree,
+            costs=costs, budget=budget, covered=existing_covered, blocked=blocked, timer=timer,
+            resume=resume, deadline=deadline,
+            checkpoint=functools.partial(checkpoint.record, radius, "greedy") if checkpoint is not None else None
+        )
+        greedy_selected = list(selected)
+        curve = coverage_curve(selected, radius_coverage, weights, curve_targets, existing_covered)
+        timer.mark("greedy", stations=len(selected), heap_pops=stats["heap_pops"],
+                   gain_reevaluations=stats.get("gain_reevaluations", 0),
+                   separation_rejections=stats["separation_rejections"])
+        if existing_covered is not None:
+            stats = {**stats, "existing_coverage": round(float(weights[existing_covered].sum() / weights.sum()), 6)}
+        
+        # Step 6b: Swap refinement keeps the station count and improves the
+        # set; the curve above still describes the greedy prefixes.  A
+        # resumed refinement continues from the checkpointed stations, and
+        # one that already finished is not repeated
+        if REFINE_SECONDS and REFINE_SECONDS > 0 and selected and not stats.get("stopped_at_deadline"):
+            refine_phase = checkpoint.phase(radius) if checkpoint is not None else None
+            if refine_phase in ("refinement", "done"):
+                selected = checkpoint.stations(radius, "stations") or selected
+            selected, covered_points, uncovered_weight, refine_stats = swap_refinement(
+                candidates, weights, radius_coverage, selected,
+                radius, MIN_SEPARATION, 0 if refine_phase == "done" else REFINE_SECONDS, costs, budget,
+                existing_covered, blocked, deadline,
+                functools.partial(checkpoint.record, radius, "refinement", greedy_selected)
+                if checkpoint is not None else None
+            )
+            stats = {**stats, **refine_stats}
+            timer.mark("refinement", swaps=refine_stats["refine_swaps"],
+                       evaluations=refine_stats["refine_evaluations"])
+        if checkpoint is not None and not stats.get("stopped_at_deadline"):
+            checkpoint.record(radius, "done", greedy_selected, selected)
+        
+        coverage_pct = 1 - (uncovered_weight / weights.sum()) if weights.sum() > 0 else 0
+        print(f"[INFO] Station selection for {radius} km completed in {time.time() - selection_start:.2f}s: "
+              f"{len(selected)} stations, {coverage_pct*100:.2f}% coverage")
+        sweep.append({
+            "service_radius_km": radius,
+            "selected": selected,
+            "coverage_percentage": coverage_pct,
+            "coverage_curve": curve,
+            "coverage_entries": len(radius_coverage[1]),
+            "selection_time_seconds": round(time.time() - selection_start, 2),
+            "selection_stats": stats,
+        })
     
-    # Step 7: Build optimized result
-    stations_info = [
-        {
-            "station_id": i + 1,
-            "lat": float(candidates[idx][0]),
-            "lon": float(candidates[idx][1])
-        }
-        for i, idx in enumerate(selected_stations)
-    ]
+    # Step 7: Build optimized result; the top level describes SERVICE_RADIUS
+    def stations_for(selected):
+        stations = [
+            {
+                "station_id": i + 1,
+                "lat": round(float(candidates[idx][0]), 6),
+                "lon": round(float(candidates[idx][1]), 6)
+            }
+            for i, idx in enumerate(selected)
+        ]
+        if costs is not None:
+            for station, idx in zip(stations, selected):
+                station["cost"] = float(costs[idx])
+        return stations
     
-    coverage_pct = 1 - (uncovered_weight / weights.sum()) if weights.sum() > 0 else 0
+    primary = next(run for run in sweep if run["service_radius_km"] == float(SERVICE_RADIUS))
+    selected_stations = primary["selected"]
+    coverage_pct = primary["coverage_percentage"]
+    selection_stats = primary["selection_stats"]
     
     # Calculate center efficiently
     if selected_stations:
@@ -325,11 +1594,52 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
         center_lon = float(np.mean(candidates[:, 1]))
     
     total_time = time.time() - start_time
+    partial = any(run["selection_stats"].get("stopped_at_deadline") for run in sweep)
+    if partial:
+        # The stage keeps where this call stopped; an identical call resumes
+        checkpoint.save()
+    elif checkpoint is not None and (checkpoint.saves or checkpoint.loaded):
+        checkpoint.clear()
+    
+    coreset_stats = None
+    if coreset_tolerance is not None:
+        # Any station set''s coreset coverage lies between the full-data
+        # coverage at SERVICE_RADIUS -/+ the tolerance; report both bounds and
+        # the exact full-data coverage of the chosen stations when the
+        # unreduced cells are at hand (not on a cache hit).  That exact
+        # coverage is then the top-level coverage_percentage, and
+        # coverage_basis says which one the result reports
+        coreset_stats = {"coreset_tolerance_km": round(coreset_tolerance, 4),
+                         "coreset_max_tolerance_km": coreset_max_tolerance,
+                         "coverage_coreset": coverage_pct}
+        if full_data is not None:
+            full_points, full_counts, full_xyz = full_data
+            full_weights = np.ones(len(full_counts))
+            if USE_TRAFFIC_WEIGHTING:
+                full_weights = full_weights + 9 * (full_counts / count_scale)
+            full_tree = cKDTree(full_xyz)
+            stations_xyz = candidates_xyz[selected_stations]
+            if existing_xyz is not None:
+                stations_xyz = np.vstack((stations_xyz, existing_xyz))
+            coreset_stats.update({
+                "coreset_input_cells": len(full_points),
+                "coverage_full_data": weighted_coverage(stations_xyz, full_tree, full_weights, SERVICE_RADIUS),
+                "coverage_full_data_bounds": [
+                    weighted_coverage(stations_xyz, full_tree, full_weights, SERVICE_RADIUS - coreset_tolerance),
+                    weighted_coverage(stations_xyz, full_tree, full_weights, SERVICE_RADIUS + coreset_tolerance),
+                ],
+            })
+            coverage_pct = coreset_stats["coverage_full_data"]
     
     result = {
-        "message": f"Optimally selected {len(selected_stations)} stations covering {coverage_pct*100:.2f}% of traffic in {total_time:.1f}s",
-        "stations": stations_info,
+        "message": (f"Partial result at the {MAX_RUNTIME_SECONDS:g}s time limit: " if partial else "Optimally ")
+                   + f"selected {len(selected_stations)} stations covering {coverage_pct*100:.2f}% of traffic in {total_time:.1f}s",
+        "partial": partial,
+        "stations": stations_for(selected_stations),
         "coverage_percentage": coverage_pct,
+        "coverage_basis": ("full_data" if coreset_stats is None or "coverage_full_data" in coreset_stats
+                           else "coreset"),
+        "coverage_curve": {"stations_for_targets": primary["coverage_curve"]["stations_for_targets"]},
         "map_meta": {
             "center_lat": center_lat,
             "center_lon": center_lon,
@@ -338,33 +1648,122 @@ def main(session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS,
         "optimization_stats": {
             "total_processing_time_seconds": round(total_time, 2),
             "data_points_processed": len(gps_points),
+            "coverage_cache_hit": cached is not None,
             "h3_resolution": H3_RESOLUTION,
             "stations_selected": len(selected_stations),
-            "coverage_achieved": round(coverage_pct * 100, 2)
+            "coverage_achieved": round(coverage_pct * 100, 2),
+            "strategy": strategy,
+            "partition_mode": partition_mode,
+            "partition_candidates": len(candidates) if partition_stats is not None else None,
+            "costed_candidates": int(np.isfinite(costs).sum()) if costs is not None else None,
+            "existing_stations": len(existing_xyz) if existing_xyz is not None else 0,
+            "partial": partial,
+            "checkpoint": checkpoint.path if partial else None,
+            "import_seconds": import_stats(IMPORT_SECONDS),
+            **selection_stats
         },
         "parameters": {
             "service_radius_km": SERVICE_RADIUS,
+            "service_radii_km": service_radii,
             "min_separation_km": MIN_SEPARATION,
             "coverage_target": COVERAGE_TARGET,
             "max_stations": MAX_STATIONS,
             "use_traffic_weighting": USE_TRAFFIC_WEIGHTING,
-            "early_termination_threshold": EARLY_TERMINATION_THRESHOLD
+            "early_termination_threshold": EARLY_TERMINATION_THRESHOLD,
+            "strategy": strategy,
+            "epsilon": EPSILON if strategy == "stochastic" else None,
+            "partition_mode": partition_mode,
+            "partition_count": len(partition_stats) if partition_stats is not None else None,
+            "reduction": reduction,
+            "refine_seconds": REFINE_SECONDS,
+            "cost_table": cost_table,
+            "cost_column": cost_column,
+            "budget": budget,
+            "existing_stations": EXISTING_STATIONS if existing_xyz is not None else None,
+            "max_runtime_seconds": MAX_RUNTIME_SECONDS if deadline is not None else None
         }
     }
+    if partition_stats is not None:
+        result["optimization_stats"]["partitions"] = partition_stats
+    if coreset_stats is not None:
+        result["optimization_stats"].update(coreset_stats)
+    if len(sweep) > 1:
+        result["radius_sweep"] = [
+            {
+                "service_radius_km": run["service_radius_km"],
+                "stations_selected": len(run["selected"]),
+                "coverage_percentage": run["coverage_percentage"],
+                "stations_for_targets": run["coverage_curve"]["stations_for_targets"],
+                "coverage_entries": run["coverage_entries"],
+                "selection_time_seconds": run["selection_time_seconds"],
+                "selection_stats": run["selection_stats"],
+            }
+            for run in sweep
+        ]
+    
+    timer.mark("result")
+    
+    # Step 8: Stations and curves of every radius and the nearest station
+    # of each cell at SERVICE_RADIUS go to the stage as Parquet; the result,
+    # serialized once, is a manifest pointing at them
+    def station_table(run):
+        selected = np.asarray(run["selected"], dtype=np.int64)
+        columns = {
+            "service_radius_km": np.full(len(selected), run["service_radius_km"]),
+            "station_id": np.arange(1, len(selected) + 1, dtype=np.int32),
+            "lat": candidates[selected, 0],
+            "lon": candidates[selected, 1],
+        }
+        if costs is not None:
+            columns["cost"] = costs[selected]
+        return pd.DataFrame(columns)
+    
+    def curve_table(run):
+        curve = run["coverage_curve"]
+        return pd.DataFrame({
+            "service_radius_km": np.full(len(curve["stations"]), run["service_radius_km"]),
+            "stations": np.asarray(curve["stations"], dtype=np.int32),
+            "coverage": curve["coverage"],
+            "marginal_gain": curve["marginal_gain"],
+        })
+    
+    nearest, distance_km = assign_cells(points_xyz, candidates_xyz[selected_stations], SERVICE_RADIUS)
+    cell_table = pd.DataFrame({
+        "cell_lat": gps_points[:, 0],
+        "cell_lon": gps_points[:, 1],
+        "point_count": point_counts,
+        "weight": weights.astype(np.float32),
+        "station_id": nearest + 1,
+        "distance_km": distance_km,
+    })
+    if existing_xyz is not None:
+        cell_table["existing_covered"] = covered_by(existing_xyz, points_tree, SERVICE_RADIUS)
+    if coreset_tolerance is not None:
+        cell_table["multiplicity"] = multiplicity.astype(np.int32)
+    
+    timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    stage_prefix = f"{STAGE_NAME}/stations_opt_{len(selected_stations)}_{timestamp}"
+    try:
+        result["artifacts"] = save_artifacts(session, stage_prefix, {
+            "stations": pd.concat([station_table(run) for run in sweep], ignore_index=True),
+            "cells": cell_table,
+            "curve": pd.concat([curve_table(run) for run in sweep], ignore_index=True),
+        })
+    except Exception as e:
+        print(f"[WARN] Could not save artifacts to stage: {str(e)}")
+    # Encoding and uploading this manifest itself is the only untimed work
+    timer.mark("serialization", cells=len(cell_table))
+    result["optimization_stats"]["phases"] = timer.summary()
     
-    # Step 8: Efficient result storage
+    result_json = json.dumps(result, separators=('','', '':''))  # Compact JSON
     try:
-        json_str = json.dumps(result, separators=('','', '':''))  # Compact JSON
-        json_file = BytesIO(json_str.encode("utf-8"))
-        timestamp = datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")
-        filename = f"stations_opt_{len(selected_stations)}_{timestamp}.json"
-        session.file.put_stream(json_file, f"{STAGE_NAME}/{filename}", overwrite=True)
-        print(f"[INFO] Results saved to {STAGE_NAME}/{filename}")
+        session.file.put_stream(BytesIO(result_json.encode("utf-8")), f"{stage_prefix}/result.json", overwrite=True)
+        print(f"[INFO] Results saved to {stage_prefix}")
     except Exception as e:
         print(f"[WARN] Could not save to stage: {str(e)}")
     
     print(f"[INFO] Total optimization time: {total_time:.2f}s, "
           f"Stations: {len(selected_stations)}, Coverage: {coverage_pct*100:.2f}%")
     
-    return json.dumps(result)
+    return result_json
 ';
\ No newline at end of file
@@ -0,0 +1,292 @@
+"""
+Benchmark the coverage-optimization procedures offline.
+
+Runs main() of each procedure against a LocalSession over synthetic GPS data
+at several H3-cell counts and reports wall time per phase:
+
+    aggregation    SQL executed by the session (filter, H3 group-by, fetch)
+    tree_build     cKDTree / BallTree construction
+    coverage       candidate coverage precomputation and coverage checks
+    greedy         station selection
+    serialization  json / Parquet encoding and stage uploads
+    other          everything else inside main()
+
+Phases are self-time: a tree built inside the greedy loop counts as
+tree_build, not greedy.  The OPTIMIZED proc runs its greedy loop inline in
+main(), so for it greedy is the unattributed remainder of main().
+
+Each (size, proc) run happens in a fresh process so peak RSS is per run.
+
+    python procs/bench/bench_coverage.py --sizes 10000 100000 1000000
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR))
+
+PHASES = ("aggregation", "tree_build", "coverage", "greedy", "serialization", "other")
+
+PROCS = {
+    "COST": {
+        "file": "COVERAGE_OPTIMIZATION_STATIONS_COST.py",
+        "functions": {"optimized_greedy_cover": "greedy", "assign_cells": "coverage",
+                      "save_artifacts": "serialization"},
+        "remainder": "other",
+        "kwargs": lambda cfg: {},
+    },
+    "COST_OPTIMIZED": {
+        "file": "COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED.py",
+        "functions": {"save_artifacts": "serialization"},
+        "remainder": "greedy",
+        "kwargs": lambda cfg: {"H3_RESOLUTION": cfg["resolution"]},
+    },
+    "COST_OPTIMIZED_V2": {
+        "file": "COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED_V2.py",
+        "functions": {"efficient_coverage_precomputation": "coverage",
+                      "optimized_greedy_selection": "greedy",
+                      "save_artifacts": "serialization"},
+        "remainder": "other",
+        "kwargs": lambda cfg: {"H3_RESOLUTION": cfg["resolution"], "MAX_DATA_POINTS": cfg["size"]},
+    },
+}
+
+
+class PhaseClock:
+    """Accumulates exclusive (self) wall time per phase."""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self._stack = []
+
+    def enter(self, phase):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def exit(self):
+        phase, start, child = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.seconds[phase] += elapsed - child
+        self.calls[phase] += 1
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def wrap(self, phase, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            self.enter(phase)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed
+
+    def wrap_iter(self, phase, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            iterator = iter(fn(*args, **kwargs))
+            while True:
+                self.enter(phase)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.exit()
+                yield item
+        return timed
+
+
+class TreeProxy:
+    """Times construction and radius queries of a spatial index."""
+
+    def __init__(self, clock, cls, *args, **kwargs):
+        clock.enter("tree_build")
+        try:
+            self._tree = cls(*args, **kwargs)
+        finally:
+            clock.exit()
+        for method in ("query_ball_point", "query_radius", "query"):
+            if hasattr(self._tree, method):
+                setattr(self, method, clock.wrap("coverage", getattr(self._tree, method)))
+
+    def __getattr__(self, name):
+        return getattr(self._tree, name)
+
+
+def instrument(module, session, clock, spec):
+    ns = module.__dict__
+    for name, phase in spec["functions"].items():
+        if name in ns:
+            ns[name] = clock.wrap(phase, ns[name])
+    for name in ("cKDTree", "BallTree"):
+        if name in ns:
+            ns[name] = functools.partial(TreeProxy, clock, ns[name])
+    if "json" in ns:
+        real_json = ns["json"]
+        proxy = types.SimpleNamespace(**{k: getattr(real_json, k) for k in dir(real_json) if not k.startswith("__")})
+        proxy.dumps = clock.wrap("serialization", real_json.dumps)
+        proxy.dump = clock.wrap("serialization", real_json.dump)
+        ns["json"] = proxy
+    session._execute = clock.wrap("aggregation", session._execute)
+    session._execute_batches = clock.wrap_iter("aggregation", session._execute_batches)
+    for name in ("put", "put_stream"):
+        setattr(session.file, name, clock.wrap("serialization", getattr(session.file, name)))
+
+
+def proc_args(cfg, stage_name):
+    return (cfg["service_radius"], cfg["min_separation"], cfg["coverage_target"],
+            cfg["max_stations"], 8, stage_name, None, None, "NULL", "NULL", "NULL")
+
+
+def summarize(raw):
+    try:
+        result = json.loads(raw)
+    except (TypeError, ValueError):
+        return {}
+    coverage = result.get("coverage_percentage", result.get("coverage"))
+    stats = result.get("optimization_stats") or result.get("compute_metrics") or {}
+    return {
+        "stations": len(result.get("stations", [])),
+        "coverage": coverage,
+        "points": stats.get("data_points_processed", stats.get("points_processed")),
+        "reported_phases": stats.get("phases", {}),
+    }
+
+
+def run_one(proc, cfg, data_path, queue):
+    """Child-process entry point: load, instrument and time one proc run."""
+    import contextlib
+    import io
+
+    from local_session import LocalSession
+    from proc_loader import PROCS_DIR, load_procedure
+
+    spec = PROCS[proc]
+    outcome = {"proc": proc, "size": cfg["size"]}
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_stage_") as stage_dir:
+            session = LocalSession.from_parquet(data_path, stage_dir=stage_dir)
+            module = load_procedure(PROCS_DIR / spec["file"])
+            clock = PhaseClock()
+            instrument(module, session, clock, spec)
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            log = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(log):
+                raw = module.main(session, *proc_args(cfg, "@BENCH_STAGE"), **spec["kwargs"](cfg))
+            total = time.perf_counter() - start
+
+            phases = {p: clock.seconds.get(p, 0.0) for p in PHASES}
+            phases[spec["remainder"]] += total - sum(clock.seconds.values())
+            outcome.update(
+                status="ok",
+                total=total,
+                phases=phases,
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                rss_delta_mb=(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0,
+                **summarize(raw),
+            )
+    except Exception as exc:  # report and keep benchmarking the other procs
+        outcome.update(status="error", error=f"{type(exc).__name__}: {exc}")
+    queue.put(outcome)
+
+
+def ensure_dataset(data_dir, size, resolution, seed):
+    from synthetic import write_gps_parquet
+
+    path = Path(data_dir) / f"gps_{size}_r{resolution}_s{seed}.parquet"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        rows = write_gps_parquet(path, size, resolution=resolution, seed=seed)
+        print(f"[INFO] Generated {path.name}: {size} cells, {rows} rows")
+    return path
+
+
+def run_benchmark(sizes, procs, cfg, data_dir, timeout, repeat):
+    from synthetic import resolution_for
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size in sizes:
+        run_cfg = dict(cfg, size=size, resolution=resolution_for(size))
+        data_path = ensure_dataset(data_dir, size, run_cfg["resolution"], cfg["seed"])
+        for proc in procs:
+            for _ in range(repeat):
+                queue = ctx.Queue()
+                child = ctx.Process(target=run_one, args=(proc, run_cfg, str(data_path), queue))
+                child.start()
+                child.join(timeout)
+                if child.is_alive():
+                    child.terminate()
+                    child.join()
+                    outcome = {"proc": proc, "size": size, "status": "timeout", "total": timeout}
+                elif queue.empty():
+                    outcome = {"proc": proc, "size": size, "status": "crashed", "exitcode": child.exitcode}
+                else:
+                    outcome = queue.get()
+                results.append(outcome)
+                print_row(outcome)
+    return results
+
+
+def print_header():
+    cols = ["size", "proc", "status", "total_s"] + [f"{p}_s" for p in PHASES] + ["rss_mb", "stations", "coverage"]
+    print(" | ".join(f"{c:>17}" if i == 1 else f"{c:>12}" for i, c in enumerate(cols)))
+
+
+def print_row(r):
+    phases = r.get("phases", {})
+    cells = [str(r["size"]), r["proc"], r["status"], f"{r.get('total', float('nan')):.2f}"]
+    cells += [f"{phases[p]:.2f}" if p in phases else "-" for p in PHASES]
+    coverage = r.get("coverage")
+    cells += [f"{r['peak_rss_mb']:.0f}" if "peak_rss_mb" in r else "-",
+              str(r.get("stations", "-")),
+              f"{coverage * 100:.2f}%" if isinstance(coverage, (int, float)) else "-"]
+    print(" | ".join(f"{c:>17}" if i == 1 else f"{c:>12}" for i, c in enumerate(cells)), flush=True)
+    if r["status"] == "error":
+        print(f"    {r['error']}", flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                        help="number of distinct H3 cells in the synthetic table")
+    parser.add_argument("--procs", nargs="+", choices=sorted(PROCS), default=sorted(PROCS))
+    parser.add_argument("--data-dir", default=str(BENCH_DIR / ".data"))
+    parser.add_argument("--timeout", type=float, default=1800.0, help="seconds per proc run")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--service-radius", type=float, default=2.0)
+    parser.add_argument("--min-separation", type=float, default=1.0)
+    parser.add_argument("--coverage-target", type=float, default=0.9)
+    parser.add_argument("--max-stations", type=int, default=50)
+    parser.add_argument("--json", help="write raw results to this file")
+    args = parser.parse_args(argv)
+
+    cfg = {
+        "seed": args.seed,
+        "service_radius": args.service_radius,
+        "min_separation": args.min_separation,
+        "coverage_target": args.coverage_target,
+        "max_stations": args.max_stations,
+    }
+    print_header()
+    results = run_benchmark(args.sizes, args.procs, cfg, args.data_dir, args.timeout, args.repeat)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    return 0 if all(r["status"] == "ok" for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
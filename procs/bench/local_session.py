@@ -0,0 +1,445 @@
+"""
+Local stand-in for the subset of the Snowpark API used by the coverage procs.
+
+LocalSession answers session.sql / session.table / session.file from a DuckDB
+connection and a directory that plays the role of the internal stage; LIST
+and REMOVE statements on a stage path are served from that directory.  Every
+LocalDataFrame is just a SQL string; operations wrap it in a subquery and
+to_pandas() executes it, so the procs run the same query shapes they would
+send to the warehouse.
+
+Snowflake's H3_LATLNG_TO_CELL is replaced by pseudo_h3_cell(), a square grid
+whose cells have the average area of the H3 cells at the same resolution.
+That keeps cell counts realistic without requiring the h3 bindings.
+"""
+import datetime
+import gzip
+import shutil
+import sys
+import tempfile
+import time
+import types
+from io import BytesIO
+from pathlib import Path
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+GPS_TABLE = "REPORT_DB.GPS_DASHBOARD.TBOX_GPS_ENRICHED"
+
+# Average H3 hexagon area in km^2 per resolution
+H3_CELL_AREA_KM2 = {
+    5: 252.9, 6: 36.13, 7: 5.161, 8: 0.7373, 9: 0.1053,
+    10: 0.01504, 11: 0.002149, 12: 0.0003071, 13: 0.00004387,
+}
+KM_PER_DEG_LAT = 111.32
+
+
+class LocalSnowparkError(Exception):
+    """Raised where Snowpark would raise a SnowparkSQLException."""
+
+
+def pseudo_h3_cell(lat, lon, resolution):
+    """Vectorized grid-cell id with H3-like cell area for the given resolution."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    side_km = np.sqrt(H3_CELL_AREA_KM2[int(resolution)])
+    dlat = side_km / KM_PER_DEG_LAT
+    row = np.floor((lat + 90.0) / dlat)
+    row_lat = np.radians(row * dlat - 90.0 + dlat / 2)
+    dlon = dlat / np.maximum(np.cos(row_lat), 1e-6)
+    col = np.floor((lon + 180.0) / dlon)
+    return (int(resolution) << 56) | (row.astype(np.int64) << 28) | col.astype(np.int64)
+
+
+def pseudo_h3_cell_center(cells):
+    """Inverse of pseudo_h3_cell: centre (lat, lon) of each cell id."""
+    cells = np.asarray(cells, dtype=np.int64)
+    resolution = cells >> 56
+    row = (cells >> 28) & ((1 << 28) - 1)
+    col = cells & ((1 << 28) - 1)
+    side_km = np.sqrt(np.vectorize(H3_CELL_AREA_KM2.get)(resolution))
+    dlat = side_km / KM_PER_DEG_LAT
+    lat = row * dlat - 90.0 + dlat / 2
+    dlon = dlat / np.maximum(np.cos(np.radians(lat)), 1e-6)
+    lon = col * dlon - 180.0 + dlon / 2
+    return lat, lon
+
+
+def _h3_udf(lat, lon, resolution):
+    import pyarrow as pa
+    res = resolution.to_numpy()
+    return pa.array(pseudo_h3_cell(lat.to_numpy(zero_copy_only=False),
+                                   lon.to_numpy(zero_copy_only=False), res[0] if len(res) else 7))
+
+
+def sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, LocalColumn):
+        return value.sql
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return repr(value.item() if hasattr(value, "item") else value)
+    if isinstance(value, (datetime.datetime, pd.Timestamp)):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, datetime.date):
+        return f"DATE '{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class LocalColumn:
+    """SQL expression builder mirroring snowflake.snowpark.Column."""
+
+    def __init__(self, sql, name=None):
+        self.sql = sql
+        self.name = name
+
+    def _binary(self, op, other):
+        return LocalColumn(f"({self.sql} {op} {sql_literal(other)})")
+
+    def __ge__(self, other):
+        return self._binary(">=", other)
+
+    def __gt__(self, other):
+        return self._binary(">", other)
+
+    def __le__(self, other):
+        return self._binary("<=", other)
+
+    def __lt__(self, other):
+        return self._binary("<", other)
+
+    def __eq__(self, other):
+        return self._binary("=", other)
+
+    def __ne__(self, other):
+        return self._binary("<>", other)
+
+    def __and__(self, other):
+        return self._binary("AND", other)
+
+    def __or__(self, other):
+        return self._binary("OR", other)
+
+    def __invert__(self):
+        return LocalColumn(f"(NOT {self.sql})")
+
+    def __hash__(self):
+        return hash(self.sql)
+
+    def isin(self, *values):
+        if len(values) == 1 and isinstance(values[0], (list, tuple, set)):
+            values = tuple(values[0])
+        if not values:
+            return LocalColumn("FALSE")
+        return LocalColumn(f"({self.sql} IN ({', '.join(sql_literal(v) for v in values)}))")
+
+    def between(self, lower, upper):
+        return LocalColumn(f"({self.sql} BETWEEN {sql_literal(lower)} AND {sql_literal(upper)})")
+
+    def alias(self, name):
+        return LocalColumn(self.sql, name=name)
+
+    as_ = alias
+
+    def select_sql(self):
+        return f"{self.sql} AS {self.name}" if self.name else self.sql
+
+
+def col(name):
+    return LocalColumn(name, name=None)
+
+
+def lit(value):
+    return LocalColumn(sql_literal(value))
+
+
+def avg(column):
+    return LocalColumn(f"AVG({_expr(column)})")
+
+
+def count(column):
+    return LocalColumn(f"COUNT({_expr(column)})")
+
+
+def sum_(column):
+    return LocalColumn(f"SUM({_expr(column)})")
+
+
+def min_(column):
+    return LocalColumn(f"MIN({_expr(column)})")
+
+
+def max_(column):
+    return LocalColumn(f"MAX({_expr(column)})")
+
+
+def _expr(column):
+    return column.sql if isinstance(column, LocalColumn) else str(column)
+
+
+def install_snowpark_functions():
+    """
+    Register this module's column functions as snowflake.snowpark.functions.
+
+    Procs import Snowpark helpers at module level; the local session only
+    understands its own LocalColumn, so the shim always takes precedence.
+    """
+    functions = types.ModuleType("snowflake.snowpark.functions")
+    for name, fn in (("col", col), ("lit", lit), ("avg", avg), ("count", count),
+                     ("sum", sum_), ("min", min_), ("max", max_)):
+        setattr(functions, name, fn)
+    snowpark = sys.modules.get("snowflake.snowpark") or types.ModuleType("snowflake.snowpark")
+    snowflake = sys.modules.get("snowflake") or types.ModuleType("snowflake")
+    snowpark.functions = functions
+    snowflake.snowpark = snowpark
+    sys.modules.update({
+        "snowflake": snowflake,
+        "snowflake.snowpark": snowpark,
+        "snowflake.snowpark.functions": functions,
+    })
+    return functions
+
+
+class LocalDataFrame:
+    """Lazily evaluated query, mirroring snowflake.snowpark.DataFrame."""
+
+    def __init__(self, session, sql):
+        self._session = session
+        self._sql = sql
+
+    @property
+    def queries(self):
+        return {"queries": [self._sql], "post_actions": []}
+
+    def __getitem__(self, name):
+        return col(name)
+
+    def col(self, name):
+        return col(name)
+
+    def filter(self, expr):
+        return LocalDataFrame(self._session, f"SELECT * FROM ({self._sql}) WHERE {_expr(expr)}")
+
+    where = filter
+
+    def select(self, *cols):
+        if len(cols) == 1 and isinstance(cols[0], (list, tuple)):
+            cols = cols[0]
+        items = ", ".join(c.select_sql() if isinstance(c, LocalColumn) else c for c in cols)
+        return LocalDataFrame(self._session, f"SELECT {items} FROM ({self._sql})")
+
+    def group_by(self, *cols):
+        if len(cols) == 1 and isinstance(cols[0], (list, tuple)):
+            cols = cols[0]
+        return LocalGroupBy(self, [_expr(c) for c in cols])
+
+    groupBy = group_by
+
+    def sample(self, frac=None, n=None):
+        if (frac is None) == (n is None):
+            raise ValueError("'frac' and 'n' cannot both be None or both be specified")
+        if frac is not None:
+            if frac < 0.0 or frac > 1.0:
+                raise ValueError(f"'frac' value {frac} is out of range (0 <= probability_fraction <= 1)")
+            return LocalDataFrame(self._session,
+                                  f"SELECT * FROM ({self._sql}) USING SAMPLE {frac * 100.0} PERCENT (bernoulli)")
+        return LocalDataFrame(self._session, f"SELECT * FROM ({self._sql}) USING SAMPLE {int(n)} ROWS")
+
+    def limit(self, n):
+        return LocalDataFrame(self._session, f"SELECT * FROM ({self._sql}) LIMIT {int(n)}")
+
+    def count(self):
+        return int(self._session._execute(f"SELECT COUNT(*) AS N FROM ({self._sql})").iloc[0, 0])
+
+    def to_pandas(self):
+        return self._session._execute(self._sql)
+
+    def to_pandas_batches(self):
+        yield from self._session._execute_batches(self._sql)
+
+    def collect(self):
+        return list(self.to_pandas().itertuples(index=False))
+
+
+class LocalGroupBy:
+    def __init__(self, df, keys):
+        self._df = df
+        self._keys = keys
+
+    def agg(self, *exprs):
+        if len(exprs) == 1 and isinstance(exprs[0], (list, tuple)):
+            exprs = exprs[0]
+        keys = ", ".join(self._keys)
+        items = ", ".join([keys] + [e.select_sql() for e in exprs])
+        return LocalDataFrame(self._df._session,
+                              f"SELECT {items} FROM ({self._df._sql}) GROUP BY {keys}")
+
+    def count(self):
+        return self.agg(LocalColumn("COUNT(*)", name="COUNT"))
+
+
+class LocalResult:
+    """Already-materialized result of a stage command (LIST, REMOVE)."""
+
+    def __init__(self, pdf):
+        self._pdf = pdf
+
+    def to_pandas(self):
+        return self._pdf.copy()
+
+    def collect(self):
+        return list(self._pdf.itertuples(index=False))
+
+
+class LocalFileOperation:
+    """session.file backed by a local directory per stage."""
+
+    def __init__(self, stage_root):
+        self._root = Path(stage_root)
+
+    def _path(self, stage_location):
+        location = stage_location.lstrip("@").strip("/")
+        stage, _, rest = location.partition("/")
+        return self._root / stage.split(".")[-1].upper() / rest
+
+    def put(self, local_file_name, stage_location, auto_compress=True, overwrite=False, **kwargs):
+        source = Path(local_file_name)
+        target_dir = self._path(stage_location)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        target = target_dir / (source.name + (".gz" if auto_compress else ""))
+        if target.exists() and not overwrite:
+            return [{"source": source.name, "target": target.name, "status": "SKIPPED"}]
+        if auto_compress:
+            with open(source, "rb") as src, gzip.open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            shutil.copyfile(source, target)
+        return [{"source": source.name, "target": target.name, "status": "UPLOADED"}]
+
+    def put_stream(self, input_stream, stage_location, auto_compress=True, overwrite=False, **kwargs):
+        target = self._path(stage_location)
+        if auto_compress:
+            target = target.with_name(target.name + ".gz")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.exists() and not overwrite:
+            return {"target": target.name, "status": "SKIPPED"}
+        data = input_stream.read()
+        target.write_bytes(gzip.compress(data) if auto_compress else data)
+        return {"target": target.name, "status": "UPLOADED"}
+
+    def list(self, stage_location):
+        """Rows shaped like Snowflake's LIST output for files under a prefix."""
+        prefix = self._path(stage_location)
+        base = prefix if prefix.is_dir() else prefix.parent
+        rows = []
+        if base.exists():
+            for path in sorted(base.rglob("*")):
+                if path.is_file() and str(path).startswith(str(prefix)):
+                    stat = path.stat()
+                    modified = datetime.datetime.fromtimestamp(stat.st_mtime, tz=datetime.timezone.utc)
+                    rows.append({
+                        "name": str(path.relative_to(self._root)).lower(),
+                        "size": stat.st_size,
+                        "md5": "",
+                        "last_modified": modified.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+                    })
+        return pd.DataFrame(rows, columns=["name", "size", "md5", "last_modified"])
+
+    def remove(self, stage_location):
+        listing = self.list(stage_location)
+        for name in listing["name"]:
+            matches = [p for p in self._root.rglob("*") if str(p.relative_to(self._root)).lower() == name]
+            for path in matches:
+                path.unlink()
+        return pd.DataFrame({"name": listing["name"], "result": "removed"})
+
+    def get_stream(self, stage_location, decompress=False, **kwargs):
+        target = self._path(stage_location)
+        if not target.exists():
+            raise LocalSnowparkError(f"File '{stage_location}' does not exist or not authorized")
+        data = target.read_bytes()
+        return BytesIO(gzip.decompress(data) if decompress and target.suffix == ".gz" else data)
+
+
+class LocalSession:
+    """
+    Minimal Snowpark session over DuckDB.
+
+    Tables are registered with their fully qualified Snowflake names so the
+    procs' SQL can reference them verbatim.  Every executed statement is
+    appended to query_history as (sql, seconds, rows).
+    """
+
+    def __init__(self, stage_dir=None, warehouse="LOCAL_WH"):
+        self._con = duckdb.connect()
+        self._con.create_function("H3_LATLNG_TO_CELL", _h3_udf,
+                                  ["DOUBLE", "DOUBLE", "INTEGER"], "BIGINT", type="arrow")
+        self._warehouse = warehouse
+        self._stage_dir = Path(stage_dir) if stage_dir else Path(tempfile.mkdtemp(prefix="local_stage_"))
+        self.file = LocalFileOperation(self._stage_dir)
+        self.query_history = []
+        install_snowpark_functions()
+
+    @classmethod
+    def from_parquet(cls, path, table=GPS_TABLE, **kwargs):
+        session = cls(**kwargs)
+        session.register_table(table, path)
+        return session
+
+    @property
+    def stage_dir(self):
+        return self._stage_dir
+
+    def register_table(self, name, source):
+        """Expose a Parquet file/glob or a pandas DataFrame as table `name`."""
+        parts = name.split(".")
+        if len(parts) == 3:
+            self._con.execute(f"ATTACH IF NOT EXISTS ':memory:' AS {parts[0]}")
+            self._con.execute(f"CREATE SCHEMA IF NOT EXISTS {parts[0]}.{parts[1]}")
+        if isinstance(source, pd.DataFrame):
+            tmp = "_src_" + parts[-1].lower()
+            self._con.register(tmp, source)
+            self._con.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM {tmp}")
+            self._con.unregister(tmp)
+        else:
+            self._con.execute(f"CREATE OR REPLACE VIEW {name} AS SELECT * FROM read_parquet({sql_literal(str(source))})")
+
+    def table(self, name):
+        return LocalDataFrame(self, f"SELECT * FROM {name}")
+
+    def sql(self, query):
+        query = query.strip().rstrip(";")
+        command, _, location = query.partition(" ")
+        if command.upper() in ("LIST", "LS"):
+            return LocalResult(self.file.list(location.strip()))
+        if command.upper() in ("REMOVE", "RM"):
+            return LocalResult(self.file.remove(location.strip()))
+        return LocalDataFrame(self, query)
+
+    def get_current_warehouse(self):
+        return self._warehouse
+
+    def _execute(self, query):
+        start = time.perf_counter()
+        pdf = self._con.sql(query).df()
+        pdf.columns = [c.upper() for c in pdf.columns]
+        self.query_history.append((query, time.perf_counter() - start, len(pdf)))
+        return pdf
+
+    def _execute_batches(self, query, batch_size=100_000):
+        start = time.perf_counter()
+        rows = 0
+        reader = self._con.sql(query).to_arrow_reader(batch_size)
+        for batch in reader:
+            pdf = batch.to_pandas()
+            pdf.columns = [c.upper() for c in pdf.columns]
+            rows += len(pdf)
+            yield pdf
+        self.query_history.append((query, time.perf_counter() - start, rows))
+
+    def close(self):
+        self._con.close()
@@ -0,0 +1,96 @@
+"""
+Load the Python handler out of a Snowflake CREATE PROCEDURE script.
+
+The files in procs/ are deployable DDL: the handler source lives inside a
+single-quoted SQL string literal, so every quote is doubled and backslash
+escapes are interpreted by Snowflake.  load_procedure() undoes that quoting
+and executes the body as a regular module so main() can be called locally.
+
+Files listed in IMPORTS are put on sys.path by Snowflake; locally they are
+resolved by file name next to the procedure file (procs/coverage_engine.py).
+"""
+import re
+import sys
+import types
+from pathlib import Path
+
+PROCS_DIR = Path(__file__).resolve().parent.parent
+
+_HEADER_RE = re.compile(r"CREATE\s+OR\s+REPLACE\s+PROCEDURE\s+([\w.]+)\s*\(", re.IGNORECASE)
+_PACKAGES_RE = re.compile(r"PACKAGES\s*=\s*\(([^)]*)\)", re.IGNORECASE)
+_IMPORTS_RE = re.compile(r"IMPORTS\s*=\s*\(([^)]*)\)", re.IGNORECASE)
+_HANDLER_RE = re.compile(r"HANDLER\s*=\s*'([^']+)'", re.IGNORECASE)
+_BODY_START_RE = re.compile(r"^AS\s+'", re.MULTILINE)
+
+_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f", "0": "\0", "'": "'", '"': '"', "\\": "\\"}
+
+
+def unescape_sql_literal(text):
+    """Decode the contents of a Snowflake single-quoted string literal."""
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == "'" and i + 1 < n and text[i + 1] == "'":
+            out.append("'")
+            i += 2
+        elif ch == "\\" and i + 1 < n:
+            nxt = text[i + 1]
+            out.append(_ESCAPES.get(nxt, nxt))
+            i += 2
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def split_procedure(ddl):
+    """Return (metadata, python_source) for a CREATE PROCEDURE script."""
+    header = _HEADER_RE.search(ddl)
+    start = _BODY_START_RE.search(ddl)
+    end = ddl.rstrip().rfind("';")
+    if not header or not start or end <= start.end():
+        raise ValueError("Not a CREATE PROCEDURE ... AS '<python>'; script")
+
+    preamble = ddl[:start.start()]
+    packages = _PACKAGES_RE.search(preamble)
+    imports = _IMPORTS_RE.search(preamble)
+    handler = _HANDLER_RE.search(preamble)
+    meta = {
+        "name": header.group(1),
+        "packages": [p.strip().strip("'") for p in packages.group(1).split(",")] if packages else [],
+        "imports": [i.strip().strip("'") for i in imports.group(1).split(",")] if imports else [],
+        "handler": handler.group(1) if handler else "main",
+    }
+    return meta, unescape_sql_literal(ddl[start.end():end])
+
+
+def load_procedure(path):
+    """
+    Execute a procedure file as a module and return it.
+
+    The module is registered in sys.modules under a stable name so that
+    functions defined in it stay picklable for multiprocessing workers.
+    The returned module carries the parsed DDL metadata as __procedure__.
+    Stage IMPORTS must exist next to the procedure file, whose directory
+    is added to sys.path.
+    """
+    path = Path(path)
+    if not path.is_absolute() and not path.exists():
+        path = PROCS_DIR / path
+    meta, source = split_procedure(path.read_text(encoding="utf-8"))
+    for stage_file in meta["imports"]:
+        local = path.parent / stage_file.rsplit("/", 1)[-1]
+        if not local.exists():
+            raise FileNotFoundError(f"{path.name} imports {stage_file}, but {local} does not exist")
+    if meta["imports"] and str(path.parent) not in sys.path:
+        sys.path.insert(0, str(path.parent))
+
+    module_name = "proc_" + path.stem.lower()
+    module = types.ModuleType(module_name)
+    module.__file__ = str(path)
+    module.__procedure__ = meta
+    sys.modules[module_name] = module
+    exec(compile(source, str(path), "exec"), module.__dict__)
+    return module
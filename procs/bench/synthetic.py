@@ -0,0 +1,99 @@
+"""
+Synthetic TBOX_GPS_ENRICHED data for offline runs.
+
+Traffic is drawn from a mixture of Gaussians centred on Sri Lankan towns,
+so the density contrast (dense Colombo core, sparse interior) resembles the
+real table.  Rows are generated until the requested number of distinct
+pseudo-H3 cells exists at the chosen resolution.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from local_session import H3_CELL_AREA_KM2, KM_PER_DEG_LAT, pseudo_h3_cell, pseudo_h3_cell_center
+
+# (name, lat, lon, sigma_km, share, province, district)
+HOTSPOTS = [
+    ("Colombo", 6.9271, 79.8612, 8.0, 0.34, "Western Province", "Colombo"),
+    ("Gampaha", 7.0873, 79.9990, 10.0, 0.14, "Western Province", "Gampaha"),
+    ("Kalutara", 6.5854, 79.9607, 9.0, 0.08, "Western Province", "Kalutara"),
+    ("Kandy", 7.2906, 80.6337, 9.0, 0.09, "Central Province", "Kandy"),
+    ("Kurunegala", 7.4863, 80.3647, 12.0, 0.07, "North Western Province", "Kurunegala"),
+    ("Galle", 6.0535, 80.2210, 9.0, 0.06, "Southern Province", "Galle"),
+    ("Matara", 5.9549, 80.5550, 8.0, 0.04, "Southern Province", "Matara"),
+    ("Ratnapura", 6.6828, 80.3992, 10.0, 0.04, "Sabaragamuwa Province", "Ratnapura"),
+    ("Anuradhapura", 8.3114, 80.4037, 14.0, 0.04, "North Central Province", "Anuradhapura"),
+    ("Jaffna", 9.6615, 80.0255, 10.0, 0.04, "Northern Province", "Jaffna"),
+    ("Batticaloa", 7.7310, 81.6747, 10.0, 0.03, "Eastern Province", "Batticaloa"),
+    ("Badulla", 6.9934, 81.0550, 10.0, 0.03, "Uva Province", "Badulla"),
+]
+
+# Resolution giving enough distinct cells for a target cell count
+DEFAULT_RESOLUTION = ((20_000, 8), (200_000, 10), (2_000_000, 11))
+
+
+def resolution_for(n_cells):
+    for limit, resolution in DEFAULT_RESOLUTION:
+        if n_cells <= limit:
+            return resolution
+    return 12
+
+
+def _draw_points(rng, n):
+    shares = np.array([h[4] for h in HOTSPOTS])
+    hotspot = rng.choice(len(HOTSPOTS), size=n, p=shares / shares.sum())
+    centre = np.array([[h[1], h[2]] for h in HOTSPOTS])[hotspot]
+    # Heavy-tailed spread so suburbs and corridors get sparse traffic too
+    sigma_deg = np.array([h[3] for h in HOTSPOTS])[hotspot] / 111.32
+    scale = sigma_deg * rng.standard_t(4, size=n)
+    angle = rng.uniform(0, 2 * np.pi, size=n)
+    lat = centre[:, 0] + scale * np.sin(angle)
+    lon = centre[:, 1] + scale * np.cos(angle) / np.cos(np.radians(centre[:, 0]))
+    return hotspot, lat, lon
+
+
+def generate_gps_table(n_cells, resolution=None, seed=0,
+                       start=datetime.datetime(2025, 1, 1), days=90):
+    """Return a DataFrame shaped like TBOX_GPS_ENRICHED with ~n_cells cells."""
+    rng = np.random.default_rng(seed)
+    resolution = resolution or resolution_for(n_cells)
+
+    cells = np.empty(0, dtype=np.int64)
+    cell_hotspot = np.empty(0, dtype=np.int64)
+    while len(cells) < n_cells:
+        hotspot, lat, lon = _draw_points(rng, max(2 * (n_cells - len(cells)), 1000))
+        drawn = pseudo_h3_cell(lat, lon, resolution)
+        merged = np.concatenate([cells, drawn])
+        owner = np.concatenate([cell_hotspot, hotspot])
+        cells, first = np.unique(merged, return_index=True)
+        cell_hotspot = owner[first]
+    keep = rng.choice(len(cells), size=n_cells, replace=False)
+    cells, cell_hotspot = cells[keep], cell_hotspot[keep]
+
+    # Rows per cell: geometric, so a few cells carry most of the traffic
+    rows_per_cell = rng.geometric(0.35, size=n_cells)
+    cell_idx = np.repeat(np.arange(n_cells), rows_per_cell)
+    lat_c, lon_c = pseudo_h3_cell_center(cells)
+    # Keep rows well inside their cell so aggregation reproduces n_cells
+    jitter = 0.25 * np.sqrt(H3_CELL_AREA_KM2[resolution]) / KM_PER_DEG_LAT
+    n_rows = len(cell_idx)
+    lat = lat_c[cell_idx] + rng.uniform(-jitter, jitter, n_rows)
+    lon = lon_c[cell_idx] + rng.uniform(-jitter, jitter, n_rows)
+
+    hot = cell_hotspot[cell_idx]
+    timestamps = pd.Timestamp(start) + pd.to_timedelta(rng.uniform(0, days * 86400, n_rows), unit="s")
+    return pd.DataFrame({
+        "MEAN_LAT": lat,
+        "MEAN_LONG": lon,
+        "MEAN_TIMESTAMP": timestamps,
+        "AREA": np.array([h[0] for h in HOTSPOTS])[hot],
+        "PROVINCE": np.array([h[5] for h in HOTSPOTS])[hot],
+        "DISTRICT": np.array([h[6] for h in HOTSPOTS])[hot],
+    })
+
+
+def write_gps_parquet(path, n_cells, resolution=None, seed=0):
+    df = generate_gps_table(n_cells, resolution=resolution, seed=seed)
+    df.to_parquet(path, index=False)
+    return len(df)
@@ -0,0 +1,364 @@
+"""
+Exactness and behaviour checks of the coverage procs on synthetic data, run
+through LocalSession and proc_loader like bench_coverage.py:
+
+    python -m pytest procs/bench -q
+"""
+import contextlib
+import gzip
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial import cKDTree
+
+from local_session import GPS_TABLE, LocalSession
+from proc_loader import PROCS_DIR, load_procedure
+from synthetic import generate_gps_table
+
+N_CELLS = 3000
+RESOLUTION = 8
+# Selection parameters under which no stopping rule but MAX_STATIONS applies
+SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS = 2.0, 1.0, 1.0, 40
+OPTIONS = dict(H3_RESOLUTION=RESOLUTION, MAX_DATA_POINTS=N_CELLS * 2, EARLY_TERMINATION_THRESHOLD=0)
+
+
+@pytest.fixture(scope="module")
+def v2():
+    return load_procedure(PROCS_DIR / "COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED_V2.py")
+
+
+@pytest.fixture(scope="module")
+def gps_table():
+    return generate_gps_table(N_CELLS, resolution=RESOLUTION, seed=0)
+
+
+@pytest.fixture
+def session(gps_table, tmp_path):
+    session = LocalSession(stage_dir=tmp_path / "stage")
+    session.register_table(GPS_TABLE, gps_table)
+    return session
+
+
+def call(proc, session, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return json.loads(proc.main(session, *args, **kwargs))
+
+
+def run_v2(v2, session, service_radius=SERVICE_RADIUS, max_stations=MAX_STATIONS, **kwargs):
+    return call(v2, session, service_radius, MIN_SEPARATION, COVERAGE_TARGET, max_stations, 8, "@S",
+                None, None, "NULL", "NULL", "NULL", **{"USE_COVERAGE_CACHE": False, **OPTIONS, **kwargs})
+
+
+def station_table(session, result):
+    return pd.read_parquet(session.stage_dir / result["artifacts"]["stations"].lstrip("@"))
+
+
+def coordinates(stations):
+    return [(s["lat"], s["lon"]) for s in stations]
+
+
+def brute_force_greedy(candidates_xyz, weights, indptr, indices, separation_chord, max_stations):
+    """Textbook greedy: re-evaluate every live candidate before every pick"""
+    covered = np.zeros(len(weights), dtype=bool)
+    alive = np.ones(len(candidates_xyz), dtype=bool)
+    selected = []
+    while len(selected) < max_stations:
+        gains = np.array([weights[p[~covered[p]]].sum() if alive[c] else -np.inf
+                          for c, p in enumerate(np.split(indices, indptr[1:-1]))])
+        best = int(np.argmax(gains))
+        if gains[best] <= 0:
+            break
+        selected.append(best)
+        covered[indices[indptr[best]:indptr[best + 1]]] = True
+        alive &= np.linalg.norm(candidates_xyz - candidates_xyz[best], axis=1) >= separation_chord
+    return selected
+
+
+@pytest.mark.parametrize("min_separation", [0.0, 1.0])
+def test_celf_matches_brute_force_greedy(v2, min_separation):
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(6.8, 7.1, 600), rng.uniform(79.8, 80.1, 600)))
+    weights = rng.uniform(1, 10, len(points))
+    points_xyz = v2.latlon_to_unit_xyz(points)
+    indptr, indices = v2.efficient_coverage_precomputation(points_xyz, cKDTree(points_xyz),
+                                                           v2.chord_length(SERVICE_RADIUS))
+    with contextlib.redirect_stdout(io.StringIO()):
+        selected, _, uncovered_weight, _ = v2.optimized_greedy_selection(
+            points, weights, (indptr, indices), SERVICE_RADIUS, min_separation, 25, 1.0, 0.0, "celf")
+    expected = brute_force_greedy(points_xyz, weights, indptr, indices, v2.chord_length(min_separation), 25)
+    assert selected == expected
+    covered = np.zeros(len(points), dtype=bool)
+    for station in expected:
+        covered[indices[indptr[station]:indptr[station + 1]]] = True
+    assert uncovered_weight == pytest.approx(weights[~covered].sum())
+
+
+def test_cache_hit_matches_miss(v2, session):
+    miss = run_v2(v2, session, USE_COVERAGE_CACHE=True)
+    hit = run_v2(v2, session, USE_COVERAGE_CACHE=True)
+    uncached = run_v2(v2, session)
+    assert not miss["optimization_stats"]["coverage_cache_hit"]
+    assert hit["optimization_stats"]["coverage_cache_hit"]
+    assert hit["stations"] == miss["stations"] == uncached["stations"]
+    assert hit["coverage_percentage"] == miss["coverage_percentage"] == uncached["coverage_percentage"]
+
+
+def test_radius_sweep_matches_separate_calls(v2, session):
+    radii = (1.0, SERVICE_RADIUS, 3.0)
+    sweep = run_v2(v2, session, SERVICE_RADII=",".join(str(r) for r in radii))
+    sweep_stations = station_table(session, sweep)
+    runs = {run["service_radius_km"]: run for run in sweep["radius_sweep"]}
+    assert sorted(runs) == list(radii)
+    for radius in radii:
+        single = run_v2(v2, session, service_radius=radius)
+        stations = sweep_stations[sweep_stations["service_radius_km"] == radius]
+        assert runs[radius]["coverage_percentage"] == pytest.approx(single["coverage_percentage"])
+        assert coordinates(single["stations"]) == [
+            (round(float(lat), 6), round(float(lon), 6)) for lat, lon in zip(stations["lat"], stations["lon"])]
+
+
+def test_existing_stations_seed_the_greedy(v2, session):
+    # Seeding with the first picks of a run continues that run exactly:
+    # their points start covered and their neighbours start blocked
+    full = run_v2(v2, session)
+    seeds = station_table(session, full).iloc[:10]
+    session.register_table("REPORT_DB.GPS_DASHBOARD.EXISTING", seeds.rename(columns=str.upper)[["LAT", "LON"]])
+    seeded = run_v2(v2, session, max_stations=MAX_STATIONS - 10, EXISTING_STATIONS="REPORT_DB.GPS_DASHBOARD.EXISTING")
+    assert coordinates(seeded["stations"]) == coordinates(full["stations"][10:])
+    assert seeded["coverage_percentage"] == pytest.approx(full["coverage_percentage"])
+    assert 0 < seeded["optimization_stats"]["existing_coverage"] < seeded["coverage_percentage"]
+
+
+def resume_until_done(run, max_calls=50):
+    for calls in range(1, max_calls + 1):
+        result = run(MAX_RUNTIME_SECONDS=1e-6)
+        if not result["partial"]:
+            return result, calls
+    raise AssertionError(f"still partial after {max_calls} calls")
+
+
+def checkpoints_left(session):
+    return [p for p in session.stage_dir.rglob("*") if p.is_file() and "checkpoints" in p.parts]
+
+
+@pytest.mark.parametrize("strategy", ["celf", "threshold"])
+def test_v2_checkpoint_resume(v2, session, strategy):
+    full = run_v2(v2, session, STRATEGY=strategy)
+    resumed, calls = resume_until_done(lambda **kw: run_v2(v2, session, STRATEGY=strategy, **kw))
+    assert calls > 1
+    assert len(resumed["stations"]) == len(full["stations"])
+    assert resumed["coverage_percentage"] == pytest.approx(full["coverage_percentage"], abs=1e-3)
+    assert not checkpoints_left(session)
+
+
+@pytest.mark.parametrize("strategy", ["celf", "threshold"])
+def test_cost_optimized_checkpoint_resume(session, strategy):
+    proc = load_procedure(PROCS_DIR / "COVERAGE_OPTIMIZATION_STATIONS_COST_OPTIMIZED.py")
+
+    def run(**kwargs):
+        return call(proc, session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, MAX_STATIONS, 8, "@S",
+                    None, None, "NULL", "NULL", "NULL", True, RESOLUTION, strategy, **kwargs)
+
+    full = run()
+    resumed, calls = resume_until_done(run)
+    assert calls > 1
+    assert len(resumed["stations"]) == len(full["stations"])
+    assert resumed["coverage_percentage"] == pytest.approx(full["coverage_percentage"], abs=1e-3)
+    assert not checkpoints_left(session)
+
+
+def run_cost(session, max_stations=MAX_STATIONS, **kwargs):
+    proc = load_procedure(PROCS_DIR / "COVERAGE_OPTIMIZATION_STATIONS_COST.py")
+    return proc, call(proc, session, SERVICE_RADIUS, MIN_SEPARATION, COVERAGE_TARGET, max_stations, 8, "@S",
+                      None, None, "NULL", "NULL", "NULL", **kwargs)
+
+
+def station_rank(proc, result, point):
+    """Selection position of the first station serving point (inf if none)"""
+    stations = np.array(coordinates(result["stations"]), dtype=np.float64).reshape(-1, 2)
+    chords = np.linalg.norm(proc.latlon_to_unit_xyz(stations) - proc.latlon_to_unit_xyz(np.array([point])), axis=1)
+    serving = np.flatnonzero(chords <= proc.chord_length(SERVICE_RADIUS))
+    return serving[0] if len(serving) else np.inf
+
+
+def test_cost_traffic_weighting_emphasises_heavy_coordinates(tmp_path):
+    # One coordinate with 300 rows against a cluster of 200 single-row
+    # coordinates, over sparse background traffic: traffic weighting must
+    # rank the heavy coordinate's station no lower than row counts alone do
+    rng = np.random.default_rng(0)
+    heavy = (7.05, 80.05)
+    background = np.column_stack((rng.uniform(6.9, 7.1, 400), rng.uniform(79.9, 80.1, 400)))
+    cluster = np.array([6.95, 79.95]) + rng.uniform(-0.003, 0.003, (200, 2))
+    points = np.vstack((background, cluster, np.repeat([heavy], 300, axis=0)))
+    session = LocalSession(stage_dir=tmp_path / "stage")
+    session.register_table(GPS_TABLE, pd.DataFrame({"MEAN_LAT": points[:, 0], "MEAN_LONG": points[:, 1]}))
+    ranks = {}
+    for weighting in (False, True):
+        proc, result = run_cost(session, use_traffic_weighting=weighting)
+        ranks[weighting] = station_rank(proc, result, heavy)
+    assert ranks[True] <= ranks[False]
+    assert ranks[True] == 0
+
+
+def min_separation_km(v2, stations):
+    """Smallest distance between two of stations (inf for fewer than two)"""
+    coords = np.array(coordinates(stations), dtype=np.float64).reshape(-1, 2)
+    distances = v2.haversine_distance(coords[:, None, 0], coords[:, None, 1], coords[None, :, 0], coords[None, :, 1])
+    return distances[np.triu_indices(len(coords), 1)].min(initial=np.inf)
+
+
+@pytest.mark.parametrize("min_separation", [0.0, 1.0])
+def test_cost_greedy_matches_brute_force_greedy(min_separation):
+    proc = load_procedure(PROCS_DIR / "COVERAGE_OPTIMIZATION_STATIONS_COST.py")
+    rng = np.random.default_rng(0)
+    points = np.column_stack((rng.uniform(6.8, 7.1, 600), rng.uniform(79.8, 80.1, 600)))
+    weights = rng.uniform(1, 10, len(points))
+    points_xyz = proc.latlon_to_unit_xyz(points)
+    indptr, indices = proc.efficient_coverage_precomputation(points_xyz, cKDTree(points_xyz),
+                                                             proc.chord_length(SERVICE_RADIUS))
+    selected, stopped_at_deadline = proc.optimized_greedy_cover(points, SERVICE_RADIUS, min_separation, 25, weights,
+                                                                candidates=points, stop_rows=0)
+    expected = brute_force_greedy(points_xyz, weights, indptr, indices, proc.chord_length(min_separation), 25)
+    assert np.array_equal(np.array(selected), points[expected])
+    assert not stopped_at_deadline
+
+
+def test_cost_grid_candidates_lie_within_one_step_of_a_point():
+    proc = load_procedure(PROCS_DIR / "COVERAGE_OPTIMIZATION_STATIONS_COST.py")
+    rng = np.random.default_rng(0)
+    # Two towns 30 km apart: most of the grid between them is empty
+    towns = np.array([[6.9, 79.9], [7.2, 79.9]])
+    points = np.vstack([town + rng.normal(0, 0.01, (300, 2)) for town in towns])
+    candidates = proc.sample_candidates(points, SERVICE_RADIUS)
+    # The grid steps SERVICE_RADIUS / 2 km and keeps cells within one step of a point
+    chords, _ = cKDTree(proc.latlon_to_unit_xyz(points)).query(proc.latlon_to_unit_xyz(candidates))
+    assert np.all(chords <= np.nextafter(proc.chord_length(SERVICE_RADIUS / 2), np.inf))
+    lat_steps = np.unique(np.round(np.diff(np.unique(candidates[:, 0])) * proc.KM_PER_DEGREE, 9))
+    assert lat_steps.min() == pytest.approx(SERVICE_RADIUS / 2)
+    town_chords, _ = cKDTree(proc.latlon_to_unit_xyz(candidates)).query(proc.latlon_to_unit_xyz(towns))
+    assert np.all(town_chords <= proc.chord_length(SERVICE_RADIUS / 2))
+
+
+def test_stochastic_strategy_is_seeded_and_keeps_separation(v2, session):
+    celf = run_v2(v2, session)
+    first = run_v2(v2, session, STRATEGY="stochastic", EPSILON=0.2)
+    second = run_v2(v2, session, STRATEGY="stochastic", EPSILON=0.2)
+    assert first["stations"] == second["stations"]
+    assert len(first["stations"]) == MAX_STATIONS
+    assert min_separation_km(v2, first["stations"]) >= MIN_SEPARATION
+    stats = first["optimization_stats"]
+    assert stats["epsilon"] == 0.2
+    assert 0 < stats["gain_evaluations"]
+    assert first["coverage_percentage"] >= 0.9 * celf["coverage_percentage"]
+
+
+def test_grid_partitions_reconcile_separation_across_borders(v2, session):
+    single = run_v2(v2, session)
+    partitioned = run_v2(v2, session, PARTITION_MODE="grid", PARTITION_COUNT=4)
+    assert len(partitioned["optimization_stats"]["partitions"]) == 4
+    assert len(partitioned["stations"]) <= MAX_STATIONS
+    assert min_separation_km(v2, partitioned["stations"]) >= MIN_SEPARATION
+    assert partitioned["coverage_percentage"] >= 0.95 * single["coverage_percentage"]
+
+
+def test_adaptive_sampling_is_deterministic_and_proportional(v2):
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame({"CELL_LAT": rng.uniform(6, 10, 20000), "CELL_LON": rng.uniform(79.5, 82, 20000),
+                          "POINT_COUNT": rng.integers(1, 100, 20000)})
+    original = frame.copy()
+    with contextlib.redirect_stdout(io.StringIO()):
+        first = v2.adaptive_sampling(frame, 2000, grid_size=10)
+        second = v2.adaptive_sampling(frame, 2000, grid_size=10)
+    pd.testing.assert_frame_equal(first, second)
+    pd.testing.assert_frame_equal(frame, original)
+    # Sampled rows keep their order, and every 10 x 10 stratum gets its
+    # share of POINT_COUNT (at least one row) up to the rows it has
+    rows = frame.reset_index().merge(first, on=list(frame.columns))["index"].to_numpy()
+    assert len(rows) == len(first) and np.all(np.diff(rows) > 0)
+    strata = [np.digitize(frame[c], np.linspace(frame[c].min(), frame[c].max(), 10)) for c in ("CELL_LAT", "CELL_LON")]
+    stratum = pd.Series(strata[0] * 11 + strata[1])
+    share = frame["POINT_COUNT"].groupby(stratum).sum() / frame["POINT_COUNT"].sum()
+    quota = np.maximum(1, (2000 * share).astype(np.int64))
+    expected = np.minimum(quota, stratum.value_counts().sort_index())
+    assert stratum.iloc[rows].value_counts().sort_index().to_dict() == expected.to_dict()
+
+
+def test_sampled_runs_are_deterministic(v2, session):
+    first = run_v2(v2, session, MAX_DATA_POINTS=N_CELLS // 3)
+    second = run_v2(v2, session, MAX_DATA_POINTS=N_CELLS // 3)
+    assert first["optimization_stats"]["data_points_processed"] <= N_CELLS // 3 * 1.1
+    assert first["stations"] == second["stations"]
+    assert first["coverage_percentage"] == second["coverage_percentage"]
+
+
+def test_coreset_coverage_lies_within_its_bounds(v2, session):
+    # The default tolerance (a tenth of the radius) is below the cell spacing
+    result = run_v2(v2, session, REDUCTION="coreset", MAX_DATA_POINTS=N_CELLS // 3, MAX_CORESET_TOLERANCE_KM=1.0)
+    stats = result["optimization_stats"]
+    assert stats["coreset_input_cells"] == N_CELLS
+    assert stats["data_points_processed"] < N_CELLS
+    assert 0 < stats["coreset_tolerance_km"] <= stats["coreset_max_tolerance_km"]
+    low, high = stats["coverage_full_data_bounds"]
+    assert low <= stats["coverage_coreset"] <= high
+    assert low <= stats["coverage_full_data"] <= high
+    assert result["coverage_basis"] == "full_data"
+    assert result["coverage_percentage"] == stats["coverage_full_data"]
+
+
+def test_swap_refinement_keeps_separation_and_never_lowers_coverage(v2, session):
+    greedy = run_v2(v2, session, max_stations=15)
+    refined = run_v2(v2, session, max_stations=15, REFINE_SECONDS=5)
+    assert len(refined["stations"]) == len(greedy["stations"])
+    assert refined["coverage_percentage"] >= greedy["coverage_percentage"] - 1e-12
+    assert min_separation_km(v2, refined["stations"]) >= MIN_SEPARATION
+    assert refined["optimization_stats"]["refine_evaluations"] > 0
+
+
+def test_budget_keeps_the_best_single_site(v2, tmp_path):
+    # Five isolated cheap sites beat one dense town on coverage per cost, but
+    # once they are bought the town's site no longer fits the budget, while
+    # the town alone covers more than all of them
+    rng = np.random.default_rng(0)
+    town = np.array([7.0, 80.0]) + rng.uniform(-0.01, 0.01, (400, 2))
+    isolated = np.column_stack((np.full(5, 7.5), 80.0 + 0.1 * np.arange(5)))
+    points = np.vstack((town, isolated))
+    session = LocalSession(stage_dir=tmp_path / "stage")
+    session.register_table(GPS_TABLE, pd.DataFrame({"MEAN_LAT": points[:, 0], "MEAN_LONG": points[:, 1]}))
+    sites = np.vstack(([7.0, 80.0], isolated))
+    session.register_table("REPORT_DB.GPS_DASHBOARD.SITES", pd.DataFrame(
+        {"LAT": sites[:, 0], "LON": sites[:, 1], "SITE_COST": [10.0] + [0.01] * 5}))
+    result = run_v2(v2, session, COST_TABLE="REPORT_DB.GPS_DASHBOARD.SITES", BUDGET=10,
+                    USE_TRAFFIC_WEIGHTING=False)
+    stats = result["optimization_stats"]
+    assert stats["best_single_site"]
+    assert stats["budget_spent"] <= 10
+    assert [station["cost"] for station in result["stations"]] == [10.0]
+    # With room for everything the greedy buys all six sites
+    everything = run_v2(v2, session, COST_TABLE="REPORT_DB.GPS_DASHBOARD.SITES", BUDGET=11,
+                        USE_TRAFFIC_WEIGHTING=False)
+    assert not everything["optimization_stats"]["best_single_site"]
+    assert len(everything["stations"]) == 6
+    assert everything["optimization_stats"]["budget_spent"] == pytest.approx(10.05)
+
+
+def test_artifacts_manifest_points_at_stage_parquet(v2, session):
+    result = run_v2(v2, session)
+    artifacts = result["artifacts"]
+    assert sorted(artifacts) == ["cells", "curve", "stations"]
+    tables = {name: pd.read_parquet(session.stage_dir / path.lstrip("@")) for name, path in artifacts.items()}
+    assert list(tables["stations"].columns) == ["service_radius_km", "station_id", "lat", "lon"]
+    assert list(tables["cells"].columns) == ["cell_lat", "cell_lon", "point_count", "weight", "station_id",
+                                             "distance_km"]
+    assert list(tables["curve"].columns) == ["service_radius_km", "stations", "coverage", "marginal_gain"]
+    assert coordinates(result["stations"]) == [(round(float(lat), 6), round(float(lon), 6))
+                                               for lat, lon in zip(tables["stations"]["lat"], tables["stations"]["lon"])]
+    cells = tables["cells"]
+    assert len(cells) == result["optimization_stats"]["data_points_processed"]
+    assert cells["station_id"].between(0, len(result["stations"])).all()
+    assert (cells["distance_km"][cells["station_id"] > 0] <= SERVICE_RADIUS).all()
+    # The returned manifest is the one serialization, also put (gzipped) beside the tables
+    manifest = (session.stage_dir / artifacts["stations"].lstrip("@")).with_name("result.json.gz")
+    assert json.loads(gzip.decompress(manifest.read_bytes())) == result
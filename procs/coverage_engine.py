@@ -0,0 +1,366 @@
+"""
+Helpers shared by the COVERAGE_OPTIMIZATION_STATIONS_* procedures.
+
+The procedures list this file in IMPORTS, so it has to be on the stage
+before they are (re)created:
+
+    PUT file://procs/coverage_engine.py @REPORT_DB.GPS_DASHBOARD.PROC_CODE
+        AUTO_COMPRESS = FALSE OVERWRITE = TRUE;
+
+Snowflake puts imported files on sys.path, so the handlers import it as a
+regular module; procs/bench/proc_loader.py does the same locally.
+
+Only light modules are imported here.  Heavy ones that not every call
+needs go through lazy_import, and numba kernels are marked with
+jit_kernel, so a call only pays for what its code path uses and the
+procedures can report what their imports cost (import_stats).
+"""
+import importlib
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+from io import BytesIO
+from itertools import chain
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0
+# Compiled kernels are cached outside the read-only import directory, so
+# only the first call on a warehouse node pays for JIT compilation
+NUMBA_CACHE_DIR = "/tmp/numba_cache"
+
+LAZY_IMPORT_SECONDS = {}
+
+def lazy_import(name):
+    """importlib.import_module(name), recording how long the first import took"""
+    if name not in sys.modules:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        LAZY_IMPORT_SECONDS[name] = time.perf_counter() - started
+    return sys.modules[name]
+
+def import_stats(module_seconds):
+    """
+    Import wall time for optimization stats: the procedure's module-level
+    imports and every lazy_import this process has done so far
+    """
+    stats = {"module": round(module_seconds, 3)}
+    stats.update({name: round(seconds, 3) for name, seconds in LAZY_IMPORT_SECONDS.items()})
+    return stats
+
+def jit_kernel(fn):
+    """
+    numba.njit(cache=True), applied when a kernel is first called.
+
+    The first call compiles every jit_kernel of fn's module and replaces
+    each with its numba dispatcher in the module, so kernels can call each
+    other and numba is only imported by code paths that run one.
+    """
+    def first_call(*args):
+        return compile_kernels(fn.__globals__)[fn.__name__](*args)
+    first_call.jit_source = fn
+    first_call.__name__ = fn.__name__
+    first_call.__doc__ = fn.__doc__
+    return first_call
+
+def compile_kernels(namespace):
+    os.environ.setdefault("NUMBA_CACHE_DIR", NUMBA_CACHE_DIR)
+    njit = lazy_import("numba").njit
+    for name, value in list(namespace.items()):
+        source = getattr(value, "jit_source", None)
+        if source is not None:
+            namespace[name] = njit(cache=True)(source)
+    return namespace
+
+def latlon_to_unit_xyz(points):
+    """(lat, lon) degrees -> 3D unit vectors, so Euclidean KD-tree queries are spherical"""
+    lat = np.radians(points[:, 0].astype(np.float64))
+    lon = np.radians(points[:, 1].astype(np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def chord_length(distance_km):
+    """Straight-line distance between unit vectors that are distance_km apart on the sphere"""
+    return 2.0 * np.sin(min(distance_km / (2.0 * EARTH_RADIUS_KM), np.pi / 2))
+
+def arc_length_km(chords):
+    """Great-circle distance in km of unit-vector chord lengths (inverse of chord_length)"""
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords / 2, 1.0))
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Vectorized haversine distance in km between (lat, lon) degrees"""
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return EARTH_RADIUS_KM * c
+
+def peak_rss_mb():
+    """High-water mark of this process' resident set in MB (Linux reports KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class PhaseTimer:
+    """
+    Wall time, peak-RSS growth and counts per phase, for
+    optimization_stats["phases"].
+
+    mark(phase) charges everything since the previous mark to phase, so
+    main() marks the end of each step rather than wrapping it and no time
+    goes unaccounted; marks of one phase accumulate.  Peak RSS is a
+    high-water mark, so a phase's delta is how far it raised the peak,
+    not how much it allocated.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._last = time.perf_counter()
+        self._last_peak = peak_rss_mb()
+
+    def mark(self, phase, **counts):
+        now, peak = time.perf_counter(), peak_rss_mb()
+        record = self.phases.setdefault(phase, {"seconds": 0.0, "peak_rss_delta_mb": 0.0})
+        record["seconds"] += now - self._last
+        record["peak_rss_delta_mb"] += peak - self._last_peak
+        for name, value in counts.items():
+            record[name] = record.get(name, 0) + int(value)
+        self._last, self._last_peak = now, peak
+
+    def summary(self):
+        return {
+            phase: {name: round(value, 3) if isinstance(value, float) else value
+                    for name, value in record.items()}
+            for phase, record in self.phases.items()
+        }
+
+def grow_buffer(buffer, rows):
+    """Copy of buffer with room for rows rows"""
+    grown = np.empty((rows,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
+
+def stream_cells(frame, capacity=65536, label_column=None, timer=None):
+    """
+    Read the CELL_LAT/CELL_LON/POINT_COUNT rows of a Snowpark DataFrame
+    batch by batch into preallocated float32/int32 buffers.
+
+    capacity is the expected row count (the query LIMIT); the buffers double
+    if it is exceeded.  Each batch is converted to unit vectors as it
+    arrives, so the KD-tree input is complete when the last batch lands and
+    the full result never exists as a pandas DataFrame.  float32 keeps
+    coordinates to within a metre, far below the H3 cell size.
+
+    Returns (points, point_counts, points_xyz, labels); labels is None
+    without label_column.  With a timer, the wait for the first batch is
+    marked sql_aggregation (the query runs until it arrives) and the rest
+    of the fetch and conversion to_pandas.
+    """
+    points = np.empty((capacity, 2), dtype=np.float32)
+    point_counts = np.empty(capacity, dtype=np.int32)
+    points_xyz = np.empty((capacity, 3), dtype=np.float64)
+    labels = []
+    n_rows = 0
+    for batch in frame.to_pandas_batches():
+        if timer is not None and n_rows == 0:
+            timer.mark("sql_aggregation")
+        end = n_rows + len(batch)
+        if end > len(points):
+            rows = max(2 * len(points), end)
+            points, point_counts, points_xyz = (grow_buffer(b, rows) for b in (points, point_counts, points_xyz))
+        points[n_rows:end, 0] = batch["CELL_LAT"].to_numpy(dtype=np.float32)
+        points[n_rows:end, 1] = batch["CELL_LON"].to_numpy(dtype=np.float32)
+        point_counts[n_rows:end] = batch["POINT_COUNT"].to_numpy(dtype=np.int32)
+        points_xyz[n_rows:end] = latlon_to_unit_xyz(points[n_rows:end])
+        if label_column:
+            labels.append(batch[label_column].to_numpy(dtype=object))
+        n_rows = end
+
+    if label_column:
+        labels = np.concatenate(labels) if labels else np.empty(0, dtype=object)
+    else:
+        labels = None
+    if timer is not None:
+        timer.mark("to_pandas" if n_rows else "sql_aggregation", rows=n_rows)
+    return points[:n_rows], point_counts[:n_rows], points_xyz[:n_rows], labels
+
+def assign_cells(points_xyz, stations_xyz, radius_km):
+    """
+    Nearest station (index into stations_xyz, -1 if none) within radius_km
+    of every point, and its great-circle distance in km (nan if none)
+    """
+    nearest = np.full(len(points_xyz), -1, dtype=np.int32)
+    distance_km = np.full(len(points_xyz), np.nan, dtype=np.float32)
+    if len(stations_xyz):
+        chords, station_idx = cKDTree(stations_xyz).query(
+            points_xyz, k=1, distance_upper_bound=np.nextafter(chord_length(radius_km), np.inf))
+        hit = np.isfinite(chords)
+        nearest[hit] = station_idx[hit]
+        distance_km[hit] = arc_length_km(chords[hit])
+    return nearest, distance_km
+
+def efficient_coverage_precomputation(candidates_xyz, tree, service_radius_chord,
+                                      max_chunk_entries=1_000_000, workers=-1):
+    """
+    Parallel, chunked coverage computation into a CSR structure.
+
+    tree and candidates_xyz are unit vectors (latlon_to_unit_xyz) and
+    service_radius_chord is chord_length(SERVICE_RADIUS), so each query
+    returns exactly the great-circle neighborhood.
+
+    Returns (indptr, indices) as int32 arrays: the points covered by
+    candidate i are indices[indptr[i]:indptr[i + 1]].  A first counting
+    pass fixes indptr exactly, then candidates are queried in chunks of at
+    most max_chunk_entries neighbors (on all cores) and written straight
+    into the preallocated indices array, so only one chunk of Python
+    neighbor lists is alive at a time.
+    """
+    n_candidates = len(candidates_xyz)
+    counts = tree.query_ball_point(candidates_xyz, service_radius_chord,
+                                   return_length=True, workers=workers)
+    indptr = np.zeros(n_candidates + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    total_entries = int(indptr[-1])
+    if total_entries > np.iinfo(np.int32).max:
+        raise ValueError(f"Coverage has {total_entries} entries; reduce SERVICE_RADIUS or MAX_DATA_POINTS")
+    indices = np.empty(total_entries, dtype=np.int32)
+
+    # Chunk boundaries so that each chunk holds ~max_chunk_entries neighbors
+    targets = np.arange(max_chunk_entries, total_entries, max_chunk_entries)
+    bounds = np.unique(np.concatenate((
+        [0], np.searchsorted(indptr, targets, side="right") - 1, [n_candidates]
+    )))
+    print(f"[INFO] Computing coverage for {n_candidates} candidates "
+          f"({total_entries} entries) in {len(bounds) - 1} chunks")
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
+        neighbors = tree.query_ball_point(candidates_xyz[start:end], service_radius_chord,
+                                          workers=workers, return_sorted=False)
+        lo, hi = indptr[start], indptr[end]
+        indices[lo:hi] = np.fromiter(chain.from_iterable(neighbors), dtype=np.int32, count=hi - lo)
+
+    return indptr.astype(np.int32), indices
+
+class SeparationGrid:
+    """
+    Spatial hash of selected stations for O(1) MIN_SEPARATION checks.
+
+    Cells are min_separation wide (longitude widened for the highest
+    latitude seen), so any station closer than min_separation lies in one
+    of the 3x3 cells around a candidate; only those are distance-checked.
+    """
+
+    def __init__(self, min_separation, max_abs_lat):
+        self.min_separation = min_separation
+        self.cell_lat = max(min_separation, 1e-9) / (EARTH_RADIUS_KM * np.pi / 180) * 1.001
+        self.cell_lon = self.cell_lat / max(np.cos(np.radians(min(abs(max_abs_lat) + 1.0, 89.0))), 1e-6)
+        self.cells = defaultdict(list)
+
+    def _key(self, lat, lon):
+        return int(np.floor(lat / self.cell_lat)), int(np.floor(lon / self.cell_lon))
+
+    def add(self, lat, lon):
+        self.cells[self._key(lat, lon)].append((lat, lon))
+
+    def too_close(self, lat, lon):
+        if self.min_separation <= 0:
+            return False
+        row, col = self._key(lat, lon)
+        nearby = [station for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                  for station in self.cells.get((row + dr, col + dc), ())]
+        if not nearby:
+            return False
+        nearby = np.asarray(nearby)
+        distances = haversine_distance(lat, lon, nearby[:, 0], nearby[:, 1])
+        return bool(np.any(distances < self.min_separation))
+
+def grid_partitions(points, partition_count):
+    """
+    Split points into about partition_count spatial cells of equal size:
+    longitude quantile stripes, each cut into latitude quantile blocks.
+    """
+    cols = int(np.ceil(np.sqrt(partition_count)))
+    rows = int(np.ceil(partition_count / cols))
+    col = np.searchsorted(np.quantile(points[:, 1], np.linspace(0, 1, cols + 1)[1:-1]),
+                          points[:, 1], side="right")
+    labels = np.empty(len(points), dtype=np.int64)
+    for c in range(cols):
+        members = np.flatnonzero(col == c)
+        if len(members) == 0:
+            continue
+        lat = points[members, 0]
+        row = np.searchsorted(np.quantile(lat, np.linspace(0, 1, rows + 1)[1:-1]), lat, side="right")
+        labels[members] = c * rows + row
+    return np.unique(labels, return_inverse=True)[1]
+
+def partition_halo(points_xyz, own, radius_chord):
+    """
+    Points (indices into points_xyz) outside own within radius_chord of an
+    own point, found by a nearest-neighbor query restricted to the own
+    points' bounding box expanded by the radius; and the cKDTree of the
+    own points
+    """
+    own_tree = cKDTree(points_xyz[own])
+    low = points_xyz[own].min(axis=0) - radius_chord
+    high = points_xyz[own].max(axis=0) + radius_chord
+    outside = np.all((points_xyz >= low) & (points_xyz <= high), axis=1)
+    outside[own] = False
+    nearby = np.flatnonzero(outside)
+    if len(nearby) == 0:
+        return nearby, own_tree
+    distances, _ = own_tree.query(points_xyz[nearby], k=1,
+                                  distance_upper_bound=np.nextafter(radius_chord, np.inf))
+    return nearby[np.isfinite(distances)], own_tree
+
+# Shared arrays of a partitioned solve, read by the procedures'
+# solve_partition functions in this process and in forked workers
+PARTITION_CONTEXT = {}
+
+def init_partition_worker(context):
+    """Make the shared arrays of a partitioned solve visible in PARTITION_CONTEXT"""
+    PARTITION_CONTEXT.clear()
+    PARTITION_CONTEXT.update(context)
+
+def solve_partitions(solve, context, partition_ids, workers):
+    """
+    [solve(partition_id) for partition_id in partition_ids] with context in
+    PARTITION_CONTEXT, in forked worker processes when more than one is
+    allowed.  Workers inherit the shared arrays through the fork instead of
+    receiving pickled copies; solve must be a module-level function.
+
+    PARTITION_CONTEXT["query_workers"] is the thread count a solve should
+    give its tree queries: all cores (-1) in process, an equal share of
+    them in each pool worker so the pool does not oversubscribe the cores.
+    """
+    init_partition_worker({**context, "query_workers": -1})
+    if workers > 1 and len(partition_ids) > 1:
+        # Process pools are only imported by partitioned runs
+        try:
+            fork_context = lazy_import("multiprocessing").get_context("fork")
+        except ValueError:
+            fork_context = None
+        if fork_context is not None:
+            executor = lazy_import("concurrent.futures").ProcessPoolExecutor
+            with executor(max_workers=workers, mp_context=fork_context,
+                          initializer=init_partition_worker,
+                          initargs=({**context, "query_workers": max(1, (os.cpu_count() or 1) // workers)},)) as pool:
+                return list(pool.map(solve, partition_ids))
+    return [solve(partition_id) for partition_id in partition_ids]
+
+def save_artifacts(session, stage_prefix, tables):
+    """
+    Upload every DataFrame of tables as <stage_prefix>/<name>.parquet
+    (zstd-compressed, so not gzipped again) and return {name: stage path}
+    """
+    paths = {}
+    for name, frame in tables.items():
+        buffer = BytesIO()
+        frame.to_parquet(buffer, compression="zstd", index=False)
+        buffer.seek(0)
+        paths[name] = f"{stage_prefix}/{name}.parquet"
+        session.file.put_stream(buffer, paths[name], auto_compress=False, overwrite=True)
+    return paths